@@ -1,17 +1,24 @@
 import os
 import io
 import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, Response, stream_with_context
 from datetime import datetime
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from models.database import Database
+from models import db_metrics
+from models import analytics_snapshot
+from models import rag_warmup
+from models.projections import (
+    PATIENT_NAME_FIELDS, PATIENT_PROFILE_FIELDS, PATIENT_TRENDS_FIELDS, DASHBOARD_STATS_FIELDS
+)
 from models.user import (
-    User, get_all_doctors, get_all_patients, get_patient_data, save_patient_data, 
-    get_all_patients_data, get_patient_records, save_patient_record, get_patient_trials, 
+    User, get_patient_data, save_patient_data, 
+    get_patient_records, save_patient_record, get_patient_trials, 
     update_patient_trials, create_appointment, get_appointments_for_doctor, 
-    get_appointments_for_patient, save_feedback, get_all_feedbacks,
-    get_prescriptions_for_doctor, create_prescription_record
+    get_appointments_for_patient, save_feedback,
+    create_prescription_record,
+    get_user_lookups_avoided, invalidate_user_cache
 )
 from dotenv import load_dotenv
 import atexit
@@ -30,8 +37,14 @@ load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SESSION_SECRET', 'dev_secret_key')
 
-# Initialize Database
-Database.initialize()
+# The MongoDB client is created lazily by Database.get_db() in each worker process,
+# so pre-fork servers do not share sockets opened before the fork
+db_metrics.init_app(app)
+# Columnar lab history snapshot for analytics; refreshed in the background when
+# ANALYTICS_SNAPSHOT_INTERVAL is set, otherwise by `python -m models.analytics_snapshot`
+analytics_snapshot.start_background_refresh()
+# RAG_WARMUP: load the chatbot's RAG engine and embedding model in the background at startup
+rag_warmup.start()
 
 # Setup Login Manager
 login_manager = LoginManager()
@@ -40,7 +53,13 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_by_id(user_id)
+    return User.get_cached(user_id)
+
+@app.after_request
+def add_user_lookup_stats(response):
+    """Expose how many users lookups the identity map/loader cache saved for this request"""
+    response.headers['X-User-Lookups-Avoided'] = str(get_user_lookups_avoided())
+    return response
 
 
 
@@ -224,7 +243,7 @@ def chatbot_welcome():
         return jsonify({'error': 'Access denied. Chatbot is for patients only.'}), 403
     
     from models.user import get_patient_records
-    patient_data = get_patient_records(current_user.username)
+    patient_data = get_patient_records(current_user.username, projection=PATIENT_NAME_FIELDS)
     patient_name = patient_data.get('name') if patient_data else None
     
     from models.patient_chatbot import get_patient_chatbot
@@ -255,11 +274,16 @@ def chatbot_message():
             }), 400
         
         from models.user import get_patient_records
-        patient_data = get_patient_records(current_user.username)
-        
         from models.patient_chatbot import get_patient_chatbot
+        patient_data = get_patient_records(current_user.username, projection=PATIENT_PROFILE_FIELDS)
+        
         chatbot = get_patient_chatbot()
-        response = chatbot.process_message(message, patient_data)
+        # One conversation per login session
+        if 'chat_session_id' not in session:
+            import uuid
+            session['chat_session_id'] = uuid.uuid4().hex
+        response = chatbot.process_message(message, patient_data, user_id=current_user.username,
+                                           session_id=session['chat_session_id'])
         
         return jsonify({
             'success': True,
@@ -331,23 +355,58 @@ def admin_login():
     
     return render_template('admin_login.html')
 
+ADMIN_PATIENTS_PER_PAGE = 20
+ADMIN_FEEDBACK_PER_PAGE = 10
+
 @app.route('/admin/dashboard')
 def admin_dashboard():
     if not session.get('admin_logged_in'):
         flash('Please login as admin first', 'warning')
         return redirect(url_for('admin_login'))
     
-    # Get all doctors
-    doctors = get_all_doctors()
+    patients_doctor = request.args.get('patients_doctor') or None
+    patients_page = max(request.args.get('patients_page', 1, type=int), 1)
+    feedback_page = max(request.args.get('feedback_page', 1, type=int), 1)
     
-    # Add patients list to each doctor
-    for doctor in doctors:
-        doctor.patients = get_all_patients()
+    # Doctors with per-doctor patient counts and one page of patients; patients_doctor pages one doctor's list
+    from models.user import get_admin_doctor_overview, get_feedbacks_page
+    doctors = get_admin_doctor_overview(patients_doctor, patients_page, ADMIN_PATIENTS_PER_PAGE)
     
-    # Get feedbacks from database
-    feedbacks = get_all_feedbacks()
+    # Get one page of feedbacks from database
+    feedbacks, feedback_total = get_feedbacks_page(feedback_page, ADMIN_FEEDBACK_PER_PAGE)
     
-    return render_template('admin_dashboard.html', doctors=doctors, feedbacks=feedbacks)
+    return render_template('admin_dashboard.html', doctors=doctors, feedbacks=feedbacks,
+                           patients_doctor=patients_doctor, patients_page=patients_page,
+                           patients_per_page=ADMIN_PATIENTS_PER_PAGE,
+                           feedback_page=feedback_page, feedback_total=feedback_total,
+                           feedback_per_page=ADMIN_FEEDBACK_PER_PAGE)
+
+@app.route('/admin/metrics/db')
+def admin_db_metrics():
+    """Per-route MongoDB command totals, chattiest routes first"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Access denied'}), 403
+    top = min(max(request.args.get('top', 10, type=int), 1), 100)
+    by = request.args.get('by', 'commands')
+    if by not in ('commands', 'duration_ms', 'documents', 'bytes', 'max_commands'):
+        return jsonify({'error': f'Unknown sort key: {by}'}), 400
+    # Reply bytes are only counted with DB_METRICS_BYTES (or the X-DB-Stats header) on
+    return jsonify({'by': by, 'routes': db_metrics.route_metrics.top_routes(top, by),
+                    'bytes_counted': db_metrics.DB_METRICS_BYTES, 'pool': Database.pool_stats()})
+
+@app.route('/admin/metrics/rag')
+def admin_rag_metrics():
+    """Query embedding and semantic answer cache hit rates for the chatbot's RAG path"""
+    if not session.get('admin_logged_in'):
+        return jsonify({'error': 'Access denied'}), 403
+    from models import rag_engine
+    from models.answer_cache import get_answer_cache
+    if rag_engine._rag_engine_instance is None:
+        return jsonify({'started': False, 'warmup': rag_warmup.state(), 'answer_cache': get_answer_cache().stats()})
+    engine = rag_engine._rag_engine_instance
+    return jsonify({'started': True, 'warmup': rag_warmup.state(), 'query_cache': engine.cache_stats(),
+                    'retrieval': engine.retrieval_stats(),
+                    'answer_cache': get_answer_cache().stats()})
 
 @app.route('/admin/add_doctor', methods=['POST'])
 def add_doctor():
@@ -372,6 +431,9 @@ def add_doctor():
     
     # Create new doctor
     User.create_user(username, password, 'doctor', email, specialization, city)
+    invalidate_user_cache(username=username)
+    from models.doctor_directory import get_doctor_directory
+    get_doctor_directory().invalidate()
     
     flash(f'Doctor {username} added successfully!', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -412,6 +474,7 @@ def complete_tour():
             )
             
         current_user.has_seen_tour = True
+        invalidate_user_cache(user_id=current_user.id)
         return jsonify({'success': True})
     except Exception as e:
         print(f"Error completing tour: {e}")
@@ -426,12 +489,14 @@ def doctor_dashboard():
         flash('Access denied. Doctors only.', 'danger')
         return redirect(url_for('patient_portal'))
     
-    from models.user import get_doctor_patients_with_details, get_appointments_for_doctor
+    from models.user import get_doctor_patients_page, get_appointments_for_doctor
     
-    filtered_patients = get_doctor_patients_with_details(current_user.username)
+    # First page only; the dashboard loads further pages on demand
+    filtered_patients, next_cursor = get_doctor_patients_page(current_user.username, None, PAGE_SIZE_DEFAULT)
     appointments = get_appointments_for_doctor(current_user.username)
     
-    return render_template('doctor_dashboard.html', patients=filtered_patients, appointments=appointments)
+    return render_template('doctor_dashboard.html', patients=filtered_patients, appointments=appointments,
+                           next_cursor=next_cursor)
 
 @app.route('/doctor/appointment/complete/<appointment_id>', methods=['POST'])
 @login_required
@@ -526,7 +591,9 @@ def get_dashboard_stats():
         return jsonify({'error': 'Access denied'}), 403
     
     from models.user import get_all_patients_data
-    all_patients_data = get_all_patients_data()
+    all_patients_data = get_all_patients_data(
+        projection=DASHBOARD_STATS_FIELDS
+    )
     
     total_patients = len(all_patients_data)
     high_risk = len([p for p in all_patients_data if p.get('risk_level') in ['High', 'Critical']])
@@ -540,6 +607,79 @@ def get_dashboard_stats():
         'avg_risk': round(avg_risk, 1)
     })
 
+@app.route('/api/export/cohort')
+def export_cohort():
+    """Stream a cohort's lab history (CSV, NDJSON or Parquet): admins export everyone, doctors their own patients"""
+    is_admin = session.get('admin_logged_in')
+    is_doctor = current_user.is_authenticated and current_user.is_doctor()
+    if not (is_doctor or is_admin):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    from models.cohort_export import stream_cohort, parquet_available, EXPORT_FORMATS, CONTENT_TYPES
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported format: {fmt}'}), 400
+    if fmt == 'parquet' and not parquet_available():
+        return jsonify({'error': 'Parquet export requires pyarrow'}), 400
+    
+    patient_keys = None
+    if not is_admin:
+        from models.user import get_doctor_patient_keys
+        patient_keys = get_doctor_patient_keys(current_user.username)
+    
+    usernames = request.args.get('usernames')
+    chunks = stream_cohort(
+        fmt,
+        risk_level=request.args.get('risk_level'),
+        stage=request.args.get('stage'),
+        usernames=usernames.split(',') if usernames else None,
+        since=request.args.get('since'),
+        until=request.args.get('until'),
+        patient_keys=patient_keys
+    )
+    filename = f"cohort_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return Response(stream_with_context(chunks), mimetype=CONTENT_TYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def _analytics_access_error():
+    is_doctor = current_user.is_authenticated and current_user.is_doctor()
+    if not (is_doctor or session.get('admin_logged_in')):
+        return jsonify({'error': 'Access denied'}), 403
+    if not analytics_snapshot.snapshot_available():
+        return jsonify({'error': 'Analytics snapshot requires pyarrow'}), 503
+    return None
+
+@app.route('/api/analytics/egfr-decline')
+def analytics_egfr_decline():
+    """Average eGFR decline by CKD stage, answered from the analytics snapshot"""
+    error = _analytics_access_error()
+    if error:
+        return error
+    years = min(max(request.args.get('years', 2, type=float), 0.25), 20)
+    return jsonify({'years': years, 'stages': analytics_snapshot.egfr_decline_by_stage(years),
+                    'snapshot': analytics_snapshot.snapshot_info()})
+
+@app.route('/api/analytics/summary')
+def analytics_summary():
+    """count/mean/min/max of a lab metric grouped by stage, risk level or test type"""
+    error = _analytics_access_error()
+    if error:
+        return error
+    metric = request.args.get('metric', 'egfr')
+    by = request.args.get('by', 'stage')
+    if by not in ('stage', 'risk_level', 'test_type', 'source'):
+        return jsonify({'error': f'Unknown grouping: {by}'}), 400
+    try:
+        groups = analytics_snapshot.metric_summary(metric, by, request.args.get('since'), request.args.get('until'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'metric': metric, 'by': by, 'groups': groups,
+                    'snapshot': analytics_snapshot.snapshot_info()})
+
+# Keyset pagination bounds for doctor-facing lists
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+
 @app.route('/api/doctor/dashboard/patients')
 @login_required
 def get_dashboard_patients():
@@ -547,10 +687,11 @@ def get_dashboard_patients():
     if not current_user.is_doctor():
         return jsonify({'error': 'Access denied'}), 403
     
-    from models.user import get_doctor_patients_with_details
-    patients = get_doctor_patients_with_details(current_user.username)
+    from models.user import get_doctor_patients_page
+    limit = min(max(request.args.get('limit', PAGE_SIZE_DEFAULT, type=int), 1), PAGE_SIZE_MAX)
+    patients, next_cursor = get_doctor_patients_page(current_user.username, request.args.get('cursor'), limit)
     
-    return jsonify({'patients': patients})
+    return jsonify({'patients': patients, 'next_cursor': next_cursor})
 
 
 @app.route('/doctor/add-patient', methods=['GET', 'POST'])
@@ -687,67 +828,52 @@ def doctor_patient_details(patient_id):
     # Import Database here to avoid duplication
     from models.database import Database
     
-    # Get patient data from patients_data collection
-    patient_data = get_patient_data(patient_id)
-    
-    # Convert MongoDB document to dict if needed
-    if patient_data and hasattr(patient_data, 'copy'):
-        patient_data = dict(patient_data)
-        patient_data.pop('_id', None)
-    
-    # If not found, try to find in all patients data
-    patient_username = None
-    if not patient_data:
-        all_patients = get_all_patients_data()
-        for patient in all_patients:
-            if patient.get('patient_id') == patient_id:
-                patient_data = dict(patient) if patient else None
-                if patient_data:
-                    patient_data.pop('_id', None)
-                    patient_username = patient_data.get('username')
-                break
+    # Resolve any identifier form (patient_id, P<userid>, username, ObjectId) in one query
+    from models.patient_identity import resolve_patient_identity
+    identity = resolve_patient_identity(patient_id)
+    patient_username = identity['username'] if identity else None
+    patient_data = None
     
-    # Extract username from patient_data if available
-    if patient_data and not patient_username:
-        patient_username = patient_data.get('username')
+    # Get patient data from patients_data collection: the resolved document first,
+    # then any document stored under the username (existing fields take precedence)
+    db = Database.get_db()
+    primary_id = identity['patients_data_id'] if identity else None
+    clauses = []
+    if primary_id is not None:
+        clauses.append({'_id': primary_id})
+    if patient_username:
+        clauses.append({'username': patient_username})
+    
+    from models import async_db
+    patient_records = prescriptions = None
+    if patient_username and async_db.enabled():
+        # patients_data, patient_records and prescriptions are independent: fetch them concurrently
+        docs, patient_records, prescriptions = async_db.gather(
+            async_db.get_patient_data_docs({'$or': clauses}),
+            async_db.get_patient_records(patient_username),
+            async_db.get_prescriptions_for_patient(patient_username)
+        )
+    elif clauses and db is not None:
+        docs = list(db.patients_data.find({'$or': clauses}))
+    else:
+        docs = []
     
-    # If patient_id starts with 'P', try extracting username by looking up User ID
-    if not patient_username and patient_id.startswith('P'):
-        potential_id = patient_id[1:]
-        # Import User model to lookup by ID
-        from models.user import User
-        user = User.get_by_id(potential_id)
-        if user:
-            patient_username = user.username
-            print(f"Resolved patient_id {patient_id} to username {patient_username}")
+    # The resolved document first, then any stored under the username
+    for doc in sorted(docs, key=lambda d: d['_id'] != primary_id):
+        doc = dict(doc)
+        doc.pop('_id', None)
+        if patient_data:
+            for key, value in doc.items():
+                if key not in patient_data or not patient_data.get(key):
+                    patient_data[key] = value
         else:
-            # Fallback to old behavior just in case
-            patient_username = potential_id
-    
-    # Try to get additional patient info directly from database
-    # Look in patients_data collection with username match to get complete patient info
-    if patient_username:
-        db = Database.get_db()
-        if db is not None:
-            # Try to find patient by username in patients_data
-            patient_by_username = db.patients_data.find_one({'username': patient_username})
-            if patient_by_username:
-                # Convert to dict and remove _id
-                patient_by_username = dict(patient_by_username)
-                patient_by_username.pop('_id', None)
-                # Merge with existing patient_data (existing patient_data takes precedence)
-                if patient_data:
-                    # Merge missing fields from patient_by_username
-                    for key, value in patient_by_username.items():
-                        if key not in patient_data or not patient_data.get(key):
-                            patient_data[key] = value
-                else:
-                    patient_data = patient_by_username.copy()
-                    patient_data['patient_id'] = patient_id
+            patient_data = doc
+            patient_data.setdefault('patient_id', patient_id)
     
     # Try to get additional patient info from patient_records
     if patient_username:
-        patient_records = get_patient_records(patient_username)
+        if patient_records is None:
+            patient_records = get_patient_records(patient_username)
         if patient_records:
             # Convert to dict if needed
             if hasattr(patient_records, 'copy'):
@@ -849,7 +975,8 @@ def doctor_patient_details(patient_id):
     return render_template('results.html', 
                          patient=patient_data,
                          lab_results=patient_data.get('history', []),
-                         prescriptions=get_prescriptions_for_patient(patient_username) if patient_username else [])
+                         prescriptions=prescriptions if prescriptions is not None else
+                         (get_prescriptions_for_patient(patient_username) if patient_username else []))
 
 def get_prescriptions_for_patient(username):
     """Helper to get prescriptions for a patient"""
@@ -1002,12 +1129,24 @@ def patient_dashboard():
         return redirect(url_for('doctor_dashboard'))
     
     try:
-        # Get patient records (Lab History)
-        lab_records = get_patient_records(current_user.username)
-        
-        # Get patient intake data (Personal Info)
         patient_id = f"P{current_user.id}"
-        intake_data = get_patient_data(patient_id)
+        from models import async_db
+        if async_db.enabled():
+            # Lab history, intake data, trials and appointments are independent: fetch them concurrently
+            lab_records, intake_data, patient_trials, upcoming_appointments = async_db.gather(
+                async_db.get_patient_records(current_user.username),
+                async_db.get_patient_data(patient_id),
+                async_db.get_patient_trials(current_user.username),
+                async_db.get_appointments_for_patient(current_user.username)
+            )
+        else:
+            # Get patient records (Lab History)
+            lab_records = get_patient_records(current_user.username)
+            # Get patient intake data (Personal Info)
+            intake_data = get_patient_data(patient_id)
+            # Get patient trial information
+            patient_trials = get_patient_trials(current_user.username)
+            upcoming_appointments = None
         
         # Merge data: Intake data first, then Lab records override (for metrics/history)
         patient_data = {}
@@ -1016,12 +1155,6 @@ def patient_dashboard():
         if lab_records:
             patient_data.update(lab_records)
         
-        # Get patient trial information
-        patient_trials = get_patient_trials(current_user.username)
-        
-        # Get available doctors
-        doctors_list = get_all_doctors()
-        
         # Get patient location (from User object or patient_data)
         # First try patient_data which comes from the form
         patient_location = patient_data.get('city')
@@ -1038,29 +1171,9 @@ def patient_dashboard():
         if not patient_location:
              patient_location = 'Mumbai' 
 
-        available_doctors = []
-        for doc in doctors_list:
-            # Use real doctor location
-            doc_location = doc.city if doc.city else 'Unknown'
-            
-            # Calculate priority (0 = Same City/Highest Priority, 1 = Others)
-            priority = 0 if patient_location and doc_location and doc_location.lower() == patient_location.lower() else 1
-            
-            available_doctors.append({
-                'name': f"Dr. {doc.username}",
-                'username': doc.username,
-                'specialty': doc.specialization or 'General',
-                'experience': 'Experienced',
-                'avatar': doc.username[:2].upper(),
-                'location': doc_location,
-                'priority': priority
-            })
-            
-        # Sort doctors: Priority 0 first, then by name
-        available_doctors.sort(key=lambda x: (x['priority'], x['name']))
-        
-        # Limit to 3 for dashboard display
-        dashboard_doctors = available_doctors[:3]
+        # Top 3 doctors for dashboard display: same city first, then by name
+        from models.doctor_directory import get_doctor_directory
+        dashboard_doctors = get_doctor_directory().top_k(patient_location, 3)
         
         # Prepare dashboard data with defaults
         dashboard_data = {
@@ -1245,9 +1358,9 @@ def patient_dashboard():
         # Check if user has seen the tour (stored in User model)
         show_tour = not current_user.has_seen_tour
 
-        # Get upcoming appointments for patient
-        from models.user import get_appointments_for_patient
-        upcoming_appointments = get_appointments_for_patient(current_user.username)
+        # Get upcoming appointments for patient (already fetched on the async path)
+        if upcoming_appointments is None:
+            upcoming_appointments = get_appointments_for_patient(current_user.username)
         
         # DEBUG LOGGING
         with open('debug_log.txt', 'a') as f:
@@ -1302,28 +1415,9 @@ def all_doctors_view():
         if not patient_location:
              patient_location = 'Mumbai'
         
-        # Get all doctors
-        doctors_list = get_all_doctors()
-        
-        all_doctors = []
-        for doc in doctors_list:
-             # Use real doctor location
-            doc_location = doc.city if doc.city else 'Unknown'
-            # Calculate priority (0 = Same City/Highest Priority, 1 = Others)
-            priority = 0 if patient_location and doc_location and doc_location.lower() == patient_location.lower() else 1
-            
-            all_doctors.append({
-                'name': f"Dr. {doc.username}",
-                'username': doc.username,
-                'specialty': doc.specialization or 'General',
-                'experience': 'Experienced',
-                'avatar': doc.username[:2].upper(),
-                'location': doc_location,
-                'priority': priority
-            })
-            
-        # Sort: same location first
-        all_doctors.sort(key=lambda x: (x['priority'], x['name']))
+        # Get all doctors, same location first
+        from models.doctor_directory import get_doctor_directory
+        all_doctors = get_doctor_directory().ranked(patient_location)
         
         return render_template('all_doctors.html', doctors=all_doctors, patient_location=patient_location)
         
@@ -1334,34 +1428,12 @@ def all_doctors_view():
         flash('Unable to load doctors list.', 'danger')
         return redirect(url_for('patient_dashboard'))
 
-def get_patient_lab_results(patient_identifier, db):
-    """Helper function to get lab results with multiple fallback methods"""
-    from bson.objectid import ObjectId
-    
-    # Try different query methods
-    query_methods = [
-        # Try exact match with patient_id
-        {'patient_id': str(patient_identifier)},
-        # Try with ObjectId if valid
-        {'patient_id': ObjectId(patient_identifier)} if ObjectId.is_valid(str(patient_identifier)) else None,
-        # Try with username
-        {'patient_username': str(patient_identifier)},
-        # Try with patient_username as ObjectId if valid
-        {'patient_username': ObjectId(patient_identifier)} if ObjectId.is_valid(str(patient_identifier)) else None
-    ]
-    
-    # Remove None values from methods
-    query_methods = [q for q in query_methods if q is not None]
-    
-    for query in query_methods:
-        try:
-            results = list(db.lab_results.find(query).sort('test_date', -1))
-            if results:
-                return results
-        except Exception as e:
-            print(f"Query {query} failed: {str(e)}")
-            continue
-    return []
+def get_patient_lab_results(patient_keys, db):
+    """Lab results stored under any of a patient's identifiers, newest first"""
+    return list(db.lab_results.find({'$or': [
+        {'patient_id': {'$in': patient_keys}},
+        {'patient_username': {'$in': patient_keys}}
+    ]}).sort('test_date', -1))
 
 @app.route('/api/doctor/patient/<patient_id>/health-trends')
 @login_required
@@ -1372,113 +1444,45 @@ def get_patient_health_trends(patient_id):
     print(f"\n=== Processing health trends for patient_id: {patient_id} ===")
     
     try:
-        from bson.objectid import ObjectId, InvalidId
         from models.database import Database
-        from models.user import get_patient_data
         
         db = Database.get_db()
         if db is None:
             return jsonify({'error': 'Database connection failed'}), 500
             
-        # Try different methods to find the patient
-        patient_data = None
-        
-        # Method 1: Try with the ID as is
-        try:
-            if ObjectId.is_valid(patient_id):
-                patient_data = db.patients_data.find_one({'_id': ObjectId(patient_id)})
-                if patient_data:
-                    print(f"Found patient by ObjectId: {patient_id}")
-        except (InvalidId, Exception) as e:
-            print(f"Error searching by ObjectId: {str(e)}")
-            
-        # Method 2: Try with patient_id field
-        if not patient_data:
-            patient_data = db.patients_data.find_one({'patient_id': patient_id})
-            if patient_data:
-                print(f"Found patient by patient_id: {patient_id}")
-        
-        # Method 3: If ID starts with 'P', try without it
-        if not patient_data and patient_id.startswith('P'):
-            alt_id = patient_id[1:]
-            if ObjectId.is_valid(alt_id):
-                patient_data = db.patients_data.find_one({'_id': ObjectId(alt_id)})
-                if patient_data:
-                    print(f"Found patient by alt ObjectId: {alt_id}")
-            
-            if not patient_data:
-                patient_data = db.patients_data.find_one({'patient_id': alt_id})
-                if patient_data:
-                    print(f"Found patient by alt patient_id: {alt_id}")
+        # Resolve the patient with one query, whichever identifier form was passed
+        from models.patient_identity import resolve_patient_identity, identity_keys
+        identity = resolve_patient_identity(patient_id)
         
-        # Method 4: Try by username
-        if not patient_data:
-            user = User.get_by_username(patient_id)
-            if user:
-                patient_data = db.patients_data.find_one({'username': patient_id})
-                if patient_data:
-                    print(f"Found patient by username: {patient_id}")
-
-        # Method 5: Try by ID in users collection (fallback if not in patients_data)
-        if not patient_data:
-            # Try stripping 'P' if present
-            search_id = patient_id[1:] if patient_id.startswith('P') else patient_id
-            if ObjectId.is_valid(search_id):
-                user_doc = db.users.find_one({'_id': ObjectId(search_id), 'role': 'patient'})
-                if user_doc:
-                    print(f"Found user in users collection: {search_id}")
-                    # Construct minimal patient_data
-                    patient_data = {
-                        '_id': user_doc['_id'],
-                        'patient_id': patient_id, 
-                        'username': user_doc.get('username'),
-                        'first_name': user_doc.get('username'), # Fallback
-                        'last_name': '',
-                        'email': user_doc.get('email'),
-                        'age': 'N/A',
-                        'gender': 'N/A'
-                    }
+        patient_data = None
+        if identity and identity['patients_data_id'] is not None:
+            patient_data = db.patients_data.find_one({'_id': identity['patients_data_id']})
+        elif identity:
+            # Not in patients_data: construct minimal patient_data from the resolved user
+            patient_data = {
+                '_id': identity['user_id'],
+                'patient_id': identity['patient_id'],
+                'username': identity['username'],
+                'first_name': identity['username'], # Fallback
+                'last_name': '',
+                'email': identity['email'],
+                'age': 'N/A',
+                'gender': 'N/A'
+            }
         
         if not patient_data:
-            print(f"Patient not found with any method for ID: {patient_id}")
+            print(f"Patient not found for ID: {patient_id}")
             return jsonify({
                 'error': 'Patient not found',
                 'searched_id': patient_id,
-                'tried_methods': ['direct_id', 'patient_id_field', 'alt_id', 'username']
+                'tried_methods': ['object_id', 'patient_id', 'p_prefixed_user_id', 'username']
             }), 404
             
         print(f"Found patient data: {patient_data.get('_id')} - {patient_data.get('username')}")
-        
-        if not patient_data:
-            return jsonify({'error': 'Patient not found'}), 404
             
-        # Get lab results using helper function
-        lab_results = []
+        # Get lab results stored under any of the patient's identifiers in one query
         try:
-            # Try with various identifiers
-            identifiers = [
-                patient_data.get('_id'),
-                patient_data.get('patient_id'),
-                patient_data.get('username'),
-                str(patient_data.get('_id')),  # Convert ObjectId to string
-                patient_id,  # Original ID
-                patient_id[1:] if patient_id.startswith('P') else None  # Without 'P' prefix
-            ]
-            
-            # Remove None and duplicate values
-            identifiers = list({str(i) for i in identifiers if i is not None})
-            
-            print(f"Trying to find lab results with identifiers: {identifiers}")
-            
-            for identifier in identifiers:
-                lab_results = get_patient_lab_results(identifier, db)
-                if lab_results:
-                    print(f"Found {len(lab_results)} lab results using identifier: {identifier}")
-                    break
-            
-            if not lab_results:
-                print("No lab results found with any identifier")
-                
+            lab_results = get_patient_lab_results(identity_keys(identity, patient_id), db)
         except Exception as e:
             print(f"Error in lab results query: {str(e)}")
             import traceback
@@ -1627,8 +1631,23 @@ def get_patient_dashboard_data(patient_id):
         return jsonify({'error': 'Access denied. Doctors only.'}), 403
     
     try:
-        # Get patient data
-        patient_data = get_patient_data(patient_id)
+        # Get patient data via the identity resolver
+        from models.patient_identity import resolve_patient_identity
+        from models.database import Database
+        identity = resolve_patient_identity(patient_id)
+        patient_data = None
+        upcoming_appointments = None
+        db = Database.get_db()
+        from models import async_db
+        if identity and identity['patients_data_id'] is not None and async_db.enabled():
+            # Patient document and appointments are independent: fetch them concurrently
+            patient_docs, upcoming_appointments = async_db.gather(
+                async_db.get_patient_data_docs({'_id': identity['patients_data_id']}),
+                async_db.get_appointments_for_patient(current_user.username)
+            )
+            patient_data = patient_docs[0] if patient_docs else None
+        elif identity and identity['patients_data_id'] is not None and db is not None:
+            patient_data = db.patients_data.find_one({'_id': identity['patients_data_id']})
         
         # Prepare dashboard data with defaults
         dashboard_data = {
@@ -1889,9 +1908,9 @@ def get_patient_dashboard_data(patient_id):
         
         dashboard_data['lifestyle_recommendations'] = lifestyle_recommendations
         
-        # Get upcoming appointments for patient
-        from models.user import get_appointments_for_patient
-        upcoming_appointments = get_appointments_for_patient(current_user.username)
+        # Get upcoming appointments for patient (already fetched on the async path)
+        if upcoming_appointments is None:
+            upcoming_appointments = get_appointments_for_patient(current_user.username)
         
         # DEBUG LOGGING
         with open('debug_log.txt', 'a') as f:
@@ -2049,16 +2068,17 @@ def create_appointment_route():
 @app.route('/messages')
 @login_required
 def messages():
-    from models.user import Message, get_all_patients
+    from models.user import Message, get_patient_usernames_page
     contacts = Message.get_conversations(current_user.username)
-    # Add all patients as contacts for doctors
+    next_cursor = None
+    # Add one page of patients as contacts for doctors
     if current_user.is_doctor():
-        patients = get_all_patients()
-        for p in patients:
-            if p.username not in contacts:
-                contacts.append(p.username)
+        patients, next_cursor = get_patient_usernames_page(request.args.get('cursor'), PAGE_SIZE_DEFAULT)
+        for username in patients:
+            if username not in contacts:
+                contacts.append(username)
     
-    return render_template('messages.html', contacts=contacts)
+    return render_template('messages.html', contacts=contacts, next_cursor=next_cursor)
 
 @app.route('/get_messages/<username>')
 @login_required
@@ -2087,35 +2107,30 @@ def send_message():
 
 # Phase 3: Clinical Tools Routes
 
+PRESCRIPTIONS_PER_PAGE = 20
+
 @app.route('/prescriptions')
 @login_required
 def prescriptions():
     if not current_user.is_doctor():
         return redirect(url_for('index'))
     
-    prescriptions_list = get_prescriptions_for_doctor(current_user.username)
+    from models.user import get_prescriptions_page, get_prescription_patients
     
-    # Get unique patients for filter dropdown
-    unique_patients = list(set([p.get('patient') for p in prescriptions_list if p.get('patient')]))
-    unique_patients.sort()
+    # Get unique patients for filter dropdown (distinct on the server)
+    unique_patients = get_prescription_patients(current_user.username)
 
-    # Filter by patient if specified
+    # Filter by patient if specified, one page at a time (newest first)
     patient_filter = request.args.get('patient')
-    if patient_filter:
-        # Keep original list for unique_patients, filter a copy or filter the result for display
-        # We need unique_patients from the FULL list, so we do this before filtering prescriptions_list
-        # But wait, if we filter prescriptions_list above, we lose the other patients? 
-        # No, 'prescriptions_list' holds all prescriptions initially.
-        
-        # We need to filter 'display_prescriptions' separately
-        display_prescriptions = [p for p in prescriptions_list if p.get('patient') == patient_filter]
-    else:
-        display_prescriptions = prescriptions_list
+    display_prescriptions, next_cursor = get_prescriptions_page(
+        current_user.username, patient_filter, request.args.get('cursor'), PRESCRIPTIONS_PER_PAGE
+    )
         
     return render_template('prescriptions.html', 
                          prescriptions=display_prescriptions, 
                          patient_filter=patient_filter,
-                         unique_patients=unique_patients)
+                         unique_patients=unique_patients,
+                         next_cursor=next_cursor)
 
 @app.route('/create_prescription', methods=['POST'])
 @login_required
@@ -2471,14 +2486,12 @@ def upload_lab_report_pdf():
             results_dir = 'static/predictions'
             prediction = kidney_stone_model.predict(filepath, save_dir=results_dir)
             
-            # Save disease status
-            from models.user import update_disease_status, update_patient_lab_values
-            update_disease_status(current_user.username, 'kidney_stone', prediction)
-            
-            # Also add to history as a lab report
-            # Images don't have standard lab values, so we pass empty dict or minimal info
+            # Save disease status and add to history as a lab report in one write path
+            # Images don't have standard lab values, so we pass an empty dict
             # We use a distinct test_type
-            update_patient_lab_values(current_user.username, {}, prediction, filepath, test_type='Kidney Stone Scan')
+            from models.user import ingest_lab_upload
+            ingest_lab_upload(current_user.username, {}, prediction, filepath,
+                              test_type='Kidney Stone Scan', disease_type='kidney_stone')
             
             return jsonify({
                 'success': True,
@@ -2546,13 +2559,12 @@ def upload_lab_report_pdf():
         else:
             return jsonify({'error': 'Invalid disease type'}), 400
             
-        # Update patient records with new data
-        from models.user import update_patient_lab_values, update_disease_status
+        # Update patient records, disease status and lab results in one write path
+        from models.user import ingest_lab_upload
         test_type_label = f"{disease_type.replace('_', ' ').title()} Analysis"
-        update_patient_lab_values(current_user.username, lab_values, prediction, filepath if not use_defaults else None, test_type=test_type_label)
-        
-        # Save specific disease status for dashboard
-        update_disease_status(current_user.username, disease_type, prediction, lab_values)
+        ingest_lab_upload(current_user.username, lab_values, prediction,
+                          filepath if not use_defaults else None,
+                          test_type=test_type_label, disease_type=disease_type)
         
         return jsonify({
             'success': True,
@@ -3046,7 +3058,7 @@ def patient_trends(username):
     if current_user.username != username and not current_user.is_doctor():
         return jsonify({'error': 'Access denied'}), 403
     
-    patient_data = get_patient_records(username)
+    patient_data = get_patient_records(username, projection=PATIENT_TRENDS_FIELDS)
     
     if not patient_data or 'history' not in patient_data:
         return jsonify({'error': 'No data available'}), 404
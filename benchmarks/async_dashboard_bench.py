@@ -0,0 +1,72 @@
+"""
+Benchmark: patient dashboard data loading, sequential pymongo vs concurrent Motor
+
+Usage:
+    python benchmarks/async_dashboard_bench.py <username> [iterations]
+"""
+
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.database import Database
+from models import user as sync_db
+from models import async_db
+
+
+def sync_load(username, patient_id):
+    return (
+        sync_db.get_patient_records(username),
+        sync_db.get_patient_data(patient_id),
+        sync_db.get_patient_trials(username),
+        sync_db.get_appointments_for_patient(username)
+    )
+
+
+def async_load(username, patient_id):
+    return async_db.gather(
+        async_db.get_patient_records(username),
+        async_db.get_patient_data(patient_id),
+        async_db.get_patient_trials(username),
+        async_db.get_appointments_for_patient(username)
+    )
+
+
+def time_it(fn, iterations, *args):
+    fn(*args)  # warm up connections
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'mean_ms': statistics.mean(samples),
+        'p50_ms': samples[len(samples) // 2],
+        'p95_ms': samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    username = sys.argv[1]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    if Database.get_db() is None:
+        print("MongoDB is not reachable; nothing to benchmark.")
+        sys.exit(1)
+    user = sync_db.User.get_by_username(username)
+    patient_id = f"P{user.id}" if user else username
+
+    for name, fn in (('sync (sequential)', sync_load), ('async (gather)', async_load)):
+        stats = time_it(fn, iterations, username, patient_id)
+        print(f"{name:20s} mean {stats['mean_ms']:7.2f} ms  p50 {stats['p50_ms']:7.2f} ms  p95 {stats['p95_ms']:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark: per-message chatbot setup cost, new chatbot per request vs the process-wide one
+
+Usage:
+    python benchmarks/chatbot_overhead_bench.py [iterations]
+
+"per request" builds a PatientEducationChatbot for every call, as /chatbot/welcome and
+/chatbot/message used to (Gemini configure + model, RAG engine lookup, Chroma count).
+"shared" goes through get_patient_chatbot(). Generation itself is not timed, so no
+Gemini calls are made; GEMINI_API_KEY must still be set for the recommender to build.
+"""
+
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.patient_chatbot import PatientEducationChatbot, get_patient_chatbot
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # The first shared call pays the one-time setup; report it separately
+    start = time.perf_counter()
+    get_patient_chatbot()
+    first_ms = (time.perf_counter() - start) * 1000
+
+    cases = [
+        ('per request', lambda: PatientEducationChatbot().get_welcome_message('Patient')),
+        ('shared', lambda: get_patient_chatbot().get_welcome_message('Patient')),
+    ]
+    print(f"shared chatbot first call: {first_ms:.1f} ms")
+    print(f"{'mode':12s} {'mean ms':>10s} {'p50 ms':>10s} {'max ms':>10s}")
+    for name, fn in cases:
+        samples = timed(fn, iterations)
+        print(f"{name:12s} {statistics.mean(samples):10.3f} {statistics.median(samples):10.3f} {max(samples):10.3f}")
+
+
+if __name__ == '__main__':
+    main()
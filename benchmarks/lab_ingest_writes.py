@@ -0,0 +1,108 @@
+"""
+Benchmark: MongoDB round trips and bytes per lab upload, old write path vs ingest_lab_upload
+
+Usage:
+    python benchmarks/lab_ingest_writes.py [history_entries] [uploads]
+
+Seeds a throwaway patient with `history_entries` past lab reports (the old path re-read
+the whole record, history included, before every upload), runs `uploads` uploads through
+each path and removes the patient's documents afterwards. Needs a real MongoDB: the
+embedded memory:// and sqlite:/// stores do not go through pymongo command monitoring.
+"""
+
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.database import Database
+from models.db_metrics import measure
+from models.user import ingest_lab_upload
+
+USERNAME = '_bench_lab_ingest'
+LAB_VALUES = {'egfr': 48.0, 'serum_creatinine': 1.6, 'bp_systolic': 138, 'bp_diastolic': 86, 'potassium': 4.9}
+PREDICTION = {'risk_percentage': 62, 'stage': '3a', 'risk_level': 'High', 'egfr': 48.0}
+
+
+def legacy_ingest(db, username, lab_values, prediction, pdf_path=None,
+                  test_type="CKD Analysis", disease_type='ckd'):
+    """The write path before ingest_lab_upload: update_patient_lab_values + update_disease_status"""
+    # update_patient_lab_values: read the whole record to merge current_metrics
+    record = db.patient_records.find_one({'username': username}) or {'username': username, 'history': []}
+    current_metrics = record.get('current_metrics', {})
+    current_metrics.update({k: v for k, v in lab_values.items() if v is not None})
+    if prediction:
+        current_metrics['disease_prediction'] = prediction
+    update_data = {'$set': {'current_metrics': current_metrics}, '$push': {'history': {
+        'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'test_type': test_type,
+        'metrics': lab_values, 'prediction': prediction, 'pdf_path': pdf_path
+    }}}
+    if pdf_path:
+        update_data['$set']['latest_lab_pdf'] = pdf_path
+    db.patient_records.update_one({'username': username}, update_data, upsert=True)
+
+    patient_data_update = {k: v for k, v in lab_values.items() if v is not None}
+    if prediction:
+        patient_data_update.update({
+            'risk_percentage': prediction.get('risk_percentage', 0), 'stage': prediction.get('stage', 'N/A'),
+            'risk_level': prediction.get('risk_level', 'Unknown'), 'egfr': prediction.get('egfr')
+        })
+    db.patients_data.update_one({'username': username}, {'$set': patient_data_update}, upsert=True)
+
+    # update_disease_status: a second patient_records write, then the lab_results copy
+    db.patient_records.update_one({'username': username}, {'$set': {f'disease_status.{disease_type}': {
+        'last_updated': datetime.datetime.now().strftime("%Y-%m-%d %H:%M"), 'prediction': prediction
+    }}}, upsert=True)
+    lab_result_doc = {'patient_username': username, 'test_date': datetime.datetime.now(),
+                      'test_type': 'Lab Report Upload', 'created_at': datetime.datetime.now()}
+    lab_result_doc.update({k: v for k, v in lab_values.items() if v is not None})
+    db.lab_results.insert_one(lab_result_doc)
+
+
+def seed(db, history_entries):
+    cleanup(db)
+    db.patient_records.insert_one({'username': USERNAME, 'history': [
+        {'date': f"2025-01-01 00:00:{i % 60:02d}", 'test_type': 'CKD Analysis',
+         'metrics': LAB_VALUES, 'prediction': PREDICTION, 'pdf_path': None}
+        for i in range(history_entries)
+    ]})
+
+
+def cleanup(db):
+    db.patient_records.delete_many({'username': USERNAME})
+    db.patients_data.delete_many({'username': USERNAME})
+    db.lab_results.delete_many({'patient_username': USERNAME})
+
+
+def main():
+    history_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    uploads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    db = Database.get_db()
+    if db is None:
+        print("MongoDB is not reachable; nothing to measure.")
+        sys.exit(1)
+
+    paths = [
+        ('old path', lambda: legacy_ingest(db, USERNAME, LAB_VALUES, PREDICTION)),
+        ('ingest_lab_upload', lambda: ingest_lab_upload(USERNAME, LAB_VALUES, PREDICTION,
+                                                        test_type="CKD Analysis", disease_type='ckd')),
+    ]
+    print(f"{uploads} uploads, {history_entries} prior history entries")
+    print(f"{'path':18s} {'round trips':>12s} {'reads':>6s} {'reply bytes':>12s} {'time ms':>9s}")
+    try:
+        for name, upload in paths:
+            seed(db, history_entries)
+            with measure(name) as stats:
+                for _ in range(uploads):
+                    upload()
+            reads = stats.by_command.get('find', 0)
+            print(f"{name:18s} {stats.commands:12d} {reads:6d} {stats.bytes:12d} {stats.duration_ms:9.2f}")
+            if not stats.commands:
+                print("  (no commands observed: the embedded local store bypasses command monitoring)")
+    finally:
+        cleanup(db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark: bytes MongoDB returns to the hot routes' helpers, whole documents vs projections
+
+Usage:
+    python benchmarks/projection_bytes.py <patient_username>
+
+The same numbers are collected live per route by models.db_metrics
+(see /admin/metrics/db?by=bytes).
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.database import Database
+from models.db_metrics import measure
+from models.user import get_patient_records, get_all_patients_data
+from models.projections import (
+    PATIENT_NAME_FIELDS, PATIENT_PROFILE_FIELDS, PATIENT_TRENDS_FIELDS, DASHBOARD_STATS_FIELDS
+)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    username = sys.argv[1]
+    if Database.get_db() is None:
+        print("MongoDB is not reachable; nothing to measure.")
+        sys.exit(1)
+
+    cases = [
+        ('chatbot_welcome', lambda p: get_patient_records(username, projection=p), PATIENT_NAME_FIELDS),
+        ('chatbot_message', lambda p: get_patient_records(username, projection=p), PATIENT_PROFILE_FIELDS),
+        ('patient_trends', lambda p: get_patient_records(username, projection=p), PATIENT_TRENDS_FIELDS),
+        ('dashboard stats', lambda p: get_all_patients_data(projection=p), DASHBOARD_STATS_FIELDS),
+    ]
+    print(f"{'route':18s} {'full bytes':>12s} {'projected':>12s} {'saved':>7s}")
+    for name, fetch, projection in cases:
+        with measure(name) as full:
+            fetch(None)
+        with measure(name) as projected:
+            fetch(projection)
+        saved = 100 * (1 - projected.bytes / full.bytes) if full.bytes else 0
+        print(f"{name:18s} {full.bytes:12d} {projected.bytes:12d} {saved:6.1f}%")
+
+
+if __name__ == '__main__':
+    main()
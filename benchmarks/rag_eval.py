@@ -0,0 +1,158 @@
+"""
+Offline retrieval evaluation for the RAG engine
+
+Usage:
+    python benchmarks/rag_eval.py [--chunk-sizes 500,1000] [--overlaps 100,200]
+                                  [--backends chroma,numpy] [--modes hybrid,vector]
+                                  [--k 1,3,5] [--output report.json]
+
+For every chunking config x backend, ingests data/medical_knowledge into a scratch
+index, then for every retrieval mode runs the questions in data/rag_eval/questions.json
+and measures recall@k, MRR, query embedding latency (model only, uncached) and search
+latency (query embedding cached, so retrieval and fusion only). Writes a JSON report.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.rag_engine import RAGEngine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_QUESTIONS = os.path.join(ROOT, "data", "rag_eval", "questions.json")
+DEFAULT_KNOWLEDGE_DIR = os.path.join(ROOT, "data", "medical_knowledge")
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def _latency(samples):
+    samples = sorted(samples)
+    return {
+        "mean": round(statistics.mean(samples), 3),
+        "p50": round(statistics.median(samples), 3),
+        "p95": round(samples[max(int(len(samples) * 0.95) - 1, 0)], 3)
+    }
+
+
+def first_relevant_rank(chunks, expected):
+    """1-based rank of the first chunk containing an expected passage, or None"""
+    passages = [_normalize(p) for p in expected]
+    for rank, chunk in enumerate(chunks, start=1):
+        text = _normalize(chunk)
+        if any(p in text for p in passages):
+            return rank
+    return None
+
+
+def evaluate(engine, questions, ks, mode):
+    engine.retrieval_mode = mode
+    max_k = max(ks)
+    ranks, embed_ms, search_ms, details = [], [], [], []
+    for q in questions:
+        # Model latency, bypassing the query cache
+        start = time.perf_counter()
+        engine.embeddings.embeddings.embed_query(q["question"])
+        embed_ms.append((time.perf_counter() - start) * 1000)
+
+        engine.search(q["question"], k=max_k)  # warm the query cache
+        start = time.perf_counter()
+        chunks = engine.search(q["question"], k=max_k)
+        search_ms.append((time.perf_counter() - start) * 1000)
+
+        rank = first_relevant_rank(chunks, q["expected"])
+        ranks.append(rank)
+        details.append({"id": q["id"], "rank": rank})
+
+    n = len(questions)
+    result = {f"recall@{k}": round(sum(1 for r in ranks if r and r <= k) / n, 4) for k in ks}
+    result["mrr"] = round(sum(1.0 / r for r in ranks if r) / n, 4)
+    result["embed_ms"] = _latency(embed_ms)
+    result["search_ms"] = _latency(search_ms)
+    result["misses"] = [d["id"] for d in details if d["rank"] is None]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality and latency")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS)
+    parser.add_argument("--knowledge-dir", default=DEFAULT_KNOWLEDGE_DIR)
+    parser.add_argument("--chunk-sizes", type=_int_list, default=[500, 1000])
+    parser.add_argument("--overlaps", type=_int_list, default=[100, 200])
+    parser.add_argument("--backends", default="chroma,numpy")
+    parser.add_argument("--modes", default="hybrid,vector")
+    parser.add_argument("--k", type=_int_list, default=[1, 3, 5])
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout only)")
+    parser.add_argument("--work-dir", help="Where scratch indexes are built (default: a temp dir, removed afterwards)")
+    args = parser.parse_args()
+
+    with open(args.questions) as f:
+        questions = json.load(f)["questions"]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rag_eval_")
+
+    results = []
+    try:
+        for backend in [b for b in args.backends.split(",") if b]:
+            for chunk_size in args.chunk_sizes:
+                for overlap in args.overlaps:
+                    if overlap >= chunk_size:
+                        continue
+                    engine = RAGEngine(
+                        persist_directory=os.path.join(work_dir, f"{backend}-{chunk_size}-{overlap}"),
+                        knowledge_dir=args.knowledge_dir,
+                        backend=backend,
+                        chunk_size=chunk_size,
+                        chunk_overlap=overlap
+                    )
+                    start = time.perf_counter()
+                    engine.ingest_documents()
+                    ingest_seconds = round(time.perf_counter() - start, 2)
+                    for mode in [m for m in args.modes.split(",") if m]:
+                        row = {"backend": backend, "chunk_size": chunk_size, "chunk_overlap": overlap,
+                               "mode": mode, "chunks": engine.vector_store.count(),
+                               "ingest_seconds": ingest_seconds}
+                        row.update(evaluate(engine, questions, args.k, mode))
+                        results.append(row)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "questions": len(questions),
+        "k": args.k,
+        "results": results,
+        "best": max(results, key=lambda r: (r["mrr"], -r["search_ms"]["p50"])) if results else None
+    }
+
+    top_k = max(args.k)
+    print(f"\n{'backend':8s} {'size':>5s} {'ovl':>4s} {'mode':7s} {'chunks':>6s} "
+          f"{'R@' + str(top_k):>6s} {'MRR':>6s} {'embed p50':>10s} {'search p50':>11s}")
+    for r in results:
+        print(f"{r['backend']:8s} {r['chunk_size']:5d} {r['chunk_overlap']:4d} {r['mode']:7s} {r['chunks']:6d} "
+              f"{r[f'recall@{top_k}']:6.3f} {r['mrr']:6.3f} {r['embed_ms']['p50']:9.2f}ms {r['search_ms']['p50']:10.2f}ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+    else:
+        print(json.dumps(report["best"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
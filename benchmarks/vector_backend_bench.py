@@ -0,0 +1,75 @@
+"""
+Benchmark: Chroma vs the memory-mapped NumPy vector backend
+
+Usage:
+    python benchmarks/vector_backend_bench.py [k] [iterations]
+
+Ingests data/medical_knowledge into both backends (incremental, so re-runs are cheap),
+then reports load time, search latency and recall@k. NumPy search is exact, so recall
+is Chroma's (approximate HNSW) top-k measured against the NumPy top-k. Query embeddings
+are warmed first, so latencies compare the index search itself.
+"""
+
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.rag_engine import RAGEngine
+
+QUESTIONS = [
+    "What is eGFR?",
+    "What does stage 3a CKD mean?",
+    "Can I eat bananas with high potassium?",
+    "What foods are high in phosphorus?",
+    "Why am I always tired with kidney disease?",
+    "When do I need dialysis?",
+    "How much water should I drink?",
+    "Is ibuprofen safe for my kidneys?",
+    "What does creatinine measure?",
+    "How can I lower my blood pressure?",
+    "What is a kidney transplant?",
+    "Why are my ankles swollen?",
+]
+
+
+def main():
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    engines = {}
+    for backend in ("chroma", "numpy"):
+        RAGEngine(backend=backend).ingest_documents()
+        # Fresh engine, so the load time is that of an already-built index
+        start = time.perf_counter()
+        engines[backend] = RAGEngine(backend=backend)
+        load_ms = (time.perf_counter() - start) * 1000
+        print(f"{backend:7s} load {load_ms:8.1f} ms  ({engines[backend].vector_store.count()} chunks)")
+
+    results = {}
+    print(f"\n{'backend':8s} {'mean ms':>10s} {'p50 ms':>10s} {'p95 ms':>10s}")
+    for backend, engine in engines.items():
+        store = engine.vector_store
+        for question in QUESTIONS:
+            results.setdefault(backend, {})[question] = store.search(question, k=k)
+        samples = []
+        for _ in range(iterations):
+            for question in QUESTIONS:
+                start = time.perf_counter()
+                store.search(question, k=k)
+                samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        print(f"{backend:8s} {statistics.mean(samples):10.3f} {statistics.median(samples):10.3f} {p95:10.3f}")
+
+    recalls = [
+        len(set(results["chroma"][q]) & set(results["numpy"][q])) / max(len(results["numpy"][q]), 1)
+        for q in QUESTIONS
+    ]
+    print(f"\nChroma recall@{k} vs exact NumPy search: {statistics.mean(recalls):.3f}")
+
+
+if __name__ == '__main__':
+    main()
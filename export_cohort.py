@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Cohort Export CLI for CKD Diagnostic System
+Streams patient lab histories and predictions to a file (or stdout) in constant memory
+
+Examples:
+    python export_cohort.py --format csv --risk-level High -o high_risk.csv
+    python export_cohort.py --format parquet --since "2024-01-01" -o cohort.parquet
+    python export_cohort.py --format ndjson --stage 4 > stage4.ndjson
+"""
+
+import sys
+import time
+import argparse
+from models.cohort_export import stream_cohort, parquet_available, EXPORT_FORMATS, EXPORT_BATCH_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a patient cohort's lab history")
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--risk-level', help="Current risk level, e.g. High")
+    parser.add_argument('--stage', help="Current CKD stage, e.g. 3")
+    parser.add_argument('--usernames', help="Comma-separated usernames")
+    parser.add_argument('--since', help="Earliest history date (YYYY-MM-DD[ HH:MM:SS])")
+    parser.add_argument('--until', help="Latest history date, inclusive (YYYY-MM-DD[ HH:MM:SS]; a bare date includes that day)")
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument('-o', '--output', help="Output file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.format == 'parquet' and not parquet_available():
+        parser.error("Parquet export requires pyarrow (pip install pyarrow)")
+
+    chunks = stream_cohort(
+        args.format,
+        batch_size=args.batch_size,
+        risk_level=args.risk_level,
+        stage=args.stage,
+        usernames=args.usernames.split(',') if args.usernames else None,
+        since=args.since,
+        until=args.until
+    )
+    start = time.perf_counter()
+    written = 0
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+    print(f"Exported {written / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,9 @@ import sys
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 from models.database import Database
+from models.user import username_key
 from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure, DuplicateKeyError
 
 def init_collections():
     """Initialize all MongoDB collections with indexes"""
@@ -30,6 +32,11 @@ def init_collections():
     
     db.prescriptions.create_index("patient_id")
     db.prescriptions.create_index("doctor_id")
+    # Keyset pagination: prescriptions list, patient filter and distinct patients
+    db.prescriptions.create_index([("doctor", 1), ("patient", 1), ("date", -1), ("_id", -1)])
+    db.prescriptions.create_index([("doctor", 1), ("date", -1), ("_id", -1)])
+    db.appointments.create_index([("doctor", 1), ("patient", 1)])
+    db.users.create_index([("role", 1), ("username", 1)])
     
     db.lab_results.create_index("patient_id")
     db.lab_results.create_index("test_date")
@@ -37,8 +44,100 @@ def init_collections():
     db.messages.create_index([("sender", 1), ("receiver", 1)])
     db.messages.create_index("timestamp")
     
+    # Normalized (case-insensitive) identity keys, see models.user.username_key
+    ensure_unique_username_key(db)
+    db.appointments.create_index("patient_key")
+    db.appointments.create_index([("doctor_key", 1), ("patient_key", 1)])
+    db.patient_records.create_index("username")
+    db.patient_records.create_index("username_key")
+    # Cohort export filters history entries by date; the incremental analytics
+    # snapshot reads them by when they were written
+    db.patient_records.create_index("history.date")
+    db.patient_records.create_index("history.ingested_at")
+    
+    # AI recommendations: one plan per patient, removed by MongoDB once expires_at passes
+    db.ai_recommendations.create_index("username", unique=True)
+    db.ai_recommendations.create_index("expires_at", expireAfterSeconds=0)
+    
+    # Persisted chatbot conversations (CONVERSATION_PERSIST), expired by MongoDB like AI plans
+    db.chat_conversations.create_index([("username", 1), ("session_id", 1)], unique=True)
+    db.chat_conversations.create_index("expires_at", expireAfterSeconds=0)
+    
     print("✓ Collections and indexes created")
 
+def migrate_ai_recommendations():
+    """Move plans embedded in users documents into the ai_recommendations collection"""
+    print("\nMigrating embedded AI recommendations...")
+    
+    db = Database.get_db()
+    moved = 0
+    for user in db.users.find({'ai_recommendations': {'$exists': True}},
+                              {'username': 1, 'ai_recommendations': 1}):
+        plan = user['ai_recommendations'] or {}
+        if plan.get('expires_at') and plan['expires_at'] > datetime.utcnow():
+            db.ai_recommendations.update_one(
+                {'username': user['username']},
+                {'$setOnInsert': {
+                    'generated_at': plan.get('generated_at'),
+                    'expires_at': plan['expires_at'],
+                    'data': plan.get('data')
+                }},
+                upsert=True
+            )
+            moved += 1
+        db.users.update_one({'_id': user['_id']}, {'$unset': {'ai_recommendations': ''}})
+    
+    print(f"✓ Moved {moved} unexpired plans; embedded copies removed")
+
+def ensure_unique_username_key(db):
+    """
+    One account per case-insensitive username. Users not yet backfilled have no key and
+    are left out of the index; while case collisions remain it stays a plain index.
+    """
+    existing = db.users.index_information().get('username_key_1')
+    if existing and existing.get('unique'):
+        return
+    if existing:
+        db.users.drop_index('username_key_1')
+    try:
+        db.users.create_index("username_key", unique=True,
+                              partialFilterExpression={'username_key': {'$exists': True}})
+    except OperationFailure as e:
+        print(f"  ! users.username_key is not unique yet ({e}); resolve the case collisions "
+              "reported by 'init_database.py --migrate' and run it again")
+        db.users.create_index("username_key")
+
+def migrate_username_keys():
+    """Backfill normalized username keys so identity lookups are indexed equality matches"""
+    print("\nBackfilling normalized username keys...")
+    
+    db = Database.get_db()
+    for collection, field in (('users', 'username'), ('patient_records', 'username'),
+                              ('appointments', 'patient'), ('appointments', 'doctor')):
+        key_field = 'username_key' if field == 'username' else f'{field}_key'
+        updated = 0
+        for doc in db[collection].find({key_field: {'$exists': False}, field: {'$type': 'string'}},
+                                       {field: 1}):
+            try:
+                db[collection].update_one({'_id': doc['_id']}, {'$set': {key_field: username_key(doc[field])}})
+                updated += 1
+            except DuplicateKeyError:
+                # Another account already holds this key under the unique index
+                print(f"  ! {collection}.{key_field}: '{doc[field]}' differs only in case from an existing account")
+        print(f"  - {collection}.{key_field}: {updated} documents")
+    
+    # Accounts whose names differ only in case now share a key; report them for manual review
+    collisions = db.users.aggregate([
+        {'$match': {'username_key': {'$type': 'string'}}},
+        {'$group': {'_id': '$username_key', 'usernames': {'$push': '$username'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ])
+    for group in collisions:
+        print(f"  ! Usernames differing only in case: {', '.join(group['usernames'])}")
+    ensure_unique_username_key(db)
+    
+    print("✓ Username keys backfilled")
+
 def create_sample_users():
     """Create sample doctors and patients"""
     print("\nCreating sample users...")
@@ -513,6 +612,11 @@ def create_sample_education():
         db.education.insert_one(edu)
         print(f"  ✓ Created education resource: {edu['title']}")
 
+def run_migrations():
+    """One-off data migrations; each is idempotent"""
+    migrate_ai_recommendations()
+    migrate_username_keys()
+
 def main():
     """Main initialization function"""
     print("=" * 60)
@@ -526,6 +630,11 @@ def main():
         # Create collections and indexes
         init_collections()
         
+        if '--migrate' in sys.argv:
+            # Indexes and data migrations only, no sample data
+            run_migrations()
+            return
+        
         # Populate sample data
         create_sample_users()
         create_sample_patients_data()
@@ -533,6 +642,7 @@ def main():
         create_sample_prescriptions()
         create_sample_lab_results()
         create_sample_education()
+        run_migrations()
         
         print("\n" + "=" * 60)
         print("✓ Database initialization completed successfully!")
@@ -0,0 +1,414 @@
+"""
+Columnar Analytics Snapshot for CKD Diagnostic System
+Flattens patient_records.history and lab_results into Arrow IPC files on disk, appending
+only the rows added since the previous run. Reads memory-map those files, so trend and
+cohort questions are answered from the snapshot without touching the OLTP collections.
+
+    python -m models.analytics_snapshot            # incremental refresh
+    python -m models.analytics_snapshot --rebuild  # rebuild from scratch
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from bson.objectid import ObjectId
+from models.database import Database
+from models.lab_rows import METRIC_COLUMNS, flatten_history_entry, to_float
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+SNAPSHOT_DIR = os.environ.get('ANALYTICS_SNAPSHOT_DIR', os.path.join('data', 'analytics_snapshot'))
+# Seconds between background refreshes; 0 leaves refreshing to the CLI
+SNAPSHOT_INTERVAL = int(os.environ.get('ANALYTICS_SNAPSHOT_INTERVAL', 0))
+# Parts are merged into one file once there are more than this many
+SNAPSHOT_MAX_PARTS = int(os.environ.get('ANALYTICS_SNAPSHOT_MAX_PARTS', 32))
+SNAPSHOT_BATCH_SIZE = 5000
+# Rows stamped within this many seconds of "now" wait for the next run, so writes
+# landing in the same second as the cutoff are never skipped
+SETTLE_SECONDS = 2
+LOCK_STALE_SECONDS = 3600
+# Bumped when the rows extracted change; an older snapshot is rebuilt on the next refresh
+SNAPSHOT_FORMAT = 3
+
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'refresh.lock'
+HISTORY_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Sample/legacy lab_results keep values under 'results' with display names
+LAB_RESULT_KEYS = {
+    'eGFR': 'egfr', 'Creatinine': 'serum_creatinine', 'BUN': 'blood_urea',
+    'Hemoglobin': 'hemoglobin', 'Potassium': 'potassium', 'Sodium': 'sodium'
+}
+# lab_results written by a patient upload mirror the history entry written with them,
+# so each upload is taken from history only
+LAB_UPLOAD_TEST_TYPE = 'Lab Report Upload'
+
+_cache_lock = threading.Lock()
+_cache = {'version': None, 'table': None}
+_refresh_thread = None
+
+
+def snapshot_available():
+    return pa is not None
+
+
+def _schema():
+    fields = [
+        pa.field('username', pa.string()),
+        pa.field('source', pa.string()),
+        pa.field('date', pa.timestamp('s')),
+        pa.field('test_type', pa.string())
+    ]
+    fields += [pa.field(c, pa.float64()) for c in METRIC_COLUMNS]
+    fields += [pa.field('risk_level', pa.string()), pa.field('risk_percentage', pa.float64()),
+               pa.field('stage', pa.string())]
+    return pa.schema(fields)
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None, microsecond=0)
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None, microsecond=0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _path(name):
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+# --- Manifest and lock ---
+
+def _read_manifest():
+    try:
+        with open(_path(MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'cutoff': 0, 'parts': [], 'rows': 0}
+
+
+def _write_manifest(manifest):
+    # Written to a temp file and swapped in, so readers never see half a manifest
+    tmp = _path(MANIFEST_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, _path(MANIFEST_FILE))
+
+
+def _acquire_lock():
+    """One refresh at a time across processes; a lock older than an hour is assumed dead"""
+    path = _path(LOCK_FILE)
+    try:
+        if time.time() - os.path.getmtime(path) > LOCK_STALE_SECONDS:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+
+def _release_lock():
+    try:
+        os.remove(_path(LOCK_FILE))
+    except OSError:
+        pass
+
+
+# --- Extraction ---
+
+def _history_rows(db, since, cutoff):
+    """
+    History entries added in [since, cutoff), by their ingested_at stamp, so an entry
+    appended late with an older lab date is still picked up. Entries written before the
+    stamp existed fall back to their date.
+    """
+    ingested = {'$gte': datetime.utcfromtimestamp(since), '$lt': datetime.utcfromtimestamp(cutoff)}
+    dated = {
+        '$gte': datetime.fromtimestamp(since).strftime(HISTORY_DATE_FORMAT),
+        '$lt': datetime.fromtimestamp(cutoff).strftime(HISTORY_DATE_FORMAT)
+    }
+    new_entry = {'$or': [{'ingested_at': ingested}, {'ingested_at': {'$exists': False}, 'date': dated}]}
+    pipeline = [
+        {'$match': {'history': {'$elemMatch': new_entry}}},
+        {'$project': {'_id': 0, 'username': 1, 'history': 1}},
+        {'$unwind': '$history'},
+        {'$match': {'$or': [{'history.' + k: v for k, v in clause.items()} for clause in new_entry['$or']]}}
+    ]
+    for doc in db.patient_records.aggregate(pipeline, allowDiskUse=True, batchSize=SNAPSHOT_BATCH_SIZE):
+        row = flatten_history_entry(doc)
+        row['source'] = 'history'
+        row['date'] = _parse_date(row['date'])
+        yield row
+
+
+def _lab_result_row(doc):
+    row = {
+        'username': doc.get('patient_username') or doc.get('patient_id'),
+        'source': 'lab_results',
+        'date': _parse_date(doc.get('test_date')),
+        'test_type': doc.get('test_type'),
+        'risk_level': None,
+        'risk_percentage': None,
+        'stage': None
+    }
+    values = {LAB_RESULT_KEYS.get(k, k): v for k, v in (doc.get('results') or {}).items()}
+    for column in METRIC_COLUMNS:
+        row[column] = to_float(doc.get(column, values.get(column)))
+    return row
+
+
+def _lab_result_rows(db, since, cutoff):
+    """lab_results inserted in [since, cutoff), by the timestamp in their ObjectId, minus upload mirrors"""
+    id_range = {
+        '$gte': ObjectId.from_datetime(datetime.fromtimestamp(since, timezone.utc)),
+        '$lt': ObjectId.from_datetime(datetime.fromtimestamp(cutoff, timezone.utc))
+    }
+    query = {'_id': id_range, 'test_type': {'$ne': LAB_UPLOAD_TEST_TYPE}}
+    for doc in db.lab_results.find(query, batch_size=SNAPSHOT_BATCH_SIZE):
+        yield _lab_result_row(doc)
+
+
+def _write_part(name, rows):
+    """Write rows to an Arrow IPC file in record batches; returns the row count"""
+    schema = _schema()
+    tmp = _path(name + '.tmp')
+    count = 0
+    with pa.OSFile(tmp, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                    writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                count += len(batch)
+    if count:
+        os.replace(tmp, _path(name))
+    else:
+        os.remove(tmp)
+    return count
+
+
+def _remove_parts(names):
+    for name in names:
+        try:
+            os.remove(_path(name))
+        except OSError:
+            # Still memory-mapped by a reader on Windows; the next compaction retries
+            pass
+
+
+def _compact(manifest):
+    """Merge every part into one file once the part count passes SNAPSHOT_MAX_PARTS"""
+    old_parts = manifest['parts']
+    name = f"compact-{manifest['cutoff']}.arrow"
+    table = _read_parts(old_parts)
+    rows = _write_part(name, (row for batch in table.to_batches() for row in batch.to_pylist()))
+    manifest['parts'] = [name] if rows else []
+    _write_manifest(manifest)
+    _remove_parts(p for p in old_parts if p != name)
+
+
+def refresh_snapshot(rebuild=False):
+    """Append rows added since the last run to the snapshot; returns the number of new rows"""
+    if pa is None:
+        raise RuntimeError("Analytics snapshot requires pyarrow")
+    db = Database.get_db()
+    if db is None:
+        return 0
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    if not _acquire_lock():
+        print("Analytics snapshot refresh already running; skipped")
+        return 0
+    try:
+        start = time.perf_counter()
+        manifest = _read_manifest()
+        old_parts = list(manifest['parts'])
+        rebuild = rebuild or manifest.get('format') != SNAPSHOT_FORMAT
+        since = 0 if rebuild else manifest['cutoff']
+        cutoff = int(time.time()) - SETTLE_SECONDS
+        if cutoff <= since:
+            return 0
+
+        def new_rows():
+            yield from _history_rows(db, since, cutoff)
+            yield from _lab_result_rows(db, since, cutoff)
+
+        name = f"part-{cutoff}.arrow"
+        rows = _write_part(name, new_rows())
+
+        if rebuild:
+            manifest = {'format': SNAPSHOT_FORMAT, 'cutoff': cutoff, 'parts': [name] if rows else [], 'rows': rows}
+        else:
+            manifest['cutoff'] = cutoff
+            manifest['rows'] += rows
+            if rows:
+                manifest['parts'].append(name)
+        manifest['updated_at'] = datetime.now().isoformat()
+        _write_manifest(manifest)
+
+        if rebuild:
+            _remove_parts(p for p in old_parts if p != name)
+        elif len(manifest['parts']) > SNAPSHOT_MAX_PARTS:
+            _compact(manifest)
+
+        print(f"Analytics snapshot: {rows} new rows in {time.perf_counter() - start:.2f}s "
+              f"({manifest['rows']} total, {len(manifest['parts'])} parts)")
+        return rows
+    finally:
+        _release_lock()
+
+
+def start_background_refresh(interval=SNAPSHOT_INTERVAL):
+    """Refresh the snapshot every `interval` seconds on a daemon thread (no-op when 0)"""
+    global _refresh_thread
+    if interval <= 0 or pa is None or (_refresh_thread and _refresh_thread.is_alive()):
+        return _refresh_thread
+
+    def loop():
+        while True:
+            try:
+                refresh_snapshot()
+            except Exception as e:
+                print(f"Error refreshing analytics snapshot: {e}")
+            time.sleep(interval)
+
+    _refresh_thread = threading.Thread(target=loop, name='analytics-snapshot', daemon=True)
+    _refresh_thread.start()
+    return _refresh_thread
+
+
+# --- Reading ---
+
+def _read_parts(parts):
+    tables = []
+    for name in parts:
+        # Memory-mapped: columns are paged in by the OS instead of copied onto the heap
+        with pa.memory_map(_path(name), 'r') as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    if not tables:
+        return _schema().empty_table()
+    return pa.concat_tables(tables)
+
+
+def load_table(columns=None, since=None, until=None, source=None):
+    """The snapshot as a pyarrow Table, optionally narrowed to columns, a date range and a source"""
+    if pa is None:
+        raise RuntimeError("Analytics snapshot requires pyarrow")
+    manifest = _read_manifest()
+    version = (manifest['cutoff'], tuple(manifest['parts']))
+    with _cache_lock:
+        if _cache['version'] != version:
+            _cache['table'] = _read_parts(manifest['parts'])
+            _cache['version'] = version
+        table = _cache['table']
+
+    mask = None
+    for condition in (
+        pc.greater_equal(table['date'], pa.scalar(_parse_date(since), pa.timestamp('s'))) if since else None,
+        pc.less_equal(table['date'], pa.scalar(_parse_date(until), pa.timestamp('s'))) if until else None,
+        pc.equal(table['source'], source) if source else None
+    ):
+        if condition is not None:
+            mask = condition if mask is None else pc.and_(mask, condition)
+    if mask is not None:
+        table = table.filter(mask)
+    return table.select(columns) if columns else table
+
+
+def snapshot_info():
+    manifest = _read_manifest()
+    return {
+        'rows': manifest['rows'],
+        'parts': len(manifest['parts']),
+        'cutoff': datetime.fromtimestamp(manifest['cutoff']).isoformat() if manifest['cutoff'] else None,
+        'updated_at': manifest.get('updated_at')
+    }
+
+
+def metric_summary(metric='egfr', by='stage', since=None, until=None):
+    """count/mean/min/max of a lab metric grouped by a column (stage, risk_level, test_type, ...)"""
+    if metric not in METRIC_COLUMNS:
+        raise ValueError(f"Unknown metric: {metric}")
+    table = load_table([by, metric], since=since, until=until)
+    table = table.filter(pc.is_valid(table[metric]))
+    grouped = table.group_by(by).aggregate([
+        (metric, 'count'), (metric, 'mean'), (metric, 'min'), (metric, 'max')
+    ])
+    rows = [{
+        by: row[by],
+        'count': row[f'{metric}_count'],
+        'mean': round(row[f'{metric}_mean'], 2),
+        'min': row[f'{metric}_min'],
+        'max': row[f'{metric}_max']
+    } for row in grouped.to_pylist()]
+    return sorted(rows, key=lambda r: (r[by] is None, str(r[by])))
+
+
+def egfr_decline_by_stage(years=2, min_span_days=90):
+    """
+    Average eGFR decline per patient over the last `years`, grouped by latest stage.
+    Decline is first minus last reading in the window, also annualised over the
+    span between them; patients with readings less than min_span_days apart are skipped.
+    """
+    since = datetime.now() - timedelta(days=365.25 * years)
+    table = load_table(['username', 'date', 'egfr', 'stage'], since=since)
+    table = table.filter(pc.and_(pc.is_valid(table['egfr']), pc.is_valid(table['date'])))
+    table = table.sort_by([('username', 'ascending'), ('date', 'ascending')])
+    # Ordered aggregations ('first'/'last') need a single-threaded group_by
+    per_patient = table.group_by('username', use_threads=False).aggregate([
+        ('egfr', 'first'), ('egfr', 'last'), ('date', 'min'), ('date', 'max'), ('stage', 'last')
+    ])
+
+    stages = {}
+    for row in per_patient.to_pylist():
+        span_days = (row['date_max'] - row['date_min']).days
+        if span_days < min_span_days:
+            continue
+        decline = row['egfr_first'] - row['egfr_last']
+        totals = stages.setdefault(row['stage_last'] or 'Unknown', {'patients': 0, 'decline': 0.0, 'annual': 0.0})
+        totals['patients'] += 1
+        totals['decline'] += decline
+        totals['annual'] += decline / (span_days / 365.25)
+
+    return [{
+        'stage': stage,
+        'patients': t['patients'],
+        'avg_egfr_decline': round(t['decline'] / t['patients'], 2),
+        'avg_annual_egfr_decline': round(t['annual'] / t['patients'], 2)
+    } for stage, t in sorted(stages.items())]
+
+
+def patient_trend(username, metric='egfr'):
+    """(date, value) readings of one metric for one patient, oldest first"""
+    if metric not in METRIC_COLUMNS:
+        raise ValueError(f"Unknown metric: {metric}")
+    table = load_table(['username', 'date', metric])
+    table = table.filter(pc.and_(pc.equal(table['username'], username), pc.is_valid(table[metric])))
+    table = table.sort_by('date')
+    return [{'date': row['date'].isoformat() if row['date'] else None, metric: row[metric]}
+            for row in table.to_pylist()]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Refresh the columnar analytics snapshot")
+    parser.add_argument('--rebuild', action='store_true', help="Discard the snapshot and rebuild it")
+    args = parser.parse_args()
+    refresh_snapshot(rebuild=args.rebuild)
+    print(json.dumps(snapshot_info(), indent=2))
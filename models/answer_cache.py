@@ -0,0 +1,175 @@
+"""
+Semantic Answer Cache for KidneyCompanion
+Reuses a generated answer when a new question's embedding is close enough to one already
+answered for a patient in the same coarse clinical bucket (stage, eGFR band, potassium
+band, age range, reported symptoms), so common questions skip the Gemini round trip.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Cosine similarity a cached question needs to count as the same question
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.92))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 24 * 3600))
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 2000))
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _age_range(age):
+    # Same bands as CKDAIRecommender.anonymize_patient_data
+    if age is None:
+        return 'unknown'
+    if age < 30:
+        return 'under 30'
+    if age < 50:
+        return '30-50'
+    if age < 65:
+        return '50-65'
+    return 'over 65'
+
+
+def _egfr_band(egfr):
+    # KDIGO GFR categories
+    if egfr is None:
+        return 'unknown'
+    for floor, band in ((90, 'G1'), (60, 'G2'), (45, 'G3a'), (30, 'G3b'), (15, 'G4')):
+        if egfr >= floor:
+            return band
+    return 'G5'
+
+
+def _potassium_band(potassium):
+    if potassium is None:
+        return 'unknown'
+    if potassium < 3.5:
+        return 'low'
+    if potassium <= 5.0:
+        return 'normal'
+    if potassium <= 5.5:
+        return 'high'
+    return 'very high'
+
+
+def patient_signature(patient_data):
+    """Coarse, PII-free clinical bucket; answers are only shared within one bucket"""
+    p = patient_data or {}
+    symptoms = p.get('symptoms') or {}
+    reported = sorted(k for k, v in symptoms.items() if v) if isinstance(symptoms, dict) else []
+    return (
+        str(p.get('stage', 'unknown')),
+        _egfr_band(_to_float(p.get('egfr'))),
+        _potassium_band(_to_float(p.get('potassium'))),
+        _age_range(_to_float(p.get('age'))),
+        ','.join(reported)
+    )
+
+
+class _Entry:
+    __slots__ = ('vector', 'signature', 'answer', 'created_at')
+
+    def __init__(self, vector, signature, answer):
+        self.vector = vector
+        self.signature = signature
+        self.answer = answer
+        self.created_at = time.monotonic()
+
+
+class SemanticAnswerCache:
+    """Thread-safe answer cache: per-signature buckets, LRU size cap, TTL"""
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_size=ANSWER_CACHE_SIZE, enabled=ANSWER_CACHE_ENABLED):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # id -> _Entry, least recently used first
+        self._buckets = {}  # signature -> [id, ...]
+        self._next_id = 0
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evictions': 0}
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove_locked(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets[entry.signature]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self._buckets[entry.signature]
+
+    def lookup(self, query_vector, signature):
+        """Cached answer for the closest question in the bucket above the threshold, else None"""
+        query = self._normalize(query_vector)
+        now = time.monotonic()
+        with self._lock:
+            ids = []
+            for entry_id in list(self._buckets.get(signature, ())):
+                if now - self._entries[entry_id].created_at > self.ttl_seconds:
+                    self._remove_locked(entry_id)
+                    self._stats['expired'] += 1
+                else:
+                    ids.append(entry_id)
+            if ids:
+                scores = np.stack([self._entries[i].vector for i in ids]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self._stats['hits'] += 1
+                    return self._entries[ids[best]].answer
+            self._stats['misses'] += 1
+            return None
+
+    def store(self, query_vector, signature, answer):
+        entry = _Entry(self._normalize(query_vector), signature, answer)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = entry
+            self._buckets.setdefault(signature, []).append(entry_id)
+            self._stats['stores'] += 1
+            while len(self._entries) > self.max_size:
+                self._remove_locked(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['buckets'] = len(self._buckets)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+
+# Singleton instance
+_cache_instance = None
+_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    """Factory function to get or create the process-wide answer cache"""
+    global _cache_instance
+    if _cache_instance is None:
+        with _cache_lock:
+            if _cache_instance is None:
+                _cache_instance = SemanticAnswerCache()
+    return _cache_instance
@@ -0,0 +1,209 @@
+"""
+Async Data Access for CKD Diagnostic System
+Motor (asyncio MongoDB driver) mirrors of the models.user helpers. Coroutines run on
+one background event loop per process, so views can fan out independent queries
+with gather() instead of issuing them one after another.
+"""
+
+import os
+import asyncio
+import threading
+import contextvars
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from models.database import Database, _client_options
+from models.db_metrics import async_pool_listener
+from models.user import User, username_query
+
+ASYNC_DB_ENABLED = os.environ.get('ASYNC_DB_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ASYNC_DB_TIMEOUT = float(os.environ.get('ASYNC_DB_TIMEOUT', 10))
+
+
+class _AsyncDatabase:
+    """Background event loop thread plus the Motor client bound to it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.loop = None
+        self.client = None
+        self.db = None
+
+    def _start(self):
+        mongo_uri = os.environ.get('MONGO_URI') or "mongodb://localhost:27017/vois_ckd"
+        db_name = mongo_uri.split('/')[-1].split('?')[0] or 'vois_ckd'
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name='async-db-loop', daemon=True).start()
+
+        async def connect():
+            return AsyncIOMotorClient(mongo_uri, **_client_options(pool_events=async_pool_listener))
+
+        self.client = asyncio.run_coroutine_threadsafe(connect(), loop).result()
+        self.db = self.client[db_name]
+        self.loop = loop
+        self._pid = os.getpid()
+
+    def ensure_started(self):
+        # A forked worker cannot use the parent's loop thread or sockets
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+        return self.db
+
+
+_async_db = _AsyncDatabase()
+
+
+def enabled():
+    """Use the async path only when configured and the sync breaker says MongoDB is up"""
+    return ASYNC_DB_ENABLED and Database.get_db() is not None and not Database.is_local()
+
+
+def run(coro, timeout=ASYNC_DB_TIMEOUT):
+    """Run a coroutine on the background loop and block for its result (for sync views)"""
+    _async_db.ensure_started()
+    # The loop thread has its own context; carry the caller's over (e.g. the request's
+    # db_metrics stats) so commands issued by the coroutine are charged to the request
+    caller_context = contextvars.copy_context()
+
+    async def _in_caller_context():
+        for var, value in caller_context.items():
+            var.set(value)
+        return await coro
+    return asyncio.run_coroutine_threadsafe(_in_caller_context(), _async_db.loop).result(timeout)
+
+
+def gather(*coros, timeout=ASYNC_DB_TIMEOUT):
+    """Run coroutines concurrently, returning their results in order"""
+    async def _all():
+        return await asyncio.gather(*coros)
+    return run(_all(), timeout)
+
+
+def _db():
+    return _async_db.ensure_started()
+
+
+# --- Async mirrors of models.user helpers ---
+
+async def get_user_by_username(username):
+    """Get user by username with error handling"""
+    try:
+        user_data = await _db().users.find_one(username_query('username', username))
+        return User(user_data) if user_data else None
+    except Exception as e:
+        print(f"Error getting user by username {username}: {e}")
+        return None
+
+
+async def get_all_doctors():
+    """Get all doctors with error handling"""
+    try:
+        return [User(doc) async for doc in _db().users.find({'role': 'doctor'})]
+    except Exception as e:
+        print(f"Error getting doctors: {e}")
+        return []
+
+
+async def get_patient_data(patient_id):
+    """Get patient data with error handling"""
+    try:
+        return await _db().patients_data.find_one({'patient_id': patient_id})
+    except Exception as e:
+        print(f"Error getting patient data for {patient_id}: {e}")
+        return None
+
+
+async def get_patient_data_docs(query):
+    """All patients_data documents matching a query"""
+    try:
+        return await _db().patients_data.find(query).to_list(length=None)
+    except Exception as e:
+        print(f"Error getting patient data for {query}: {e}")
+        return []
+
+
+async def get_patient_records(username):
+    """Get patient records with error handling"""
+    try:
+        record = await _db().patient_records.find_one(username_query('username', username))
+        return record if record else {}
+    except Exception as e:
+        print(f"Error getting patient records for {username}: {e}")
+        return {}
+
+
+async def get_patient_trials(username):
+    """Get patient trials with error handling"""
+    try:
+        trial = await _db().patient_trials.find_one({'username': username})
+        if trial:
+            return trial
+    except Exception as e:
+        print(f"Error getting patient trials for {username}: {e}")
+    # Default trial info
+    return {'username': username, 'remaining': 999, 'used': 0}
+
+
+async def get_prescriptions_for_patient(username):
+    """Prescriptions for a patient, newest first"""
+    try:
+        prescriptions = await _db().prescriptions.find({'patient_username': username}).sort('date', -1).to_list(length=None)
+        for p in prescriptions:
+            p['_id'] = str(p['_id'])
+        return prescriptions
+    except Exception as e:
+        print(f"Error getting prescriptions for {username}: {e}")
+        return []
+
+
+async def get_appointments_for_patient(patient_username):
+    """Get upcoming appointments for a patient with doctor details"""
+    try:
+        db = _db()
+        appointments = await db.appointments.find(username_query('patient', patient_username)).to_list(length=None)
+
+        # Pending/confirmed appointments from today on (unparseable dates are kept)
+        today = datetime.now().date()
+        upcoming = []
+        for apt in appointments:
+            if apt.get('status') not in ['pending', 'confirmed']:
+                continue
+            try:
+                apt_date_str = apt.get('preferred_date', '')
+                if apt_date_str and datetime.strptime(apt_date_str, '%Y-%m-%d').date() >= today:
+                    upcoming.append(apt)
+            except ValueError:
+                upcoming.append(apt)
+
+        # One query for every doctor referenced
+        doctor_names = list({apt['doctor'] for apt in upcoming})
+        doctors = {
+            doc['username']: doc async for doc in db.users.find(
+                {'username': {'$in': doctor_names}},
+                {'username': 1, 'specialization': 1}
+            )
+        }
+
+        result = []
+        for apt in upcoming:
+            doctor = doctors.get(apt['doctor'])
+            if not doctor:
+                continue
+            if not apt.get('meet_link'):
+                import uuid
+                apt['meet_link'] = f"https://meet.jit.si/ckd-appointment-{uuid.uuid4()}"
+                await db.appointments.update_one({'_id': apt['_id']}, {'$set': {'meet_link': apt['meet_link']}})
+            apt['doctor_details'] = {
+                'name': doctor.get('username'),
+                'specialty': doctor.get('specialization', 'Nephrology'),
+                'avatar': doctor.get('username', 'DR')[0:2].upper()
+            }
+            result.append(apt)
+
+        result.sort(key=lambda x: (x.get('preferred_date', ''), x.get('preferred_time', '')))
+        return result
+    except Exception as e:
+        print(f"Error getting appointments for patient {patient_username}: {e}")
+        return []
@@ -0,0 +1,131 @@
+"""
+BM25 Keyword Index for KidneyCompanion retrieval
+In-memory inverted index over the same chunks as the vector store, kept in sync at
+ingestion time and persisted next to it. Catches exact terms (drug names, "eGFR 45")
+that embeddings blur, and answers short keyword queries without embedding at all.
+"""
+
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Decimal numbers stay one token so "4.5" and "eGFR 45" match exactly
+_TOKEN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+STOPWORDS = frozenset("""
+a about am an and are as at be been but by can could do does for from had has have how i if in
+is it its me my of on or our should so than that the their them then there these they this to
+was we were what when where which who why will with would you your
+""".split())
+
+
+def tokenize(text):
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Thread-safe BM25 index keyed by chunk id"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._texts = {}      # id -> chunk text
+        self._lengths = {}    # id -> token count
+        self._postings = {}   # term -> {id: term frequency}
+        self._total_length = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._texts)
+
+    def _add_locked(self, chunk_id, text):
+        if chunk_id in self._texts:
+            self._delete_locked(chunk_id)
+        counts = Counter(tokenize(text))
+        self._texts[chunk_id] = text
+        self._lengths[chunk_id] = sum(counts.values())
+        self._total_length += self._lengths[chunk_id]
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+
+    def _delete_locked(self, chunk_id):
+        text = self._texts.pop(chunk_id, None)
+        if text is None:
+            return
+        self._total_length -= self._lengths.pop(chunk_id)
+        for term in set(tokenize(text)):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def add(self, ids, texts):
+        with self._lock:
+            for chunk_id, text in zip(ids, texts):
+                self._add_locked(chunk_id, text)
+
+    def delete(self, ids):
+        with self._lock:
+            for chunk_id in ids:
+                self._delete_locked(chunk_id)
+
+    def clear(self):
+        with self._lock:
+            self._texts.clear()
+            self._lengths.clear()
+            self._postings.clear()
+            self._total_length = 0
+
+    def search(self, query, k=3):
+        """[(chunk id, text, score)] best first; empty when no query term is indexed"""
+        terms = tokenize(query)
+        with self._lock:
+            n = len(self._texts)
+            if not n or not terms:
+                return []
+            avg_length = self._total_length / n or 1
+            scores = {}
+            for term in set(terms):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[chunk_id] / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(chunk_id, self._texts[chunk_id], score) for chunk_id, score in best]
+
+    def save(self):
+        """Persist chunk texts; postings are rebuilt on load"""
+        if not self.path:
+            return
+        with self._lock:
+            data = dict(self._texts)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        with self._lock:
+            for chunk_id, text in data.items():
+                self._add_locked(chunk_id, text)
+
+
+def reciprocal_rank_fusion(*rankings, k=60):
+    """Fuse ranked lists of keys: score = sum of 1 / (k + rank), best first"""
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return [key for key, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
@@ -0,0 +1,167 @@
+"""
+Cohort Export for CKD Diagnostic System
+Streams patient lab histories and predictions as CSV, NDJSON or Parquet, batch by batch
+from a MongoDB cursor, so exports of any size run in constant memory
+"""
+
+import io
+import os
+import csv
+import json
+from models.database import Database
+from models.lab_rows import METRIC_COLUMNS, flatten_history_entry
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 5000))
+EXPORT_FORMATS = ('csv', 'ndjson', 'parquet')
+
+COLUMNS = ['username', 'date', 'test_type'] + METRIC_COLUMNS + ['risk_level', 'risk_percentage', 'stage']
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+
+def parquet_available():
+    return pa is not None
+
+
+def _cohort_pipeline(risk_level=None, stage=None, usernames=None, since=None, until=None, patient_keys=None):
+    """
+    One output document per history entry of the matching patients. `patient_keys`
+    (normalized username keys) limits the export to those patients, e.g. a doctor's own.
+    """
+    match = {'history.0': {'$exists': True}}
+    if risk_level:
+        match['current_metrics.disease_prediction.risk_level'] = risk_level
+    if stage:
+        # Stages are stored as numbers or strings depending on the model that produced them
+        stage_values = [stage, int(stage)] if str(stage).isdigit() else [stage]
+        match['current_metrics.disease_prediction.stage'] = {'$in': stage_values}
+    if usernames:
+        match['username'] = {'$in': list(usernames)}
+    if patient_keys is not None:
+        # Records written before the username_key backfill still match on the stored name
+        match['$or'] = [{'username_key': {'$in': list(patient_keys)}}, {'username': {'$in': list(patient_keys)}}]
+    pipeline = [
+        {'$match': match},
+        {'$project': {'_id': 0, 'username': 1, 'history': 1}},
+        {'$unwind': '$history'}
+    ]
+    # History dates are "YYYY-MM-DD HH:MM:SS" strings, so string bounds compare correctly
+    date_range = {}
+    if since:
+        date_range['$gte'] = since
+    if until:
+        # A bare date includes that whole day
+        date_range['$lte'] = f"{until} 23:59:59" if len(until) == 10 else until
+    if date_range:
+        pipeline.append({'$match': {'history.date': date_range}})
+    return pipeline
+
+
+def iter_cohort_batches(batch_size=EXPORT_BATCH_SIZE, **filters):
+    """Yield lists of flat rows (dicts keyed by COLUMNS), at most batch_size each"""
+    db = Database.get_db()
+    if db is None:
+        return
+    cursor = db.patient_records.aggregate(
+        _cohort_pipeline(**filters), allowDiskUse=True, batchSize=batch_size
+    )
+    batch = []
+    for doc in cursor:
+        batch.append(flatten_history_entry(doc))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only when the cohort is empty
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(row, default=str) + '\n' for row in batch).encode('utf-8')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only stream the Parquet writer fills; drained after every row group"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema():
+    fields = [pa.field(c, pa.string()) for c in ('username', 'date', 'test_type')]
+    fields += [pa.field(c, pa.float64()) for c in METRIC_COLUMNS]
+    fields += [pa.field('risk_level', pa.string()), pa.field('risk_percentage', pa.float64()),
+               pa.field('stage', pa.string())]
+    return pa.schema(fields)
+
+
+def _parquet_chunks(batches):
+    if pa is None:
+        raise RuntimeError("Parquet export requires pyarrow")
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for batch in batches:
+            # One row group per batch
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def stream_cohort(fmt='csv', batch_size=EXPORT_BATCH_SIZE, **filters):
+    """Yield the encoded export in chunks (one per batch) for the given format"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    batches = iter_cohort_batches(batch_size=batch_size, **filters)
+    if fmt == 'csv':
+        return _csv_chunks(batches)
+    if fmt == 'ndjson':
+        return _ndjson_chunks(batches)
+    return _parquet_chunks(batches)
@@ -0,0 +1,218 @@
+"""
+Conversation Memory for the Patient Chatbot
+Per (user, session) ring-buffer histories held in process memory, with idle eviction,
+a global memory cap and optional persistence to MongoDB (expired by a TTL index).
+Only the most recent turns, within a token budget, are handed to the prompt.
+"""
+
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+from models.database import Database
+
+# Messages kept per conversation (patient and assistant turns both count)
+CONVERSATION_MAX_MESSAGES = int(os.environ.get('CONVERSATION_MAX_MESSAGES', 20))
+# Conversations untouched for this long are dropped from memory
+CONVERSATION_IDLE_SECONDS = int(os.environ.get('CONVERSATION_IDLE_SECONDS', 1800))
+# Approximate cap on message text held in memory across all conversations
+CONVERSATION_MAX_BYTES = int(os.environ.get('CONVERSATION_MAX_BYTES', 8 * 1024 * 1024))
+CONVERSATION_PERSIST = os.environ.get('CONVERSATION_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+CONVERSATION_TTL_DAYS = int(os.environ.get('CONVERSATION_TTL_DAYS', 7))
+
+# What the prompt gets: at most this many recent messages, within this many tokens
+PROMPT_HISTORY_MESSAGES = int(os.environ.get('PROMPT_HISTORY_MESSAGES', 6))
+PROMPT_HISTORY_TOKENS = int(os.environ.get('PROMPT_HISTORY_TOKENS', 600))
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def _message_size(entry):
+    return len(entry['message'].encode('utf-8'))
+
+
+class _Conversation:
+    def __init__(self, max_messages):
+        self.messages = deque(maxlen=max_messages)
+        self.bytes = 0
+        self.last_access = time.monotonic()
+
+    def append(self, entry):
+        """Add a message, returning the change in bytes held (the oldest may fall off)"""
+        delta = _message_size(entry)
+        if len(self.messages) == self.messages.maxlen:
+            delta -= _message_size(self.messages[0])
+        self.messages.append(entry)
+        self.bytes += delta
+        return delta
+
+
+class ConversationStore:
+    """Thread-safe conversation histories keyed by (user_id, session_id)"""
+
+    def __init__(self, max_messages=CONVERSATION_MAX_MESSAGES, idle_seconds=CONVERSATION_IDLE_SECONDS,
+                 max_bytes=CONVERSATION_MAX_BYTES, persist=CONVERSATION_PERSIST):
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self._lock = threading.Lock()
+        # Least recently used first, so idle and over-cap eviction pop from the front
+        self._conversations = OrderedDict()
+        self._bytes = 0
+        self._evictions = 0
+
+    # --- Memory management ---
+
+    def _evict_locked(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._conversations:
+            conversation = next(iter(self._conversations.values()))
+            idle = conversation.last_access < cutoff
+            # The cap never evicts the conversation in use (the most recent one)
+            over_cap = self._bytes > self.max_bytes and len(self._conversations) > 1
+            if not (idle or over_cap):
+                break
+            self._conversations.popitem(last=False)
+            self._bytes -= conversation.bytes
+            self._evictions += 1
+
+    def _get_locked(self, key, create=False):
+        conversation = self._conversations.get(key)
+        if conversation is None:
+            if not create:
+                return None
+            conversation = self._conversations[key] = _Conversation(self.max_messages)
+        conversation.last_access = time.monotonic()
+        self._conversations.move_to_end(key)
+        return conversation
+
+    def _seed(self, key):
+        """
+        Messages to restore a conversation that is not in memory (evicted, or lost on
+        restart) from MongoDB; None when it is already in memory
+        """
+        with self._lock:
+            if key in self._conversations:
+                return None
+        return self._load_persisted(*key) if self.persist else []
+
+    def _get_or_seed_locked(self, key, seed):
+        conversation = self._get_locked(key, create=True)
+        if seed and not conversation.messages:
+            for entry in seed[-self.max_messages:]:
+                self._bytes += conversation.append(entry)
+        return conversation
+
+    # --- Persistence ---
+
+    def _load_persisted(self, user_id, session_id):
+        try:
+            db = Database.get_db()
+            if db is None:
+                return []
+            doc = db.chat_conversations.find_one(
+                {'username': user_id, 'session_id': session_id, 'expires_at': {'$gt': datetime.utcnow()}},
+                {'_id': 0, 'messages': 1}
+            )
+            return doc.get('messages', []) if doc else []
+        except Exception as e:
+            print(f"Error loading conversation for {user_id}: {e}")
+            return []
+
+    def _persist(self, user_id, session_id, entry):
+        try:
+            db = Database.get_db()
+            if db is None:
+                return
+            now = datetime.utcnow()
+            db.chat_conversations.update_one(
+                {'username': user_id, 'session_id': session_id},
+                {
+                    '$push': {'messages': {'$each': [entry], '$slice': -self.max_messages}},
+                    '$set': {'updated_at': now, 'expires_at': now + timedelta(days=CONVERSATION_TTL_DAYS)}
+                },
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error saving conversation for {user_id}: {e}")
+
+    # --- Public API ---
+
+    def append(self, user_id, session_id, role, message):
+        key = (user_id, session_id)
+        entry = {'role': role, 'message': message, 'timestamp': datetime.now().isoformat()}
+        seed = self._seed(key)
+        with self._lock:
+            conversation = self._get_or_seed_locked(key, seed)
+            self._bytes += conversation.append(entry)
+            self._evict_locked()
+        if self.persist and user_id is not None:
+            self._persist(user_id, session_id, entry)
+
+    def history(self, user_id, session_id=None):
+        """Every message held for the conversation, oldest first"""
+        key = (user_id, session_id)
+        seed = self._seed(key)
+        with self._lock:
+            if seed:
+                conversation = self._get_or_seed_locked(key, seed)
+                self._evict_locked()
+            else:
+                conversation = self._get_locked(key)
+            return list(conversation.messages) if conversation else []
+
+    def recent(self, user_id, session_id=None, max_messages=PROMPT_HISTORY_MESSAGES,
+               token_budget=PROMPT_HISTORY_TOKENS):
+        """The newest messages that fit both limits, oldest first (for the prompt)"""
+        selected = []
+        tokens = 0
+        for entry in reversed(self.history(user_id, session_id)):
+            cost = estimate_tokens(entry['message'])
+            if len(selected) >= max_messages or tokens + cost > token_budget:
+                break
+            selected.append(entry)
+            tokens += cost
+        selected.reverse()
+        return selected
+
+    def reset(self, user_id, session_id=None):
+        with self._lock:
+            conversation = self._conversations.pop((user_id, session_id), None)
+            if conversation is not None:
+                self._bytes -= conversation.bytes
+        if self.persist:
+            try:
+                db = Database.get_db()
+                if db is not None:
+                    db.chat_conversations.delete_one({'username': user_id, 'session_id': session_id})
+            except Exception as e:
+                print(f"Error deleting conversation for {user_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            self._evict_locked()
+            return {
+                'conversations': len(self._conversations),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self._evictions
+            }
+
+
+# Singleton instance
+_store_instance = None
+_store_lock = threading.Lock()
+
+def get_conversation_store():
+    """Factory function to get or create the process-wide conversation store"""
+    global _store_instance
+    if _store_instance is None:
+        with _store_lock:
+            if _store_instance is None:
+                _store_instance = ConversationStore()
+    return _store_instance
@@ -2,7 +2,11 @@ import os
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+import time
+import threading
 import logging
+from models.db_metrics import command_listener, pool_listener, async_pool_listener
+from models.local_store import LocalClient, is_local_uri
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -10,9 +14,43 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Connection pool settings (see pymongo MongoClient options)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+# Comma separated, e.g. "zstd,snappy"; unavailable compressors are ignored by pymongo
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', '')
+
+# Circuit breaker: after a failed connect, wait before trying again (doubling up to the max)
+MONGO_RETRY_BACKOFF_SECONDS = float(os.environ.get('MONGO_RETRY_BACKOFF_SECONDS', 5))
+MONGO_RETRY_BACKOFF_MAX_SECONDS = float(os.environ.get('MONGO_RETRY_BACKOFF_MAX_SECONDS', 60))
+
+
+def _client_options(pool_events=pool_listener):
+    options = {
+        'serverSelectionTimeoutMS': MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        'maxPoolSize': MONGO_MAX_POOL_SIZE,
+        'minPoolSize': MONGO_MIN_POOL_SIZE,
+        'maxIdleTimeMS': MONGO_MAX_IDLE_TIME_MS,
+        'waitQueueTimeoutMS': MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'event_listeners': [command_listener, pool_events]
+    }
+    if MONGO_COMPRESSORS:
+        options['compressors'] = MONGO_COMPRESSORS
+    return options
+
+
 class Database:
     client = None
     db = None
+    _supports_transactions = None
+    # Process that owns the client; a forked worker must build its own
+    _pid = None
+    _lock = threading.Lock()
+    _failures = 0
+    _retry_at = 0
 
     @staticmethod
     def initialize():
@@ -22,28 +60,89 @@ class Database:
             mongo_uri = "mongodb://localhost:27017/vois_ckd"
             print("WARNING: MONGO_URI not found. Using default local URI.")
         
+        Database._pid = os.getpid()
         try:
-            # Test connection with shorter timeout
-            Database.client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
-            # Get database name from URI or default to vois_ckd
-            db_name = mongo_uri.split('/')[-1].split('?')[0] or 'vois_ckd'
+            if is_local_uri(mongo_uri):
+                # Embedded datastore (sqlite:///path.db or memory://), no MongoDB server needed
+                Database.client = LocalClient(mongo_uri)
+                db_name = 'vois_ckd'
+            else:
+                # The listeners charge each command to the current request and track pool usage
+                Database.client = MongoClient(mongo_uri, **_client_options())
+                # Get database name from URI or default to vois_ckd
+                db_name = mongo_uri.split('/')[-1].split('?')[0] or 'vois_ckd'
             Database.db = Database.client[db_name]
             # Test the connection
             Database.client.admin.command('ping')
             print(f"Connected to MongoDB database: {db_name}")
+            Database._failures = 0
+            Database._retry_at = 0
         except Exception as e:
             logger.error(f"Error connecting to MongoDB: {e}")
             print(f"WARNING: Could not connect to MongoDB. Running in offline mode.")
             print("Please ensure MongoDB is running or update MONGO_URI in .env file.")
+            if Database.client is not None:
+                Database.client.close()
             Database.client = None
             Database.db = None
+            Database._failures += 1
+            backoff = min(MONGO_RETRY_BACKOFF_SECONDS * 2 ** (Database._failures - 1),
+                          MONGO_RETRY_BACKOFF_MAX_SECONDS)
+            Database._retry_at = time.monotonic() + backoff
+        Database._supports_transactions = None
+
+    @staticmethod
+    def supports_transactions():
+        """Multi-document transactions need a replica set or a sharded cluster"""
+        if Database._supports_transactions is None:
+            try:
+                if Database.client is None:
+                    return False
+                hello = Database.client.admin.command('hello')
+                Database._supports_transactions = bool(
+                    hello.get('setName') or hello.get('msg') == 'isdbgrid'
+                )
+            except Exception as e:
+                logger.error(f"Error checking transaction support: {e}")
+                return False
+        return Database._supports_transactions
+
+    @staticmethod
+    def is_local():
+        """True when running on the embedded datastore instead of a MongoDB server"""
+        return isinstance(Database.client, LocalClient)
 
     @staticmethod
     def get_db():
+        """Connect lazily in each process; while the breaker is open, return None without retrying"""
+        if Database._pid != os.getpid():
+            # Inherited across fork: the parent's sockets are not ours to use
+            Database.client = None
+            Database.db = None
+            Database._failures = 0
+            Database._retry_at = 0
+            Database._pid = os.getpid()
         if Database.db is None:
-            Database.initialize()
+            if time.monotonic() < Database._retry_at:
+                return None
+            with Database._lock:
+                if Database.db is None and time.monotonic() >= Database._retry_at:
+                    Database.initialize()
         return Database.db
 
+    @staticmethod
+    def pool_stats():
+        """Pool counters plus the configured limits and breaker state"""
+        return {
+            **pool_listener.snapshot(),
+            'max_pool_size': MONGO_MAX_POOL_SIZE,
+            'min_pool_size': MONGO_MIN_POOL_SIZE,
+            'connected': Database.db is not None,
+            'consecutive_failures': Database._failures,
+            'retry_in_seconds': round(max(Database._retry_at - time.monotonic(), 0), 1),
+            'async': async_pool_listener.snapshot()
+        }
+
     @staticmethod
     def close():
         if Database.client:
@@ -51,40 +150,43 @@ class Database:
                 Database.client.close()
             except Exception as e:
                 logger.error(f"Error closing database connection: {e}")
+        Database.client = None
+        Database.db = None
 
 
 # AI Recommendations Helper Functions
+# Plans live in their own collection (one document per username) so users documents stay
+# small; a TTL index on expires_at (see init_database.init_collections) removes expired plans.
+AI_RECOMMENDATIONS_TTL_DAYS = int(os.environ.get('AI_RECOMMENDATIONS_TTL_DAYS', 30))
+
+
 def save_ai_recommendations(username, recommendations_data):
-    """Save AI-generated recommendations to patient record"""
+    """Save AI-generated recommendations for a patient"""
     try:
         db = Database.get_db()
         if db is None:
             logger.error("Database connection failed in save_ai_recommendations")
             return False
-        # Users are stored in 'users' collection, not 'patients'
-        users = db['users']
         
-        logger.info(f"Saving AI recommendations for user: {username}")
+        if not db.users.count_documents({'username': username}, limit=1):
+            logger.warning(f"No user found for {username}. Recommendations not saved.")
+            return False
         
-        result = users.update_one(
+        logger.info(f"Saving AI recommendations for user: {username}")
+        now = datetime.utcnow()
+        db.ai_recommendations.update_one(
             {'username': username},
             {
                 '$set': {
-                    'ai_recommendations': {
-                        'generated_at': datetime.utcnow(),
-                        'expires_at': datetime.utcnow() + timedelta(days=30),
-                        'data': recommendations_data
-                    }
+                    'generated_at': now,
+                    'expires_at': now + timedelta(days=AI_RECOMMENDATIONS_TTL_DAYS),
+                    'data': recommendations_data
                 }
-            }
+            },
+            upsert=True
         )
-        
-        if result.modified_count > 0:
-            logger.info(f"Successfully saved recommendations for {username}")
-            return True
-        else:
-            logger.warning(f"No document updated for {username}. User might not exist.")
-            return False
+        logger.info(f"Successfully saved recommendations for {username}")
+        return True
     except Exception as e:
         logger.error(f"Error saving AI recommendations: {e}")
         return False
@@ -96,33 +198,15 @@ def get_ai_recommendations(username):
         db = Database.get_db()
         if db is None:
             return None
-        # Users are stored in 'users' collection, not 'patients'
-        users = db['users']
-        
-        user = users.find_one({'username': username})
-        
-        if not user:
-            logger.warning(f"User not found for username: {username}")
-            return None
-            
-        if 'ai_recommendations' in user:
-            recommendations = user['ai_recommendations']
-            
-            # Check if recommendations are still valid (not expired)
-            if 'expires_at' in recommendations:
-                expiry = recommendations['expires_at']
-                now = datetime.utcnow()
-                
-                if expiry > now:
-                    logger.info(f"Found valid recommendations for {username}")
-                    return recommendations.get('data')
-                else:
-                    logger.warning(f"Recommendations for {username} expired at {expiry}")
-            else:
-                logger.warning(f"No expiry date found for recommendations of {username}")
-        else:
-            logger.info(f"No AI recommendations found for {username}")
-        
+        # The TTL monitor runs about once a minute, so filter out just-expired plans too
+        recommendations = db.ai_recommendations.find_one(
+            {'username': username, 'expires_at': {'$gt': datetime.utcnow()}},
+            {'_id': 0, 'data': 1}
+        )
+        if recommendations:
+            logger.info(f"Found valid recommendations for {username}")
+            return recommendations.get('data')
+        logger.info(f"No valid AI recommendations found for {username}")
         return None
     except Exception as e:
         logger.error(f"Error getting AI recommendations: {e}")
@@ -0,0 +1,256 @@
+"""
+MongoDB command instrumentation for CKD Diagnostic System
+Attributes every pymongo command to the Flask request that issued it and keeps
+per-route totals so chatty routes show up in a "top N" report; also counts
+connection pool activity.
+Reply sizes are measured by re-encoding each reply, so per-request byte counts are only
+taken when something reads them: the X-DB-Stats header (DB_METRICS_HEADER or debug),
+the per-route report (DB_METRICS_BYTES) or measure().
+The embedded memory:// and sqlite:/// stores do not go through pymongo, so they issue no
+monitored commands; requests that issued none are not logged.
+"""
+
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bson
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Count reply bytes for every request, for /admin/metrics/db?by=bytes
+DB_METRICS_BYTES = os.environ.get('DB_METRICS_BYTES', '').lower() in ('1', 'true', 'yes')
+
+# Stats for the request running in the current thread/context
+_current_stats = ContextVar('db_request_stats', default=None)
+
+
+def _documents_returned(reply):
+    """Documents in a command reply (find/aggregate/getMore batches, distinct values)"""
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    if 'values' in reply:
+        return len(reply['values'])
+    return 0
+
+
+def _reply_bytes(reply):
+    try:
+        return len(bson.encode(reply))
+    except Exception:
+        return 0
+
+
+class RequestDBStats:
+    """Database work done by one request"""
+
+    def __init__(self, route, count_bytes=True):
+        self.route = route
+        self.count_bytes = count_bytes
+        # Commands issued with async_db.gather() finish on several threads at once
+        self._lock = threading.Lock()
+        self.commands = 0
+        self.failed = 0
+        self.duration_ms = 0.0
+        self.documents = 0
+        self.bytes = 0
+        self.by_command = {}
+
+    def record(self, command_name, duration_micros, documents=0, size=0, failed=False):
+        with self._lock:
+            self.commands += 1
+            self.failed += 1 if failed else 0
+            self.duration_ms += duration_micros / 1000.0
+            self.documents += documents
+            self.bytes += size
+            self.by_command[command_name] = self.by_command.get(command_name, 0) + 1
+
+    def to_dict(self):
+        return {
+            'route': self.route,
+            'commands': self.commands,
+            'failed': self.failed,
+            'duration_ms': round(self.duration_ms, 2),
+            'documents': self.documents,
+            'bytes': self.bytes,
+            'by_command': self.by_command
+        }
+
+
+class RequestCommandListener(monitoring.CommandListener):
+    """pymongo listener that charges each command to the current request, if any"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.record(event.command_name, event.duration_micros, _documents_returned(event.reply),
+                         _reply_bytes(event.reply) if stats.count_bytes else 0)
+
+    def failed(self, event):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.record(event.command_name, event.duration_micros, failed=True)
+
+
+class RouteMetrics:
+    """Process-wide per-route totals"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def add(self, stats):
+        with self._lock:
+            totals = self._routes.setdefault(stats.route, {
+                'requests': 0, 'commands': 0, 'failed': 0,
+                'duration_ms': 0.0, 'documents': 0, 'bytes': 0, 'max_commands': 0
+            })
+            totals['requests'] += 1
+            totals['commands'] += stats.commands
+            totals['failed'] += stats.failed
+            totals['duration_ms'] += stats.duration_ms
+            totals['documents'] += stats.documents
+            totals['bytes'] += stats.bytes
+            totals['max_commands'] = max(totals['max_commands'], stats.commands)
+
+    def top_routes(self, n=10, by='commands'):
+        """Routes ordered by average `by` (commands, duration_ms, documents, bytes) per request"""
+        with self._lock:
+            rows = []
+            for route, totals in self._routes.items():
+                requests = totals['requests'] or 1
+                rows.append({
+                    'route': route,
+                    'requests': totals['requests'],
+                    'avg_commands': round(totals['commands'] / requests, 2),
+                    'avg_duration_ms': round(totals['duration_ms'] / requests, 2),
+                    'avg_documents': round(totals['documents'] / requests, 2),
+                    'avg_bytes': round(totals['bytes'] / requests, 1),
+                    'max_commands': totals['max_commands'],
+                    'failed': totals['failed']
+                })
+        key = 'avg_' + by if by != 'max_commands' else by
+        rows.sort(key=lambda r: r.get(key, r['avg_commands']), reverse=True)
+        return rows[:n]
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Connection pool counters: open/checked-out connections, checkout waits and failures"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            'connections_created': 0, 'connections_closed': 0,
+            'checkouts': 0, 'checkout_failures': 0, 'checked_out': 0,
+            'pool_cleared': 0
+        }
+
+    def _bump(self, name, delta=1):
+        with self._lock:
+            self._counters[name] += delta
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters['open_connections'] = counters['connections_created'] - counters['connections_closed']
+        return counters
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump('pool_cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump('connections_created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump('connections_closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._bump('checkout_failures')
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self._counters['checkouts'] += 1
+            self._counters['checked_out'] += 1
+
+    def connection_checked_in(self, event):
+        self._bump('checked_out', -1)
+
+
+command_listener = RequestCommandListener()
+pool_listener = PoolMetricsListener()
+# The Motor client (models.async_db) has its own pool, counted separately
+async_pool_listener = PoolMetricsListener()
+route_metrics = RouteMetrics()
+
+
+def current_request_stats():
+    """Stats for the request in progress, or None outside a request"""
+    return _current_stats.get()
+
+
+@contextmanager
+def measure(label):
+    """Collect command stats for a block of code outside Flask (scripts, benchmarks)"""
+    stats = RequestDBStats(label)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def init_app(app):
+    """Register request hooks: start stats, emit header/log line, fold into route totals"""
+    header_enabled = os.environ.get('DB_METRICS_HEADER', '').lower() in ('1', 'true', 'yes')
+
+    @app.before_request
+    def _start_db_stats():
+        from flask import request
+        route = request.url_rule.rule if request.url_rule else request.path
+        count_bytes = DB_METRICS_BYTES or header_enabled or app.debug
+        _current_stats.set(RequestDBStats(f"{request.method} {route}", count_bytes))
+
+    @app.after_request
+    def _finish_db_stats(response):
+        stats = _current_stats.get()
+        if stats is None:
+            return response
+        if header_enabled or app.debug:
+            response.headers['X-DB-Stats'] = (
+                f"commands={stats.commands}; time_ms={stats.duration_ms:.2f}; "
+                f"docs={stats.documents}; bytes={stats.bytes}"
+            )
+        if stats.commands:
+            logger.info(json.dumps({'event': 'db_request_stats', 'status': response.status_code, **stats.to_dict()}))
+        route_metrics.add(stats)
+        return response
+
+    @app.teardown_request
+    def _clear_db_stats(exc):
+        _current_stats.set(None)
@@ -0,0 +1,103 @@
+"""
+Doctor Directory Service for CKD Diagnostic System
+Keeps a city-keyed, pre-sorted index of doctor summaries in memory so the
+patient-facing doctor lists do not scan and rebuild every doctor per page view
+"""
+
+import os
+import threading
+import time
+from models.database import Database
+
+DOCTOR_DIRECTORY_TTL = int(os.environ.get('DOCTOR_DIRECTORY_TTL', 300))
+
+
+def _doctor_summary(doctor):
+    """Build the card data the doctor lists render"""
+    username = doctor.get('username')
+    city = doctor.get('city')
+    return {
+        'name': f"Dr. {username}",
+        'username': username,
+        'specialty': doctor.get('specialization') or 'General',
+        'experience': 'Experienced',
+        'avatar': username[:2].upper(),
+        'location': city if city else 'Unknown'
+    }
+
+
+class DoctorDirectory:
+    def __init__(self, ttl=DOCTOR_DIRECTORY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (all doctors sorted by name, city -> doctors in that city sorted by name)
+        self._index = ([], {})
+        self._expires_at = 0
+
+    def invalidate(self):
+        """Force a rebuild on the next lookup (e.g. after a doctor is added)"""
+        self._expires_at = 0
+
+    def _ensure_fresh(self):
+        if time.monotonic() < self._expires_at:
+            return
+        with self._lock:
+            if time.monotonic() < self._expires_at:
+                return
+            self._rebuild()
+
+    def _rebuild(self):
+        try:
+            db = Database.get_db()
+            if db is None:
+                return
+            cursor = db.users.find(
+                {'role': 'doctor'},
+                {'username': 1, 'specialization': 1, 'city': 1}
+            )
+            doctors = sorted(
+                (_doctor_summary(doc) for doc in cursor if doc.get('username')),
+                key=lambda d: d['name']
+            )
+            by_city = {}
+            for doctor in doctors:
+                by_city.setdefault(doctor['location'].lower(), []).append(doctor)
+            self._index = (doctors, by_city)
+            self._expires_at = time.monotonic() + self.ttl
+        except Exception as e:
+            print(f"Error rebuilding doctor directory: {e}")
+
+    def top_k(self, city, k):
+        """
+        Doctors for a patient in `city`: same-city doctors first, then the rest, each by name.
+        Only walks the same-city bucket and as many other doctors as needed to fill k.
+        """
+        self._ensure_fresh()
+        doctors, by_city = self._index
+        city_key = city.lower() if city else None
+        result = [dict(d, priority=0) for d in by_city.get(city_key, [])[:k]]
+        if len(result) < k:
+            for doctor in doctors:
+                if doctor['location'].lower() == city_key:
+                    continue
+                result.append(dict(doctor, priority=1))
+                if len(result) >= k:
+                    break
+        return result
+
+    def ranked(self, city):
+        """Every doctor, same-city first"""
+        self._ensure_fresh()
+        return self.top_k(city, len(self._index[0]))
+
+
+# Singleton instance
+_doctor_directory_instance = None
+
+
+def get_doctor_directory():
+    """Factory function to get or create the singleton doctor directory"""
+    global _doctor_directory_instance
+    if _doctor_directory_instance is None:
+        _doctor_directory_instance = DoctorDirectory()
+    return _doctor_directory_instance
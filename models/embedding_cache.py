@@ -0,0 +1,127 @@
+"""
+Query Embedding Cache for the RAG Engine
+LRU cache of normalized query text -> embedding vector in front of the embedding model.
+Repeated patient questions skip re-embedding; misses arriving together are coalesced
+and embedded as one batch. Document embedding (ingestion) passes straight through.
+"""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+QUERY_CACHE_SIZE = int(os.environ.get('RAG_QUERY_CACHE_SIZE', 1024))
+# How long the first miss waits for concurrent misses to join its batch
+QUERY_BATCH_WINDOW_MS = float(os.environ.get('RAG_QUERY_BATCH_WINDOW_MS', 2))
+QUERY_BATCH_MAX = int(os.environ.get('RAG_QUERY_BATCH_MAX', 32))
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(text):
+    """Case, surrounding whitespace/punctuation and repeated spaces do not change the key"""
+    return _WHITESPACE.sub(' ', text).strip().strip('?!.').strip().lower()
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper whose embed_query is cached and micro-batched"""
+
+    def __init__(self, embeddings, max_size=QUERY_CACHE_SIZE,
+                 batch_window_ms=QUERY_BATCH_WINDOW_MS, max_batch=QUERY_BATCH_MAX):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._queue = []
+        self._batch_running = False
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'batches': 0, 'embedded': 0, 'evictions': 0}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_query(text)
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self._stats['hits'] += 1
+                return vector
+            self._stats['misses'] += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _Pending()
+                self._queue.append(key)
+            else:
+                # Same question already being embedded for another request
+                self._stats['coalesced'] += 1
+            leader = not self._batch_running
+            if leader:
+                self._batch_running = True
+
+        if leader:
+            if self.batch_window > 0:
+                time.sleep(self.batch_window)
+            self._run_batches()
+        pending.event.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.vector
+
+    def _embed_queries(self, texts):
+        # FastEmbed embeds a list of queries in one ONNX run; other models go one by one
+        model = getattr(self.embeddings, '_model', None)
+        if model is not None and hasattr(model, 'query_embed'):
+            return [vector.tolist() for vector in model.query_embed(texts)]
+        return [self.embeddings.embed_query(text) for text in texts]
+
+    def _run_batches(self):
+        """Embed queued misses until the queue is empty (runs on the first waiting thread)"""
+        while True:
+            with self._lock:
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+                if not batch:
+                    self._batch_running = False
+                    return
+            try:
+                vectors, error = self._embed_queries(batch), None
+            except Exception as e:
+                vectors, error = [None] * len(batch), e
+            with self._lock:
+                self._stats['batches'] += 1
+                for key, vector in zip(batch, vectors):
+                    pending = self._pending.pop(key)
+                    pending.vector, pending.error = vector, error
+                    if error is None:
+                        self._cache[key] = vector
+                        self._stats['embedded'] += 1
+                    pending.event.set()
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+                    self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,38 @@
+"""
+Lab Row Flattening for CKD Diagnostic System
+Turns patient_records history entries into flat rows of lab values and predictions,
+shared by the cohort export and the analytics snapshot
+"""
+
+METRIC_COLUMNS = [
+    'egfr', 'serum_creatinine', 'blood_urea', 'hemoglobin', 'sodium', 'potassium',
+    'bp_systolic', 'bp_diastolic', 'blood_glucose'
+]
+
+
+def to_float(value):
+    """Lab value as a float, or None when missing or not numeric"""
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def flatten_history_entry(doc):
+    """Flat row from an unwound {'username', 'history': entry} document"""
+    entry = doc.get('history') or {}
+    # Newer entries nest lab values under 'metrics'; older ones store them flat
+    metrics = entry.get('metrics') or entry
+    prediction = entry.get('prediction') or {}
+    row = {
+        'username': doc.get('username'),
+        'date': entry.get('date'),
+        'test_type': entry.get('test_type')
+    }
+    for column in METRIC_COLUMNS:
+        row[column] = to_float(metrics.get(column))
+    row['risk_level'] = prediction.get('risk_level')
+    row['risk_percentage'] = to_float(prediction.get('risk_percentage'))
+    stage = prediction.get('stage')
+    row['stage'] = str(stage) if stage is not None else None
+    return row
@@ -0,0 +1,1222 @@
+"""
+Embedded Local Datastore for CKD Diagnostic System
+A pymongo-compatible subset for running without a MongoDB server (laptops, CI,
+benchmarks). Selected through MONGO_URI:
+    sqlite:///data/local_store.db   documents persisted as JSON in one SQLite file
+    memory://                       process-local, nothing written to disk
+Collections are held in memory and queried in Python; SQLite is written through
+on every change and re-read when another connection has committed.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+import bson
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult
+
+# Extended JSON that round-trips ObjectId/datetime/int-vs-float, with naive UTC datetimes like pymongo
+_JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=False)
+
+# How often (seconds) TTL indexes are swept when a collection is touched
+TTL_SWEEP_INTERVAL = 1.0
+
+_MISSING = object()
+
+# memory:// databases by name, so re-initializing in the same process keeps the data
+_memory_databases = {}
+_memory_databases_lock = threading.Lock()
+
+
+def is_local_uri(uri):
+    return bool(uri) and (uri.startswith('sqlite://') or uri.startswith('memory://'))
+
+
+def _copy(doc):
+    """Detached copy with BSON semantics (validates types, tuples become lists, naive datetimes)"""
+    return bson.decode(bson.encode(doc))
+
+
+def _id_key(value):
+    return json_util.dumps(value, json_options=_JSON_OPTIONS)
+
+
+# --- Value comparison -------------------------------------------------------
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _type_key(value):
+    """Sort key following MongoDB's cross-type ordering"""
+    if value is None or value is _MISSING:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, json_util.dumps(value, json_options=_JSON_OPTIONS))
+    if isinstance(value, list):
+        return (5, json_util.dumps(value, json_options=_JSON_OPTIONS))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value)
+    if isinstance(value, datetime):
+        return (9, _naive_utc(value))
+    return (10, str(value))
+
+
+def _eq(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+    return a == b
+
+
+def _compare(a, b):
+    """-1/0/1 when a and b are of comparable types, else None"""
+    ka, kb = _type_key(a), _type_key(b)
+    if ka[0] != kb[0]:
+        return None
+    return (ka[1] > kb[1]) - (ka[1] < kb[1])
+
+
+def _hash_key(value):
+    return json_util.dumps({'v': value}, json_options=_JSON_OPTIONS)
+
+
+# --- Paths -----------------------------------------------------------------
+
+def _query_values(value, parts):
+    """Candidate values for a dotted query path, descending into arrays like MongoDB"""
+    if not parts:
+        return [value] + value if isinstance(value, list) else [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        return _query_values(value[head], rest) if head in value else []
+    if isinstance(value, list):
+        out = []
+        if head.isdigit() and int(head) < len(value):
+            out += _query_values(value[int(head)], rest)
+        for item in value:
+            if isinstance(item, dict):
+                out += _query_values(item, parts)
+        return out
+    return []
+
+
+def _field(value, parts):
+    """Value of an expression field path ('$a.b'); arrays of subdocuments map to arrays"""
+    for i, part in enumerate(parts):
+        if isinstance(value, dict):
+            if part not in value:
+                return _MISSING
+            value = value[part]
+        elif isinstance(value, list):
+            out = [_field(item, parts[i:]) for item in value if isinstance(item, dict)]
+            return [v for v in out if v is not _MISSING]
+        else:
+            return _MISSING
+    return value
+
+
+def _get_path(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+
+def _parent_for_write(doc, path, create=True):
+    """(container, last key) for a dotted path, creating intermediate documents"""
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list) and part.isdigit():
+            target = target[int(part)]
+            continue
+        if part not in target or not isinstance(target[part], (dict, list)):
+            if not create:
+                return None, None
+            target[part] = {}
+        target = target[part]
+    last = parts[-1]
+    if isinstance(target, list):
+        last = int(last)
+    return target, last
+
+
+def _set_path(doc, path, value):
+    parent, key = _parent_for_write(doc, path)
+    if isinstance(parent, list):
+        while len(parent) <= key:
+            parent.append(None)
+    parent[key] = value
+
+
+def _unset_path(doc, path):
+    parent, key = _parent_for_write(doc, path, create=False)
+    if isinstance(parent, dict):
+        parent.pop(key, None)
+    elif isinstance(parent, list) and key < len(parent):
+        parent[key] = None
+
+
+def _copy_path(src, dst, parts):
+    head, rest = parts[0], parts[1:]
+    if not isinstance(src, dict) or head not in src:
+        return
+    value = src[head]
+    if not rest:
+        dst[head] = value
+    elif isinstance(value, dict):
+        _copy_path(value, dst.setdefault(head, {}), rest)
+    elif isinstance(value, list):
+        items = []
+        for item in value:
+            if isinstance(item, dict):
+                sub = {}
+                _copy_path(item, sub, rest)
+                items.append(sub)
+        dst[head] = items
+
+
+# --- Query matching --------------------------------------------------------
+
+def _regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if isinstance(pattern, Regex):
+        return pattern.try_compile()
+    flags = 0
+    for flag, value in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+        if flag in (options or ''):
+            flags |= value
+    return re.compile(pattern, flags)
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and value and all(k.startswith('$') for k in value)
+
+
+def _equals_any(values, target):
+    if isinstance(target, (re.Pattern, Regex)):
+        pattern = _regex(target)
+        return any(isinstance(v, str) and pattern.search(v) for v in values)
+    if target is None and not values:
+        return True
+    return any(_eq(v, target) for v in values)
+
+
+def _bson_type(value):
+    """$type alias for a value"""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+    for kind, alias in ((float, 'double'), (str, 'string'), (dict, 'object'), (list, 'array'),
+                        (bytes, 'binData'), (ObjectId, 'objectId'), (datetime, 'date')):
+        if isinstance(value, kind):
+            return alias
+    return None
+
+
+def _match_condition(values, cond):
+    if not _is_operator_dict(cond):
+        return _equals_any(values, cond)
+    for op, arg in cond.items():
+        if op == '$eq':
+            ok = _equals_any(values, arg)
+        elif op == '$ne':
+            ok = not _equals_any(values, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            wanted = {'$gt': (1,), '$gte': (0, 1), '$lt': (-1,), '$lte': (-1, 0)}[op]
+            ok = any(_compare(v, arg) in wanted for v in values)
+        elif op == '$in':
+            ok = any(_equals_any(values, target) for target in arg)
+        elif op == '$nin':
+            ok = not any(_equals_any(values, target) for target in arg)
+        elif op == '$exists':
+            ok = bool(values) == bool(arg)
+        elif op == '$regex':
+            pattern = _regex(arg, cond.get('$options'))
+            ok = any(isinstance(v, str) and pattern.search(v) for v in values)
+        elif op == '$options':
+            continue
+        elif op == '$size':
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == '$elemMatch':
+            # Field conditions or $or/$and/$nor apply to document elements, operators to the values
+            as_query = not _is_operator_dict(arg) or any(k in ('$or', '$and', '$nor') for k in arg)
+            ok = any(isinstance(v, list) and any(
+                _match(item, arg) if isinstance(item, dict) and as_query
+                else not as_query and _match_condition([item], arg)
+                for item in v) for v in values)
+        elif op == '$not':
+            ok = not _match_condition(values, arg)
+        elif op == '$type':
+            ok = any(_bson_type(v) in (arg if isinstance(arg, list) else [arg]) for v in values)
+        elif op == '$all':
+            ok = all(_equals_any(values, target) for target in arg)
+        else:
+            raise OperationFailure(f"Unsupported query operator in local datastore: {op}")
+        if not ok:
+            return False
+    return True
+
+
+def _match(doc, query):
+    for key, cond in (query or {}).items():
+        if key == '$or':
+            ok = any(_match(doc, q) for q in cond)
+        elif key == '$and':
+            ok = all(_match(doc, q) for q in cond)
+        elif key == '$nor':
+            ok = not any(_match(doc, q) for q in cond)
+        elif key == '$expr':
+            ok = _truthy(_eval(cond, doc))
+        elif key.startswith('$'):
+            raise OperationFailure(f"Unsupported query operator in local datastore: {key}")
+        else:
+            ok = _match_condition(_query_values(doc, key.split('.')), cond)
+        if not ok:
+            return False
+    return True
+
+
+# --- Sorting and projection -------------------------------------------------
+
+def _normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(k, d) for k, d in key_or_list]
+
+
+def _sort_docs(docs, spec):
+    # Stable multi-pass sort, least significant key first
+    for path, direction in reversed(spec):
+        parts = path.split('.')
+
+        def key(doc, parts=parts, direction=direction):
+            value = _field(doc, parts)
+            if isinstance(value, list):
+                keys = [_type_key(v) for v in value] or [_type_key(None)]
+                return min(keys) if direction > 0 else max(keys)
+            return _type_key(value)
+        docs.sort(key=key, reverse=direction < 0)
+    return docs
+
+
+def _slice(values, arg):
+    if isinstance(arg, list):
+        skip, count = arg
+        start = skip if skip >= 0 else max(len(values) + skip, 0)
+        return values[start:start + count]
+    return values[:arg] if arg >= 0 else values[arg:]
+
+
+def _find_projection(doc, projection):
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    slices = {k: v['$slice'] for k, v in projection.items() if isinstance(v, dict) and '$slice' in v}
+    spec = {k: v for k, v in projection.items() if k not in slices}
+    include_id = spec.pop('_id', 1)
+    if any(spec.values()):
+        out = {}
+        if include_id and '_id' in doc:
+            out['_id'] = doc['_id']
+        for path in list(spec) + list(slices):
+            _copy_path(doc, out, path.split('.'))
+    else:
+        out = doc
+        for path in spec:
+            _unset_path(out, path)
+        if not include_id:
+            out.pop('_id', None)
+    for path, arg in slices.items():
+        value = _get_path(out, path)
+        if isinstance(value, list):
+            _set_path(out, path, _slice(value, arg))
+    return out
+
+
+# --- Aggregation expressions ------------------------------------------------
+
+def _bind(expr, variables):
+    """Substitute $$name / $$name.path references with literal values"""
+    if isinstance(expr, str) and expr.startswith('$$'):
+        name, *path = expr[2:].split('.')
+        if name in variables:
+            value = variables[name]
+            for part in path:
+                value = value.get(part) if isinstance(value, dict) else None
+            return {'$literal': value}
+        return expr
+    if isinstance(expr, list):
+        return [_bind(e, variables) for e in expr]
+    if isinstance(expr, dict):
+        return {k: _bind(v, variables) for k, v in expr.items()}
+    return expr
+
+
+def _eval(expr, doc):
+    if isinstance(expr, str) and expr.startswith('$') and not expr.startswith('$$'):
+        return _field(doc, expr[1:].split('.'))
+    if isinstance(expr, list):
+        return [_eval(e, doc) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1:
+        op, arg = next(iter(expr.items()))
+        if op.startswith('$'):
+            return _eval_operator(op, arg, doc)
+    return {k: _eval(v, doc) for k, v in expr.items()}
+
+
+def _value(v):
+    return None if v is _MISSING else v
+
+
+def _eval_operator(op, arg, doc):
+    if op == '$literal':
+        return arg
+    args = arg if isinstance(arg, list) else [arg]
+    if op == '$ifNull':
+        for a in args[:-1]:
+            value = _eval(a, doc)
+            if value is not None and value is not _MISSING:
+                return value
+        return _eval(args[-1], doc)
+    if op == '$map':
+        items = _value(_eval(arg['input'], doc))
+        if items is None:
+            return None
+        name = arg.get('as', 'this')
+        return [_value(_eval(_bind(arg['in'], {name: item}), doc)) for item in items]
+    if op == '$trim':
+        value = _value(_eval(arg['input'], doc))
+        return None if value is None else value.strip(arg.get('chars'))
+    if op == '$cond':
+        if isinstance(arg, dict):
+            args = [arg['if'], arg['then'], arg['else']]
+        return _eval(args[1] if _truthy(_eval(args[0], doc)) else args[2], doc)
+    if op == '$switch':
+        for branch in arg['branches']:
+            if _truthy(_eval(branch['case'], doc)):
+                return _eval(branch['then'], doc)
+        if 'default' not in arg:
+            raise OperationFailure("$switch could not find a matching branch for an input, and no default was specified.")
+        return _eval(arg['default'], doc)
+    values = [_value(_eval(a, doc)) for a in args]
+    if op == '$size':
+        if not isinstance(values[0], list):
+            raise OperationFailure("The argument to $size must be an array")
+        return len(values[0])
+    if op == '$slice':
+        return None if values[0] is None else _slice(values[0], values[1] if len(values) == 2 else values[1:])
+    if op == '$setUnion':
+        out, seen = [], set()
+        for value in values:
+            for item in value or []:
+                key = _hash_key(item)
+                if key not in seen:
+                    seen.add(key)
+                    out.append(item)
+        return out
+    if op == '$setDifference':
+        exclude = {_hash_key(item) for item in values[1] or []}
+        return _eval_operator('$setUnion', [{'$literal': [v for v in values[0] or [] if _hash_key(v) not in exclude]}], {})
+    if op == '$concatArrays':
+        return None if any(v is None for v in values) else [item for value in values for item in value]
+    if op == '$arrayElemAt':
+        array, index = values
+        return array[index] if array and -len(array) <= index < len(array) else _MISSING
+    if op == '$concat':
+        return None if any(v is None for v in values) else ''.join(values)
+    if op == '$toString':
+        return None if values[0] is None else str(values[0])
+    if op == '$toLower':
+        return (values[0] or '').lower()
+    if op == '$toUpper':
+        return (values[0] or '').upper()
+    if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        result = _compare(values[0], values[1])
+        if result is None:
+            result = (_type_key(values[0]) > _type_key(values[1])) - (_type_key(values[0]) < _type_key(values[1]))
+        return {'$eq': result == 0, '$ne': result != 0, '$gt': result > 0,
+                '$gte': result >= 0, '$lt': result < 0, '$lte': result <= 0}[op]
+    if op == '$in':
+        return any(_eq(values[0], v) for v in values[1] or [])
+    if op == '$and':
+        return all(_truthy(v) for v in values)
+    if op == '$or':
+        return any(_truthy(v) for v in values)
+    if op == '$not':
+        return not _truthy(values[0])
+    if op == '$add':
+        return sum(values)
+    if op == '$subtract':
+        return values[0] - values[1]
+    if op == '$multiply':
+        result = 1
+        for v in values:
+            result *= v
+        return result
+    if op == '$divide':
+        return values[0] / values[1]
+    if op in ('$max', '$min'):
+        items = values[0] if len(values) == 1 and isinstance(values[0], list) else values
+        items = [v for v in items if v is not None]
+        if not items:
+            return None
+        return (max if op == '$max' else min)(items, key=_type_key)
+    raise OperationFailure(f"Unsupported aggregation operator in local datastore: {op}")
+
+
+def _truthy(value):
+    return value not in (None, False, 0, _MISSING)
+
+
+def _project(doc, spec):
+    spec = dict(spec)
+    include_id = spec.pop('_id', 1)
+    computed = {k: v for k, v in spec.items() if v not in (0, 1, True, False)}
+    exclusion = all(v in (0, False) for v in spec.values()) if spec else include_id in (0, False)
+    if exclusion:
+        out = dict(doc)
+        for path in spec:
+            _unset_path(out, path)
+        if not include_id:
+            out.pop('_id', None)
+        return out
+    out = {}
+    if include_id in (1, True) and '_id' in doc:
+        out['_id'] = doc['_id']
+    elif include_id not in (0, False, 1, True):
+        out['_id'] = _value(_eval(include_id, doc))
+    for path, value in spec.items():
+        if path in computed:
+            result = _eval(value, doc)
+            if result is not _MISSING:
+                _set_path(out, path, result)
+        else:
+            _copy_path(doc, out, path.split('.'))
+    return out
+
+
+# --- Cursors ---------------------------------------------------------------
+
+class LocalCursor:
+    """Subset of pymongo.cursor.Cursor: sort/skip/limit/batch_size, evaluated on first iteration"""
+
+    def __init__(self, collection, filter=None, projection=None):
+        self._collection = collection
+        self._filter = filter or {}
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def _evaluate(self):
+        docs = self._collection._select(self._filter)
+        if self._sort:
+            _sort_docs(docs, self._sort)
+        docs = docs[self._skip:]
+        if self._limit:
+            docs = docs[:self._limit]
+        return iter([_find_projection(_copy(d), self._projection) for d in docs])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = self._evaluate()
+        return next(self._results)
+
+    next = __next__
+
+    def close(self):
+        self._results = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalCommandCursor:
+    """Iterator over precomputed aggregation results"""
+
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._docs)
+
+    next = __next__
+
+    def close(self):
+        self._docs = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# --- Collections -----------------------------------------------------------
+
+class LocalCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self._lock = database._lock
+        self._docs = None
+        self._indexes = None
+        self._last_ttl_sweep = 0
+
+    # Storage --------------------------------------------------------------
+
+    def _load(self):
+        self.database._check_external_writes()
+        if self._docs is None:
+            self._docs = {}
+            for body in self.database._load_bodies(self.name):
+                doc = json_util.loads(body, json_options=_JSON_OPTIONS)
+                self._docs[_id_key(doc['_id'])] = doc
+            self._indexes = self.database._load_indexes(self.name)
+        self._sweep_ttl()
+        return self._docs
+
+    def _invalidate(self):
+        self._docs = None
+        self._indexes = None
+
+    def _save(self, docs):
+        self.database._save_bodies(self.name, [
+            (_id_key(d['_id']), json_util.dumps(d, json_options=_JSON_OPTIONS)) for d in docs
+        ])
+
+    def _sweep_ttl(self):
+        now = time.monotonic()
+        if now - self._last_ttl_sweep < TTL_SWEEP_INTERVAL:
+            return
+        self._last_ttl_sweep = now
+        for index in self._indexes.values():
+            seconds = index.get('expireAfterSeconds')
+            if seconds is None:
+                continue
+            field = index['key'][0][0]
+            cutoff = time.time() - seconds
+            expired = []
+            for key, doc in self._docs.items():
+                value = _get_path(doc, field)
+                # Stored datetimes are naive UTC
+                if isinstance(value, datetime) and _naive_utc(value).replace(tzinfo=timezone.utc).timestamp() <= cutoff:
+                    expired.append(key)
+            if expired:
+                for key in expired:
+                    del self._docs[key]
+                self.database._delete_bodies(self.name, expired)
+
+    def _select(self, filter):
+        with self._lock:
+            docs = self._load()
+            if isinstance(filter, dict) and list(filter) == ['_id'] and not _is_operator_dict(filter['_id']):
+                doc = docs.get(_id_key(filter['_id']))
+                return [doc] if doc is not None else []
+            return [d for d in docs.values() if _match(d, filter)]
+
+    def _check_unique(self, doc, ignore_key=None):
+        for index in self._indexes.values():
+            if not index.get('unique'):
+                continue
+            partial = index.get('partialFilterExpression')
+            if partial and not _match(doc, partial):
+                continue
+            fields = [f for f, _ in index['key']]
+            values = [_value(_get_path(doc, f)) for f in fields]
+            for key, other in self._docs.items():
+                if key == ignore_key or (partial and not _match(other, partial)):
+                    continue
+                if all(_eq(_value(_get_path(other, f)), v) for f, v in zip(fields, values)):
+                    raise DuplicateKeyError(
+                        f"E11000 duplicate key error collection: {self.name} index: {index['name']}"
+                    )
+
+    # Reads ----------------------------------------------------------------
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0, session=None, **kwargs):
+        cursor = LocalCursor(self, filter, projection).skip(skip).limit(limit)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, filter=None, projection=None, *args, session=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(self.find(filter, projection, *args, limit=1, **kwargs), None)
+
+    def count_documents(self, filter, session=None, skip=0, limit=0, **kwargs):
+        docs = self._select(filter)[skip:]
+        return len(docs[:limit] if limit else docs)
+
+    def estimated_document_count(self, **kwargs):
+        with self._lock:
+            return len(self._load())
+
+    def distinct(self, key, filter=None, session=None, **kwargs):
+        out, seen = [], set()
+        for doc in self._select(filter or {}):
+            value = _field(doc, key.split('.'))
+            for item in (value if isinstance(value, list) else [value]):
+                if item is _MISSING:
+                    continue
+                marker = _hash_key(item)
+                if marker not in seen:
+                    seen.add(marker)
+                    out.append(_copy({'v': item})['v'])
+        return out
+
+    def aggregate(self, pipeline, session=None, **kwargs):
+        with self._lock:
+            docs = [_copy(d) for d in self._load().values()]
+            return LocalCommandCursor(self.database._run_pipeline(docs, pipeline))
+
+    # Writes ---------------------------------------------------------------
+
+    def insert_one(self, document, session=None, **kwargs):
+        with self._lock:
+            docs = self._load()
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+            doc = _copy(document)
+            key = _id_key(doc['_id'])
+            if key in docs:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+            self._check_unique(doc)
+            docs[key] = doc
+            self._save([doc])
+            return InsertOneResult(doc['_id'], True)
+
+    def insert_many(self, documents, ordered=True, session=None, **kwargs):
+        ids = [self.insert_one(document).inserted_id for document in documents]
+        return InsertManyResult(ids, True)
+
+    def _update(self, filter, update, upsert, multi):
+        with self._lock:
+            docs = self._load()
+            matches = [d for d in self._select(filter)]
+            if not multi:
+                matches = matches[:1]
+            modified = []
+            for doc in matches:
+                new_doc = _apply_update(_copy(doc), update, is_insert=False)
+                new_doc['_id'] = doc['_id']
+                if bson.encode(new_doc) != bson.encode(doc):
+                    key = _id_key(doc['_id'])
+                    self._check_unique(new_doc, ignore_key=key)
+                    docs[key] = _copy(new_doc)
+                    modified.append(docs[key])
+            if modified:
+                self._save(modified)
+            raw = {'n': len(matches), 'nModified': len(modified)}
+            if not matches and upsert:
+                seed = _upsert_seed(filter)
+                new_doc = _apply_update(seed, update, is_insert=True)
+                new_doc.setdefault('_id', ObjectId())
+                new_doc = _copy(new_doc)
+                self._check_unique(new_doc)
+                docs[_id_key(new_doc['_id'])] = new_doc
+                self._save([new_doc])
+                raw = {'n': 1, 'nModified': 0, 'upserted': new_doc['_id']}
+            return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert=False, session=None, **kwargs):
+        return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False, session=None, **kwargs):
+        return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False, session=None, **kwargs):
+        if any(k.startswith('$') for k in replacement):
+            raise ValueError("replacement can not include $ operators")
+        return self._update(filter, replacement, upsert, multi=False)
+
+    def _delete(self, filter, multi):
+        with self._lock:
+            docs = self._load()
+            matches = self._select(filter)
+            if not multi:
+                matches = matches[:1]
+            keys = [_id_key(d['_id']) for d in matches]
+            for key in keys:
+                del docs[key]
+            self.database._delete_bodies(self.name, keys)
+            return DeleteResult({'n': len(keys)}, True)
+
+    def delete_one(self, filter, session=None, **kwargs):
+        return self._delete(filter, multi=False)
+
+    def delete_many(self, filter, session=None, **kwargs):
+        return self._delete(filter, multi=True)
+
+    def drop(self, session=None, **kwargs):
+        with self._lock:
+            self.database._drop(self.name)
+            self._docs = {}
+            self._indexes = {}
+
+    # Indexes --------------------------------------------------------------
+
+    def create_index(self, keys, session=None, **kwargs):
+        """Indexes are not used for lookups; unique (optionally partial) and TTL (expireAfterSeconds) are enforced"""
+        key = _normalize_sort(keys, 1)
+        name = kwargs.get('name') or '_'.join(f"{f}_{d}" for f, d in key)
+        index = {'name': name, 'key': key}
+        if kwargs.get('unique'):
+            index['unique'] = True
+        if kwargs.get('partialFilterExpression'):
+            index['partialFilterExpression'] = kwargs['partialFilterExpression']
+        if kwargs.get('expireAfterSeconds') is not None:
+            index['expireAfterSeconds'] = kwargs['expireAfterSeconds']
+        with self._lock:
+            self._load()
+            if index.get('unique'):
+                seen = {}
+                for doc in self._docs.values():
+                    if index.get('partialFilterExpression') and not _match(doc, index['partialFilterExpression']):
+                        continue
+                    marker = _hash_key([_value(_get_path(doc, f)) for f, _ in key])
+                    if marker in seen:
+                        raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name}")
+                    seen[marker] = True
+            self._indexes[name] = index
+            self.database._save_index(self.name, index)
+        return name
+
+    def create_indexes(self, indexes, session=None, **kwargs):
+        return [self.create_index(i.document['key'], **{k: v for k, v in i.document.items() if k != 'key'})
+                for i in indexes]
+
+    def index_information(self):
+        with self._lock:
+            self._load()
+            info = {'_id_': {'key': [('_id', 1)]}}
+            for name, index in self._indexes.items():
+                info[name] = {k: v for k, v in index.items() if k != 'name'}
+            return info
+
+    def drop_index(self, name, session=None, **kwargs):
+        with self._lock:
+            self._load()
+            self._indexes.pop(name, None)
+            self.database._drop_index(self.name, name)
+
+
+def _upsert_seed(filter):
+    """Equality fields of an upsert filter become the new document's initial fields"""
+    seed = {}
+    for key, cond in (filter or {}).items():
+        if key == '$and':
+            for clause in cond:
+                seed.update(_upsert_seed(clause))
+        elif not key.startswith('$') and not _is_operator_dict(cond):
+            _set_path(seed, key, cond)
+        elif isinstance(cond, dict) and '$eq' in cond:
+            _set_path(seed, key, cond['$eq'])
+    return seed
+
+
+def _apply_update(doc, update, is_insert):
+    if not any(k.startswith('$') for k in update):
+        # Replacement document
+        return {'_id': doc['_id'], **update} if '_id' in doc else dict(update)
+    for op, fields in update.items():
+        if op == '$setOnInsert':
+            if not is_insert:
+                continue
+            op = '$set'
+        for path, arg in fields.items():
+            current = _get_path(doc, path)
+            if op == '$set':
+                _set_path(doc, path, arg)
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                _set_path(doc, path, (0 if current is _MISSING else current) + arg)
+            elif op in ('$min', '$max'):
+                if current is _MISSING or (_compare(arg, current) or 0) == (-1 if op == '$min' else 1):
+                    _set_path(doc, path, arg)
+            elif op in ('$push', '$addToSet'):
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                array = [] if current is _MISSING else current
+                if not isinstance(array, list):
+                    raise OperationFailure(f"The field '{path}' must be an array")
+                for item in items:
+                    if op == '$push' or not any(_eq(item, existing) for existing in array):
+                        array.append(item)
+                if op == '$push' and isinstance(arg, dict) and '$slice' in arg:
+                    array = _slice(array, arg['$slice'])
+                _set_path(doc, path, array)
+            elif op == '$pull':
+                if isinstance(current, list):
+                    def pulled(item):
+                        if _is_operator_dict(arg):
+                            return _match_condition([item], arg)
+                        if isinstance(arg, dict) and isinstance(item, dict):
+                            return _match(item, arg)
+                        return _eq(item, arg)
+                    _set_path(doc, path, [item for item in current if not pulled(item)])
+            else:
+                raise OperationFailure(f"Unsupported update operator in local datastore: {op}")
+    return doc
+
+
+# --- Databases and client ---------------------------------------------------
+
+class LocalDatabase:
+    def __init__(self, name, path=None):
+        self.name = name
+        self._path = path
+        self._lock = threading.RLock()
+        self._collections = {}
+        self._conn = None
+        self._data_version = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # One file holds one database; writes commit per operation via `with self._conn`
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS documents ("
+                    "collection TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, "
+                    "PRIMARY KEY (collection, id))"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS indexes ("
+                    "collection TEXT NOT NULL, name TEXT NOT NULL, spec TEXT NOT NULL, "
+                    "PRIMARY KEY (collection, name))"
+                )
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = LocalCollection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def list_collection_names(self, **kwargs):
+        with self._lock:
+            names = {name for name, c in self._collections.items() if c._docs}
+            if self._conn is not None:
+                names.update(row[0] for row in self._conn.execute("SELECT DISTINCT collection FROM documents"))
+            return sorted(names)
+
+    def drop_collection(self, name, **kwargs):
+        self[name].drop()
+
+    def command(self, command, *args, **kwargs):
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == 'ping':
+            return {'ok': 1.0}
+        if name in ('hello', 'isMaster', 'ismaster'):
+            # No setName: supports_transactions() reports False
+            return {'isWritablePrimary': True, 'ismaster': True, 'ok': 1.0}
+        raise OperationFailure(f"Unsupported command in local datastore: {name}")
+
+    # SQLite persistence ---------------------------------------------------
+
+    def _check_external_writes(self):
+        """Drop cached collections when another connection has committed since we last looked"""
+        if self._conn is None:
+            return
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and version != self._data_version:
+            for collection in self._collections.values():
+                collection._invalidate()
+        self._data_version = version
+
+    def _load_bodies(self, collection):
+        if self._conn is None:
+            return []
+        rows = self._conn.execute(
+            "SELECT body FROM documents WHERE collection = ? ORDER BY rowid", (collection,)
+        )
+        return [row[0] for row in rows]
+
+    def _load_indexes(self, collection):
+        if self._conn is None:
+            return {}
+        rows = self._conn.execute("SELECT name, spec FROM indexes WHERE collection = ?", (collection,))
+        indexes = {}
+        for name, spec in rows:
+            index = json_util.loads(spec)
+            index['key'] = [tuple(k) for k in index['key']]
+            indexes[name] = index
+        return indexes
+
+    def _save_bodies(self, collection, rows):
+        if self._conn is None or not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO documents (collection, id, body) VALUES (?, ?, ?) "
+                "ON CONFLICT(collection, id) DO UPDATE SET body = excluded.body",
+                [(collection, key, body) for key, body in rows]
+            )
+
+    def _delete_bodies(self, collection, keys):
+        if self._conn is None or not keys:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM documents WHERE collection = ? AND id = ?",
+                [(collection, key) for key in keys]
+            )
+
+    def _save_index(self, collection, index):
+        if self._conn is None:
+            return
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO indexes (collection, name, spec) VALUES (?, ?, ?)",
+                (collection, index['name'], json_util.dumps(index))
+            )
+
+    def _drop_index(self, collection, name):
+        if self._conn is None:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM indexes WHERE collection = ? AND name = ?", (collection, name))
+
+    def _drop(self, collection):
+        if self._conn is None:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM documents WHERE collection = ?", (collection,))
+            self._conn.execute("DELETE FROM indexes WHERE collection = ?", (collection,))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # Aggregation ----------------------------------------------------------
+
+    def _run_pipeline(self, docs, pipeline):
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == '$match':
+                docs = [d for d in docs if _match(d, spec)]
+            elif name == '$sort':
+                docs = _sort_docs(docs, _normalize_sort(spec))
+            elif name == '$skip':
+                docs = docs[spec:]
+            elif name == '$limit':
+                docs = docs[:spec]
+            elif name == '$project':
+                docs = [_project(d, spec) for d in docs]
+            elif name in ('$addFields', '$set'):
+                for d in docs:
+                    for path, expr in spec.items():
+                        value = _eval(expr, d)
+                        if value is not _MISSING:
+                            _set_path(d, path, value)
+            elif name == '$unset':
+                for d in docs:
+                    for path in ([spec] if isinstance(spec, str) else spec):
+                        _unset_path(d, path)
+            elif name == '$replaceRoot':
+                docs = [_eval(spec['newRoot'], d) for d in docs]
+            elif name == '$unwind':
+                docs = self._unwind(docs, spec)
+            elif name == '$group':
+                docs = self._group(docs, spec)
+            elif name == '$count':
+                docs = [{spec: len(docs)}]
+            elif name == '$lookup':
+                docs = self._lookup(docs, spec)
+            elif name == '$unionWith':
+                spec = {'coll': spec} if isinstance(spec, str) else spec
+                other = [_copy(d) for d in self[spec['coll']]._select({})]
+                docs = docs + self._run_pipeline(other, spec.get('pipeline', []))
+            else:
+                raise OperationFailure(f"Unsupported aggregation stage in local datastore: {name}")
+        return docs
+
+    def _unwind(self, docs, spec):
+        spec = {'path': spec} if isinstance(spec, str) else spec
+        path = spec['path'][1:]
+        keep_empty = spec.get('preserveNullAndEmptyArrays', False)
+        out = []
+        for d in docs:
+            value = _get_path(d, path)
+            if isinstance(value, list) and value:
+                for item in value:
+                    copy = _copy(d)
+                    _set_path(copy, path, item)
+                    out.append(copy)
+            elif keep_empty:
+                out.append(d)
+            elif value is not _MISSING and value is not None and not isinstance(value, list):
+                out.append(d)
+        return out
+
+    def _group(self, docs, spec):
+        spec = dict(spec)
+        id_expr = spec.pop('_id')
+        groups = {}
+        for d in docs:
+            group_id = _value(_eval(id_expr, d))
+            key = _hash_key(group_id)
+            if key not in groups:
+                groups[key] = ({'_id': group_id}, [])
+            groups[key][1].append(d)
+        out = []
+        for result, members in groups.values():
+            for field, accumulator in spec.items():
+                (op, expr), = accumulator.items()
+                values = [_eval(expr, m) for m in members]
+                present = [v for v in values if v is not _MISSING]
+                numbers = [v for v in present if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                if op == '$sum':
+                    result[field] = sum(numbers)
+                elif op == '$avg':
+                    result[field] = sum(numbers) / len(numbers) if numbers else None
+                elif op in ('$min', '$max'):
+                    candidates = [v for v in present if v is not None]
+                    result[field] = (min if op == '$min' else max)(candidates, key=_type_key) if candidates else None
+                elif op == '$first':
+                    result[field] = _value(values[0]) if values else None
+                elif op == '$last':
+                    result[field] = _value(values[-1]) if values else None
+                elif op == '$push':
+                    result[field] = present
+                elif op == '$addToSet':
+                    result[field] = _eval_operator('$setUnion', [{'$literal': present}], {})
+                else:
+                    raise OperationFailure(f"Unsupported accumulator in local datastore: {op}")
+            out.append(result)
+        return out
+
+    def _lookup(self, docs, spec):
+        foreign = [_copy(d) for d in self[spec['from']]._select({})]
+        for d in docs:
+            pipeline = spec.get('pipeline', [])
+            if 'let' in spec:
+                pipeline = _bind(pipeline, {name: _value(_eval(expr, d)) for name, expr in spec['let'].items()})
+            if 'localField' in spec:
+                local = _field(d, spec['localField'].split('.'))
+                local = [None] if local is _MISSING else (local if isinstance(local, list) else [local])
+                foreign_path = spec['foreignField'].split('.')
+                matched = [
+                    _copy(f) for f in foreign
+                    if any(_equals_any(_query_values(f, foreign_path), value) for value in local)
+                ]
+            else:
+                matched = [_copy(f) for f in foreign]
+            _set_path(d, spec['as'], self._run_pipeline(matched, pipeline))
+        return docs
+
+
+class _LocalAdmin:
+    def __init__(self, client):
+        self._client = client
+
+    def command(self, command, *args, **kwargs):
+        return self._client._default_database().command(command, *args, **kwargs)
+
+
+class LocalClient:
+    """Stands in for MongoClient when MONGO_URI is sqlite:// or memory://"""
+
+    def __init__(self, uri):
+        self._uri = uri
+        self._databases = {}
+        self.admin = _LocalAdmin(self)
+
+    def _open(self, name):
+        if self._uri.startswith('memory://'):
+            with _memory_databases_lock:
+                if name not in _memory_databases:
+                    _memory_databases[name] = LocalDatabase(name)
+                return _memory_databases[name]
+        # sqlite:///relative/path.db or sqlite:////absolute/path.db
+        path = self._uri[len('sqlite:///'):] or 'data/local_store.db'
+        return LocalDatabase(name, path)
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = self._open(name)
+        return self._databases[name]
+
+    def get_database(self, name=None, **kwargs):
+        return self[name or 'vois_ckd']
+
+    def _default_database(self):
+        return self[next(iter(self._databases), 'vois_ckd')]
+
+    def start_session(self, **kwargs):
+        raise OperationFailure("Sessions and transactions are not supported by the local datastore")
+
+    def close(self):
+        if self._uri.startswith('memory://'):
+            return
+        for database in self._databases.values():
+            database.close()
+        self._databases = {}
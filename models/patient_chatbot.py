@@ -5,15 +5,34 @@ Provides 24/7 support for basic inquiries about CKD stages, symptoms, and medica
 
 import os
 import json
-from datetime import datetime
+import threading
 from models.ai_recommender import CKDAIRecommender
+from models.conversation_store import get_conversation_store
+from models.answer_cache import get_answer_cache, patient_signature
+from models import rag_warmup
 
 class PatientEducationChatbot:
+    """
+    Long-lived chatbot shared by every request in the process (see get_patient_chatbot).
+    The Gemini model and RAG engine are set up once; conversation history lives in the
+    per-user, per-session conversation store.
+    """
     def __init__(self):
         self.recommender = CKDAIRecommender()
-        self.conversation_history = []
+        self.conversations = get_conversation_store()
+        self.answer_cache = get_answer_cache()
+        self.knowledge_base = self._load_knowledge_base()
+        self.rag_engine = None
+        self.rag_enabled = False
         
-        # Initialize RAG Engine
+        # With RAG_WARMUP the engine loads on a background thread; answer from the
+        # fallback until it is ready instead of stalling this request
+        self._warming_up = rag_warmup.start()
+        if not self._warming_up:
+            self._init_rag_engine()
+    
+    def _init_rag_engine(self):
+        """Initialize RAG Engine"""
         try:
             from models.rag_engine import get_rag_engine
             self.rag_engine = get_rag_engine()
@@ -22,7 +41,7 @@ class PatientEducationChatbot:
             # This is a simplified check; in prod you might want a more robust one
             # or an admin trigger for ingestion.
             # For this demo, we'll try to ingest if we can't find anything.
-            if self.rag_engine.vector_store._collection.count() == 0:
+            if self.rag_engine.vector_store.count() == 0:
                 print("Retrieval database empty. Ingesting documents...")
                 self.rag_engine.ingest_documents()
                 
@@ -30,7 +49,6 @@ class PatientEducationChatbot:
         except Exception as e:
             print(f"Failed to initialize RAG engine: {e}")
             self.rag_enabled = False
-            self.knowledge_base = self._load_knowledge_base() # Fallback
     
     def _load_knowledge_base(self):
         """Load the knowledge base for common CKD questions (Fallback)"""
@@ -73,50 +91,81 @@ class PatientEducationChatbot:
         name = patient_name if patient_name else "Patient"
         return f"Hello {name}! 👋 I'm your KidneyCompanion assistant, now powered by AI. I can answer your questions about CKD based on the latest medical guidelines and your specific health data. How can I help you today?"
     
-    def process_message(self, message, patient_data=None):
+    def process_message(self, message, patient_data=None, user_id=None, session_id=None):
         """Process a patient message and generate an appropriate response"""
-        # Add message to conversation history
-        self.conversation_history.append({
-            "role": "patient",
-            "message": message,
-            "timestamp": datetime.now().isoformat()
-        })
+        # Earlier turns for the prompt, read before this message is added
+        history = self.conversations.recent(user_id, session_id)
+        self.conversations.append(user_id, session_id, "patient", message)
+        
+        # Pick up the engine once background warm-up has finished; one request does the handoff.
+        # A failed warm-up is not retried inline: the chatbot stays on the rule-based fallback.
+        if self._warming_up and rag_warmup.state() in ('ready', 'failed'):
+            with _chatbot_lock:
+                if self._warming_up:
+                    if rag_warmup.ready():
+                        self._init_rag_engine()
+                    else:
+                        print("RAG warm-up failed; using the rule-based fallback")
+                    self._warming_up = False
         
         # Generate response
         try:
             if self.rag_enabled:
-                response = self._generate_rag_response(message, patient_data)
+                response = self._generate_rag_response(message, patient_data, history)
             else:
-                # Fallback to rule-based if RAG is broken
+                # Fallback to rule-based if RAG is broken or still warming up
                 response = self._generate_fallback_response(message.lower(), patient_data)
         except Exception as e:
             print(f"Error generating response: {e}")
             response = "I apologize, but I'm having trouble retrieving information right now. Please try again later."
             
         # Add response to conversation history
-        self.conversation_history.append({
-            "role": "assistant",
-            "message": response,
-            "timestamp": datetime.now().isoformat()
-        })
+        self.conversations.append(user_id, session_id, "assistant", response)
         
         return response
     
-    def _generate_rag_response(self, message, patient_data=None):
+    def _generate_rag_response(self, message, patient_data=None, history=None):
         """Generate a response using RAG and Gemini"""
         
-        # 1. Retrieve Context
+        # 1. Retrieve Context. First questions are answer-cache candidates, so retrieval also
+        # returns their (query-cached) embedding, even on the keyword-only fast path.
+        # Follow-ups (with conversation history) depend on context, so they always generate.
         context = "No specific medical documents found."
+        query_vector = None
+        wants_cache = self.answer_cache.enabled and not history
         try:
-            retrieved_docs = self.rag_engine.search(message, k=3)
+            retrieved_docs, query_vector = self.rag_engine.search_with_vector(message, k=3, embed=wants_cache)
             if retrieved_docs:
                 context = "\n\n".join(retrieved_docs)
         except Exception as e:
             print(f"RAG Search failed: {e}")
+        
+        # 2. Semantic answer cache: a near-identical question answered for the same clinical bucket
+        signature = patient_signature(patient_data)
+        cacheable = wants_cache and query_vector is not None
+        if cacheable:
+            try:
+                cached = self.answer_cache.lookup(query_vector, signature)
+                if cached is not None:
+                    return cached
+            except Exception as e:
+                print(f"Answer cache lookup failed: {e}")
+                cacheable = False
             
-        # 2. Format Patient Data
+        # 3. Format Patient Data. A cacheable answer is shared across the bucket, so its
+        # prompt carries only the bucket (the signature), never the patient's exact values.
         patient_context = "Patient Data: Not available."
-        if patient_data:
+        if patient_data and cacheable:
+            stage, egfr_band, potassium_band, age_range, symptoms = signature
+            patient_context = f"""
+            Patient Profile (ranges only):
+            - Age range: {age_range}
+            - CKD Stage: {stage}
+            - eGFR category (KDIGO): {egfr_band}
+            - Potassium: {potassium_band}
+            - Symptoms: {symptoms.replace(',', ', ') or 'None reported'}
+            """
+        elif patient_data:
             # Anonymize/simplify for the prompt
             p = patient_data
             patient_context = f"""
@@ -129,7 +178,14 @@ class PatientEducationChatbot:
             - Symptoms: {', '.join([k for k,v in p.get('symptoms', {}).items() if v]) or 'None reported'}
             """
             
-        # 3. Construct Prompt
+        # 4. Recent conversation (already trimmed to the store's turn and token budget)
+        conversation_context = "Recent Conversation: None."
+        if history:
+            conversation_context = "Recent Conversation:\n" + "\n".join(
+                f"- {'Patient' if turn['role'] == 'patient' else 'Assistant'}: {turn['message']}" for turn in history
+            )
+            
+        # 5. Construct Prompt
         prompt = f"""
 You are KidneyCompanion, a helpful and empathetic medical assistant for CKD patients.
 Use the following context and patient data to answer the user's question.
@@ -139,6 +195,8 @@ CONTEXT FROM KNOWLEDGE BASE:
 
 {patient_context}
 
+{conversation_context}
+
 USER QUESTION:
 {message}
 
@@ -153,9 +211,11 @@ INSTRUCTIONS:
 ANSWER:
 """
         
-        # 4. Generate with Gemini
+        # 6. Generate with Gemini
         try:
             response = self.recommender.model.generate_content(prompt)
+            if cacheable:
+                self.answer_cache.store(query_vector, signature, response.text)
             return response.text
         except Exception as e:
             print(f"Gemini generation failed: {e}")
@@ -214,16 +274,26 @@ ANSWER:
                "• Diet and lifestyle recommendations\n\n" + \
                "What would you like to know more about?"
     
-    def get_conversation_history(self):
-        """Return the conversation history"""
-        return self.conversation_history
+    def get_conversation_history(self, user_id=None, session_id=None):
+        """Return the conversation history for a user's session"""
+        return self.conversations.history(user_id, session_id)
     
-    def reset_conversation(self):
-        """Reset the conversation history"""
-        self.conversation_history = []
+    def reset_conversation(self, user_id=None, session_id=None):
+        """Reset the conversation history for a user's session"""
+        self.conversations.reset(user_id, session_id)
         return "Conversation reset. How can I help you today?"
 
+# Singleton instance
+_chatbot_instance = None
+_chatbot_lock = threading.Lock()
+
 # Factory function for easy import
 def get_patient_chatbot():
-    """Factory function to create patient chatbot instance"""
-    return PatientEducationChatbot()
\ No newline at end of file
+    """Factory function to get or create the process-wide patient chatbot"""
+    global _chatbot_instance
+    if _chatbot_instance is None:
+        with _chatbot_lock:
+            # A failed construction (e.g. no GEMINI_API_KEY) is not cached, so the next call retries
+            if _chatbot_instance is None:
+                _chatbot_instance = PatientEducationChatbot()
+    return _chatbot_instance
\ No newline at end of file
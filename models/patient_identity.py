@@ -0,0 +1,149 @@
+"""
+Patient Identity Resolver for CKD Diagnostic System
+Maps any patient identifier used across the app (patient_id, P<userid>, username
+or a raw ObjectId) to one canonical identity, cached in-process. One indexed query per
+collection, so it runs on any MongoDB the app supports (no $unionWith)
+"""
+
+import os
+import threading
+import time
+from bson.objectid import ObjectId
+from models.database import Database
+
+PATIENT_IDENTITY_TTL = int(os.environ.get('PATIENT_IDENTITY_TTL', 300))
+PATIENT_IDENTITY_MAX_ENTRIES = 4096
+
+# identifier -> (expires_at, identity)
+_identity_cache = {}
+_identity_cache_lock = threading.Lock()
+
+
+def _candidates(identifier):
+    """
+    Forms an identifier may be stored under: `names` for username/patient_id, `ids` for
+    patient_id only and `object_ids` for _id. A leading "P" is stripped only when the rest
+    is an ObjectId, so "P..." usernames are never matched by their tail.
+    """
+    ids = [identifier]
+    if identifier.startswith('P') and ObjectId.is_valid(identifier[1:]):
+        ids.append(identifier[1:])
+    object_ids = [ObjectId(s) for s in ids if ObjectId.is_valid(s)]
+    return [identifier], ids, object_ids
+
+
+def _pick(docs, identifier, object_ids):
+    """
+    Choose the best match per collection: exact username/patient_id, then exact _id, then
+    derived forms, then a username differing only in case
+    """
+    exact_id = ObjectId(identifier) if ObjectId.is_valid(identifier) else None
+
+    def rank(doc):
+        if doc.get('username') == identifier or doc.get('patient_id') == identifier:
+            return 0
+        if exact_id and doc['_id'] == exact_id:
+            return 1
+        if doc['_id'] in object_ids:
+            return 2
+        return 3
+    return min(docs, key=rank) if docs else None
+
+
+def resolve_patient_identity(identifier):
+    """
+    Resolve a patient identifier to
+    {'username', 'user_id', 'patient_id', 'patients_data_id', 'email'} or None.
+    Looks in users, patients_data and patient_records. Usernames match on the normalized
+    username_key where the collection stores one (users, patient_records).
+    """
+    if not identifier:
+        return None
+    identifier = str(identifier)
+
+    now = time.monotonic()
+    with _identity_cache_lock:
+        entry = _identity_cache.get(identifier)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    try:
+        db = Database.get_db()
+        if db is None:
+            return None
+        # Imported here: models.user imports this module
+        from models.user import username_key
+        names, ids, object_ids = _candidates(identifier)
+        by_name = [{'username': {'$in': names}}, {'username_key': username_key(identifier)}]
+        user = _pick(list(db.users.find(
+            {'role': 'patient', '$or': [{'_id': {'$in': object_ids}}, *by_name]},
+            {'username': 1, 'email': 1}
+        ).limit(5)), identifier, object_ids)
+        # patients_data has no username_key, so names match as stored there
+        patient_data = _pick(list(db.patients_data.find(
+            {'$or': [{'_id': {'$in': object_ids}}, {'patient_id': {'$in': ids}}, {'username': {'$in': names}}]},
+            {'username': 1, 'patient_id': 1}
+        ).limit(5)), identifier, object_ids)
+        record = _pick(list(db.patient_records.find(
+            {'$or': [{'patient_id': {'$in': ids}}, *by_name]},
+            {'username': 1, 'patient_id': 1}
+        ).limit(5)), identifier, object_ids)
+    except Exception as e:
+        print(f"Error resolving patient identity {identifier}: {e}")
+        return None
+
+    if not (user or patient_data or record):
+        return None
+
+    username = next((d.get('username') for d in (patient_data, user, record) if d and d.get('username')), None)
+    if user:
+        patient_id = f"P{user['_id']}"
+    else:
+        patient_id = next((d.get('patient_id') for d in (patient_data, record) if d and d.get('patient_id')), identifier)
+
+    identity = {
+        'username': username,
+        'user_id': str(user['_id']) if user else None,
+        'patient_id': patient_id,
+        'patients_data_id': patient_data['_id'] if patient_data else None,
+        'email': user.get('email') if user else None
+    }
+    with _identity_cache_lock:
+        if len(_identity_cache) >= PATIENT_IDENTITY_MAX_ENTRIES:
+            _identity_cache.pop(next(iter(_identity_cache)))
+        _identity_cache[identifier] = (now + PATIENT_IDENTITY_TTL, identity)
+    return identity
+
+
+def identity_keys(identity, identifier=None):
+    """Every string/ObjectId form of a resolved patient, for querying legacy collections"""
+    keys = set()
+    for value in (identifier, identity.get('username'), identity.get('user_id'),
+                  identity.get('patient_id'), identity.get('patients_data_id')):
+        if value is None:
+            continue
+        keys.add(str(value))
+        if ObjectId.is_valid(str(value)):
+            keys.add(ObjectId(str(value)))
+    patient_id = identity.get('patient_id') or ''
+    if patient_id.startswith('P') and ObjectId.is_valid(patient_id[1:]):
+        keys.add(patient_id[1:])
+        keys.add(ObjectId(patient_id[1:]))
+    return list(keys)
+
+
+def invalidate_patient_identity(*identifiers):
+    """
+    Drop cached identities looked up by, or resolving to, any of these identifiers
+    (username, patient_id, ...); with no arguments clears the whole cache
+    """
+    with _identity_cache_lock:
+        if not identifiers:
+            _identity_cache.clear()
+            return
+        targets = {str(i) for i in identifiers if i is not None}
+        stale = [key for key, (_, identity) in _identity_cache.items()
+                 if key in targets or identity.get('username') in targets
+                 or identity.get('patient_id') in targets]
+        for key in stale:
+            del _identity_cache[key]
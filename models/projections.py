@@ -0,0 +1,20 @@
+"""
+Field projections for the hot read paths of CKD Diagnostic System
+Shared by the routes that use them and by benchmarks/projection_bytes.py, which
+measures the bytes each one saves
+"""
+
+# Chatbot welcome message: only the patient's name
+PATIENT_NAME_FIELDS = {'_id': 0, 'name': 1}
+
+# patient_records fields the chatbot prompt's patient profile uses
+PATIENT_PROFILE_FIELDS = {'_id': 0, 'age': 1, 'stage': 1, 'egfr': 1, 'serum_creatinine': 1, 'potassium': 1, 'symptoms': 1}
+
+# /api/patient-trends: the lab values charted over time
+PATIENT_TRENDS_FIELDS = {
+    '_id': 0, 'history.date': 1, 'history.serum_creatinine': 1, 'history.egfr': 1,
+    'history.blood_urea': 1, 'history.hemoglobin': 1
+}
+
+# /api/doctor/dashboard/stats: risk and stage counters
+DASHBOARD_STATS_FIELDS = {'_id': 0, 'risk_level': 1, 'stage': 1, 'risk_percentage': 1}
@@ -5,108 +5,367 @@ Handles document ingestion, vector storage, and semantic retrieval
 
 import os
 import glob
-from typing import List, Dict, Any
+import json
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Optional, Tuple
 import google.generativeai as genai
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import FastEmbedEmbeddings
+from models.embedding_cache import CachedQueryEmbeddings
+from models.bm25_index import BM25Index, reciprocal_rank_fusion, tokenize
+from models.vector_backends import create_backend, RAG_VECTOR_BACKEND, DEFAULT_PERSIST_DIRECTORIES
 from dotenv import load_dotenv
 
 load_dotenv()
 
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+CHUNK_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+# Processes loading and splitting documents during ingestion (0 = up to 4, 1 = no pool)
+RAG_INGEST_WORKERS = int(os.environ.get('RAG_INGEST_WORKERS', 0))
+# Chunks embedded and written to the vector store per call
+RAG_EMBED_BATCH_SIZE = int(os.environ.get('RAG_EMBED_BATCH_SIZE', 64))
+# 'hybrid' fuses BM25 and vector results; 'vector' is similarity search only
+RAG_RETRIEVAL_MODE = os.environ.get('RAG_RETRIEVAL_MODE', 'hybrid').lower()
+# Queries with at most this many keywords are answered from BM25 alone when it has matches
+RAG_LEXICAL_MAX_TERMS = int(os.environ.get('RAG_LEXICAL_MAX_TERMS', 3))
+RRF_K = 60
+
+def _load_and_split(path, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Load one file and split it into chunks (runs in an ingestion worker process)"""
+    loader = PyPDFLoader(path) if path.lower().endswith(".pdf") else TextLoader(path)
+    documents = loader.load()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=CHUNK_SEPARATORS
+    )
+    splits = text_splitter.split_documents(documents)
+    return len(documents), [(doc.page_content, doc.metadata) for doc in splits]
+
+def _iter_loaded(paths, workers, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """
+    Yield (path, pages, chunks, error) as files finish loading. With a process pool at
+    most 2 * workers files are in flight, so loaded-but-unwritten chunks stay bounded.
+    Workers are spawned, not forked: ingestion can run inside the multithreaded web
+    process, and a forked child could inherit a lock some other thread was holding.
+    """
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            try:
+                yield (path, *_load_and_split(path, chunk_size, chunk_overlap), None)
+            except Exception as e:
+                yield path, 0, [], e
+        return
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        remaining = iter(paths)
+        in_flight = {}
+        
+        def submit_next():
+            path = next(remaining, None)
+            if path is not None:
+                in_flight[pool.submit(_load_and_split, path, chunk_size, chunk_overlap)] = path
+        
+        for _ in range(workers * 2):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = in_flight.pop(future)
+                submit_next()
+                try:
+                    yield (path, *future.result(), None)
+                except Exception as e:
+                    yield path, 0, [], e
+
 class RAGEngine:
-    def __init__(self, persist_directory="data/chroma_db", knowledge_dir="data/medical_knowledge"):
-        self.persist_directory = persist_directory
+    def __init__(self, persist_directory=None, knowledge_dir="data/medical_knowledge", backend=None,
+                 chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, retrieval_mode=None):
+        # Each backend keeps its own directory (index, ingest manifest, keyword index)
+        self.backend = (backend or RAG_VECTOR_BACKEND).lower()
+        self.persist_directory = persist_directory or DEFAULT_PERSIST_DIRECTORIES.get(self.backend, "data/chroma_db")
         self.knowledge_dir = knowledge_dir
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.retrieval_mode = (retrieval_mode or RAG_RETRIEVAL_MODE).lower()
         self.api_key = os.getenv('GEMINI_API_KEY')
         
         # Initialize Embeddings
         # Switching to FastEmbed to avoid PyTorch hangs on Windows
         # This uses ONNX Runtime which is lighter and faster
-        self.embeddings = FastEmbedEmbeddings()
+        # Query embeddings are cached, so repeated questions skip the model
+        self.embeddings = CachedQueryEmbeddings(FastEmbedEmbeddings())
         
         # Initialize Vector Store
         self._init_vector_store()
         
+        # Keyword index over the same chunks
+        self.bm25 = BM25Index(os.path.join(self.persist_directory, "bm25_index.json"))
+        if not len(self.bm25) and self._load_manifest():
+            self._rebuild_bm25()
+        self.search_stats = {"lexical": 0, "hybrid": 0, "vector": 0}
+        
     def _init_vector_store(self):
-        """Initialize or load the ChromaDB vector store"""
-        if os.path.exists(self.persist_directory):
-            self.vector_store = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings
-            )
-        else:
-            # Create empty if not exists, will be populated on ingest
-            self.vector_store = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=self.embeddings
-            )
+        """Initialize or load the configured vector store (created empty, populated on ingest)"""
+        self.vector_store = create_backend(self.backend, self.persist_directory, self.embeddings)
             
+    def _manifest_path(self):
+        return os.path.join(self.persist_directory, "ingest_manifest.json")
+    
+    def _load_manifest(self):
+        """Ingested files: relative path -> content hash and chunk ids (None before the first run)"""
+        try:
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _save_manifest(self, manifest):
+        os.makedirs(self.persist_directory, exist_ok=True)
+        tmp = self._manifest_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, self._manifest_path())
+    
+    @staticmethod
+    def _file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _chunk_ids(source, texts):
+        """
+        Deterministic ids from the file and chunk text, so an unchanged chunk keeps its id
+        when other parts of the file change (repeated text gets an occurrence number)
+        """
+        seen = {}
+        ids = []
+        for text in texts:
+            occurrence = seen.get(text, 0)
+            seen[text] = occurrence + 1
+            key = f"{source}\n{occurrence}\n{text}"
+            ids.append(hashlib.sha256(key.encode("utf-8")).hexdigest()[:32])
+        return ids
+    
+    def _rebuild_bm25(self):
+        """Index chunks ingested before the keyword index existed"""
+        ids, texts = self.vector_store.get_all()
+        self.bm25.add(ids, texts)
+        self.bm25.save()
+        print(f"Built keyword index over {len(self.bm25)} chunks.")
+    
+    def _drop_untracked_chunks(self):
+        """Chunks added before the manifest existed have random ids; clear them once"""
+        existing, _ = self.vector_store.get_all()
+        if existing:
+            self.vector_store.delete(existing)
+            self.bm25.clear()
+            print(f"Removed {len(existing)} chunks ingested without a manifest.")
+        
     def ingest_documents(self):
-        """Load and process all documents from the knowledge directory"""
-        documents = []
+        """
+        Bring the vector store in line with the knowledge directory.
+        Only new or changed files are loaded and embedded; chunks of removed files and
+        chunks no longer present in changed files are deleted. Safe to run repeatedly.
+        Files are loaded and split in a process pool; chunks are embedded and written in
+        batches of RAG_EMBED_BATCH_SIZE as files complete.
+        Returns ingestion counts and throughput, or False when there is nothing to ingest.
+        """
+        manifest = self._load_manifest()
+        if manifest is None:
+            manifest = {"files": {}}
+            self._drop_untracked_chunks()
         
-        # Load PDFs
-        pdf_files = glob.glob(os.path.join(self.knowledge_dir, "*.pdf"))
-        for pdf_path in pdf_files:
-            try:
-                loader = PyPDFLoader(pdf_path)
-                documents.extend(loader.load())
-                print(f"Loaded PDF: {pdf_path}")
-            except Exception as e:
-                print(f"Error loading PDF {pdf_path}: {e}")
-                
-        # Load Text Files
-        txt_files = glob.glob(os.path.join(self.knowledge_dir, "*.txt"))
-        for txt_path in txt_files:
-            try:
-                loader = TextLoader(txt_path)
-                documents.extend(loader.load())
-                print(f"Loaded Text: {txt_path}")
-            except Exception as e:
-                print(f"Error loading Text {txt_path}: {e}")
-                
-        if not documents:
+        paths = sorted(glob.glob(os.path.join(self.knowledge_dir, "*.pdf")) +
+                       glob.glob(os.path.join(self.knowledge_dir, "*.txt")))
+        if not paths and not manifest["files"]:
             print("No documents found to ingest.")
             return False
+        
+        start = time.perf_counter()
+        workers = RAG_INGEST_WORKERS or min(4, os.cpu_count() or 1)
+        stats = {"files_unchanged": 0, "files_ingested": 0, "files_removed": 0,
+                 "chunks_skipped": 0, "chunks_embedded": 0, "chunks_deleted": 0,
+                 "pages": 0, "batches": 0}
+        files = {}
+        
+        # Only new or changed files are loaded; a chunking change re-splits everything
+        # (entries written before chunking was recorded used the defaults)
+        chunking = [self.chunk_size, self.chunk_overlap]
+        to_load = {}
+        for path in paths:
+            source = os.path.relpath(path, self.knowledge_dir)
+            digest = self._file_hash(path)
+            previous = manifest["files"].get(source)
+            if (previous and previous["sha256"] == digest and
+                    previous.get("chunking", [CHUNK_SIZE, CHUNK_OVERLAP]) == chunking):
+                files[source] = previous
+                stats["files_unchanged"] += 1
+                stats["chunks_skipped"] += len(previous["chunk_ids"])
+            else:
+                to_load[path] = (source, digest, previous)
+        
+        batch = []  # (source, chunk id, text, metadata) waiting to be embedded
+        unwritten = {}  # source -> [manifest entry, chunks not yet written]
+        
+        def commit(*entries):
+            # Saved per batch so an interrupted run resumes where it stopped; the index is
+            # persisted first, so the manifest never lists chunks that are not on disk
+            self.vector_store.persist()
+            self.bm25.save()
+            for source, entry in entries:
+                files[source] = entry
+                manifest["files"] = {**manifest["files"], source: entry}
+            self._save_manifest(manifest)
+        
+        def flush():
+            if not batch:
+                return
+            # Backends upsert by id, so a re-run after an interrupted ingest does not duplicate
+            self.vector_store.add(
+                ids=[chunk_id for _, chunk_id, _, _ in batch],
+                texts=[text for _, _, text, _ in batch],
+                metadatas=[metadata for _, _, _, metadata in batch]
+            )
+            self.bm25.add([chunk_id for _, chunk_id, _, _ in batch], [text for _, _, text, _ in batch])
+            stats["batches"] += 1
+            for source, _, _, _ in batch:
+                unwritten[source][1] -= 1
+            batch.clear()
+            done = [s for s, (_, left) in unwritten.items() if left == 0]
+            if done:
+                commit(*[(source, unwritten.pop(source)[0]) for source in done])
+        
+        for path, pages, chunks, error in _iter_loaded(list(to_load), workers, self.chunk_size, self.chunk_overlap):
+            source, digest, previous = to_load[path]
+            if error is not None:
+                print(f"Error loading {path}: {error}")
+                if previous:
+                    files[source] = previous
+                continue
+            print(f"Loaded {path}: {pages} pages, {len(chunks)} chunks")
+            
+            ids = self._chunk_ids(source, [text for text, _ in chunks])
+            old_ids = set(previous["chunk_ids"]) if previous else set()
+            new = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id not in old_ids]
+            stale = list(old_ids - set(ids))
+            if stale:
+                self.vector_store.delete(stale)
+                self.bm25.delete(stale)
             
-        # Split text into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
-        )
-        
-        splits = text_splitter.split_documents(documents)
-        print(f"Created {len(splits)} chunks from documents.")
-        
-        # Add to vector store
-        self.vector_store.add_documents(documents=splits)
+            stats["files_ingested"] += 1
+            stats["pages"] += pages
+            stats["chunks_embedded"] += len(new)
+            stats["chunks_skipped"] += len(ids) - len(new)
+            stats["chunks_deleted"] += len(stale)
+            entry = {"sha256": digest, "chunking": chunking, "chunk_ids": ids}
+            if not new:
+                commit((source, entry))
+                continue
+            unwritten[source] = [entry, len(new)]
+            for chunk_id, (text, metadata) in new:
+                batch.append((source, chunk_id, text, metadata))
+                if len(batch) >= RAG_EMBED_BATCH_SIZE:
+                    flush()
+        flush()
+        
+        for source, previous in manifest["files"].items():
+            if source not in files:
+                if previous["chunk_ids"]:
+                    self.vector_store.delete(previous["chunk_ids"])
+                    self.bm25.delete(previous["chunk_ids"])
+                stats["files_removed"] += 1
+                stats["chunks_deleted"] += len(previous["chunk_ids"])
+        
         self.vector_store.persist()
-        print("Knowledge base updated and persisted.")
-        return True
+        self.bm25.save()
+        manifest["files"] = files
+        self._save_manifest(manifest)
+        
+        elapsed = time.perf_counter() - start
+        stats["seconds"] = round(elapsed, 2)
+        stats["pages_per_sec"] = round(stats["pages"] / elapsed, 1) if elapsed else 0.0
+        stats["chunks_per_sec"] = round(stats["chunks_embedded"] / elapsed, 1) if elapsed else 0.0
+        print(f"Knowledge base updated: {stats['chunks_embedded']} chunks embedded, "
+              f"{stats['chunks_skipped']} skipped, {stats['chunks_deleted']} deleted "
+              f"({stats['files_ingested']} files ingested, {stats['files_unchanged']} unchanged, "
+              f"{stats['files_removed']} removed).")
+        print(f"Ingestion throughput: {stats['pages_per_sec']} pages/sec, {stats['chunks_per_sec']} chunks/sec "
+              f"over {stats['seconds']}s ({workers} loader processes, batches of {RAG_EMBED_BATCH_SIZE}).")
+        return stats
         
     def search(self, query: str, k: int = 3) -> List[str]:
-        """Search for relevant context for a query"""
+        """
+        Search for relevant context for a query.
+        Short keyword queries with BM25 matches skip embedding; otherwise BM25 and vector
+        results are fused by reciprocal rank (RRF_K).
+        """
+        return self.search_with_vector(query, k=k)[0]
+    
+    def search_with_vector(self, query: str, k: int = 3, embed: bool = False) -> Tuple[List[str], Optional[List[float]]]:
+        """
+        Like search(), also returning the query embedding. The lexical fast path does not
+        need one and returns None, unless `embed` asks for it (through the query cache).
+        """
         try:
-            docs = self.vector_store.similarity_search(query, k=k)
-            return [doc.page_content for doc in docs]
+            if self.retrieval_mode == "vector" or not len(self.bm25):
+                self.search_stats["vector"] += 1
+                query_vector = self.embeddings.embed_query(query)
+                return self.vector_store.search_by_vector(query_vector, k=k), query_vector
+            
+            lexical = self.bm25.search(query, k=k * 2)
+            if lexical and len(tokenize(query)) <= RAG_LEXICAL_MAX_TERMS:
+                self.search_stats["lexical"] += 1
+                query_vector = self.embeddings.embed_query(query) if embed else None
+                return [text for _, text, _ in lexical[:k]], query_vector
+            
+            self.search_stats["hybrid"] += 1
+            query_vector = self.embeddings.embed_query(query)
+            vector_texts = self.vector_store.search_by_vector(query_vector, k=k * 2)
+            # Both lists hold chunk texts, so fuse on the text itself
+            fused = reciprocal_rank_fusion(
+                vector_texts,
+                [text for _, text, _ in lexical],
+                k=RRF_K
+            )
+            return fused[:k], query_vector
         except Exception as e:
             print(f"Error during RAG search: {e}")
-            return []
-            
-            return []
+            return [], None
+    
+    def cache_stats(self):
+        """Query embedding cache hits, misses and batching"""
+        return self.embeddings.stats()
+    
+    def retrieval_stats(self):
+        """Searches served by each retrieval path"""
+        return dict(self.search_stats, bm25_chunks=len(self.bm25), mode=self.retrieval_mode,
+                    backend=self.backend, vector_chunks=self.vector_store.count())
             
 # Singleton instance
 _rag_engine_instance = None
+_rag_engine_lock = threading.Lock()
 
 def get_rag_engine():
     """Factory function to get or create the singleton RAG engine"""
     global _rag_engine_instance
     if _rag_engine_instance is None:
-        print("Initializing RAGEngine Singleton...")
-        _rag_engine_instance = RAGEngine()
-    else:
-        print("Using existing RAGEngine Singleton.")
+        # The warm-up thread and request threads may race to build it; only one does
+        with _rag_engine_lock:
+            if _rag_engine_instance is None:
+                print("Initializing RAGEngine Singleton...")
+                _rag_engine_instance = RAGEngine()
     return _rag_engine_instance
+
+if __name__ == "__main__":
+    # python -m models.rag_engine: bring the vector store up to date with data/medical_knowledge
+    get_rag_engine().ingest_documents()
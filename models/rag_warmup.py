@@ -0,0 +1,61 @@
+"""
+Background warm-up for the RAG engine
+Opt-in (RAG_WARMUP): builds the RAG engine, loads the embedding model with a dummy
+embedding and opens the vector store on a background thread at startup, so the first
+chatbot message in a worker does not stall. Until it finishes the chatbot answers
+from its rule-based fallback.
+"""
+
+import os
+import time
+import threading
+
+RAG_WARMUP = os.environ.get('RAG_WARMUP', 'false').lower() in ('1', 'true', 'yes')
+
+_lock = threading.Lock()
+_pid = None
+_state = 'idle'  # idle -> pending -> ready | failed
+
+
+def enabled():
+    return RAG_WARMUP
+
+
+def state():
+    return _state if _pid == os.getpid() else 'idle'
+
+
+def ready():
+    return state() == 'ready'
+
+
+def _warm():
+    global _state
+    start = time.perf_counter()
+    try:
+        # Imported here: langchain/Chroma/FastEmbed are heavy and only needed by the chatbot
+        from models.rag_engine import get_rag_engine
+        engine = get_rag_engine()
+        # Straight to the model (not the query cache) to load the ONNX session
+        engine.embeddings.embeddings.embed_query("kidney function")
+        if engine.vector_store.count() == 0:
+            engine.ingest_documents()
+        _state = 'ready'
+        print(f"RAG warm-up finished in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        _state = 'failed'
+        print(f"RAG warm-up failed: {e}")
+
+
+def start():
+    """Start the warm-up thread once per process (no-op unless RAG_WARMUP is set)"""
+    global _pid, _state
+    if not RAG_WARMUP:
+        return False
+    with _lock:
+        # A forked worker does not inherit the parent's thread, so it warms up itself
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _state = 'pending'
+            threading.Thread(target=_warm, name='rag-warmup', daemon=True).start()
+    return True
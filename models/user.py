@@ -1,9 +1,98 @@
+from flask import g, has_request_context
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from models.database import Database
+from models.patient_identity import invalidate_patient_identity
+from bson import json_util
 from bson.objectid import ObjectId
 import pandas as pd
+import base64
 import datetime
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Process-level cache behind the Flask-Login user loader: user_id -> (expires_at, user_data)
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+USER_CACHE_MAX_ENTRIES = 1024
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+# Fields the User model reads; user lookups fetch only these by default
+USER_FIELDS = {
+    'username': 1, 'password_hash': 1, 'role': 1, 'email': 1, 'specialization': 1,
+    'city': 1, 'patients': 1, 'has_seen_tour': 1
+}
+
+def username_key(username):
+    """Normalized (case-insensitive) lookup key stored beside usernames as *_key fields"""
+    return username.strip().casefold() if isinstance(username, str) else username
+
+def username_query(field, username):
+    """
+    Indexed equality on the stored name or its normalized key (`<field>_key`, or
+    `username_key` for `username`). The exact clause keeps documents written before
+    the key backfill reachable.
+    """
+    key_field = 'username_key' if field == 'username' else f'{field}_key'
+    return {'$or': [{field: username}, {key_field: username_key(username)}]}
+
+def usernames_query(field, usernames):
+    """username_query for several names at once (`$in` on the stored name or its key)"""
+    key_field = 'username_key' if field == 'username' else f'{field}_key'
+    return {'$or': [{field: {'$in': list(usernames)}},
+                    {key_field: {'$in': [username_key(u) for u in usernames]}}]}
+
+def _find_one_by_username(collection, username, projection=None):
+    """Case-insensitive single lookup that prefers an exact-case match"""
+    docs = list(collection.find(username_query('username', username), projection).limit(2))
+    return next((d for d in docs if d.get('username') == username), docs[0] if docs else None)
+
+def _identity_map():
+    """Request-scoped map of User objects keyed by ('id', ...) and ('username', ...)"""
+    if not has_request_context():
+        return None
+    if 'user_identity_map' not in g:
+        g.user_identity_map = {}
+        g.user_lookups_avoided = 0
+    return g.user_identity_map
+
+def _identity_get(key):
+    identity_map = _identity_map()
+    if identity_map is None:
+        return None
+    user = identity_map.get(key)
+    if user is not None:
+        g.user_lookups_avoided += 1
+    return user
+
+def _identity_put(user):
+    identity_map = _identity_map()
+    if identity_map is not None and user is not None:
+        identity_map[('id', user.id)] = user
+        identity_map[('username', user.username)] = user
+    return user
+
+def get_user_lookups_avoided():
+    """Number of users.find_one calls skipped in the current request"""
+    if not has_request_context():
+        return 0
+    return g.get('user_lookups_avoided', 0)
+
+def invalidate_user_cache(user_id=None, username=None):
+    """Drop a user from the loader cache and the current request's identity map"""
+    with _user_cache_lock:
+        for cached_id, (_, user_data) in list(_user_cache.items()):
+            if cached_id == user_id or (username and user_data.get('username') == username):
+                _user_cache.pop(cached_id, None)
+    identity_map = _identity_map()
+    if identity_map is not None:
+        for key, user in list(identity_map.items()):
+            if user.id == user_id or (username and user.username == username):
+                identity_map.pop(key, None)
 
 class User(UserMixin):
     def __init__(self, user_data):
@@ -25,29 +114,68 @@ class User(UserMixin):
         return self.role == 'patient'
 
     @staticmethod
-    def get_by_id(user_id):
-        """Get user by ID with error handling"""
+    def get_by_id(user_id, projection=None):
+        """Get user by ID with error handling (a custom projection bypasses the identity map)"""
+        if projection is None:
+            user = _identity_get(('id', str(user_id)))
+            if user is not None:
+                return user
         try:
             db = Database.get_db()
             if db is None:
                 return None
-            user_data = db.users.find_one({'_id': ObjectId(user_id)})
+            user_data = db.users.find_one({'_id': ObjectId(user_id)}, projection or USER_FIELDS)
             if user_data:
-                return User(user_data)
+                user = User(user_data)
+                return _identity_put(user) if projection is None else user
         except:
             pass
         return None
 
     @staticmethod
-    def get_by_username(username):
-        """Get user by username with error handling"""
+    def get_cached(user_id):
+        """Get user by ID through the process-level TTL cache (used by the login loader)"""
+        user = _identity_get(('id', str(user_id)))
+        if user is not None:
+            return user
+        now = time.monotonic()
+        with _user_cache_lock:
+            entry = _user_cache.get(str(user_id))
+        if entry and entry[0] > now:
+            if has_request_context():
+                _identity_map()
+                g.user_lookups_avoided += 1
+            return _identity_put(User(entry[1]))
+        try:
+            db = Database.get_db()
+            if db is None:
+                return None
+            user_data = db.users.find_one({'_id': ObjectId(user_id)}, USER_FIELDS)
+        except:
+            return None
+        if not user_data:
+            return None
+        with _user_cache_lock:
+            if len(_user_cache) >= USER_CACHE_MAX_ENTRIES:
+                _user_cache.pop(next(iter(_user_cache)))
+            _user_cache[str(user_id)] = (now + USER_CACHE_TTL, user_data)
+        return _identity_put(User(user_data))
+
+    @staticmethod
+    def get_by_username(username, projection=None):
+        """Get user by username with error handling (a custom projection bypasses the identity map)"""
+        if projection is None:
+            user = _identity_get(('username', username))
+            if user is not None:
+                return user
         try:
             db = Database.get_db()
             if db is None:
                 return None
-            user_data = db.users.find_one({'username': username})
+            user_data = _find_one_by_username(db.users, username, projection or USER_FIELDS)
             if user_data:
-                return User(user_data)
+                user = User(user_data)
+                return _identity_put(user) if projection is None else user
             return None
         except Exception as e:
             print(f"Error getting user by username {username}: {e}")
@@ -60,11 +188,13 @@ class User(UserMixin):
             db = Database.get_db()
             if db is None:
                 return None
-            if db.users.find_one({'username': username}):
+            # Names differing only in case are the same account
+            if db.users.find_one(username_query('username', username), {'_id': 1}):
                 return None
             
             user_data = {
                 'username': username,
+                'username_key': username_key(username),
                 'password_hash': generate_password_hash(password),
                 'role': role,
                 'email': email,
@@ -77,6 +207,7 @@ class User(UserMixin):
             
             result = db.users.insert_one(user_data)
             user_data['_id'] = result.inserted_id
+            invalidate_patient_identity(username)
             return User(user_data)
         except Exception as e:
             print(f"Error creating user {username}: {e}")
@@ -84,38 +215,38 @@ class User(UserMixin):
 
 # --- Helper functions for Data Persistence ---
 
-def get_all_doctors():
+def get_all_doctors(projection=None):
     """Get all doctors with error handling"""
     try:
         db = Database.get_db()
         if db is None:
             return []
-        doctors_cursor = db.users.find({'role': 'doctor'})
+        doctors_cursor = db.users.find({'role': 'doctor'}, projection or USER_FIELDS)
         return [User(doc) for doc in doctors_cursor]
     except Exception as e:
         print(f"Error getting doctors: {e}")
         return []
 
-def get_all_patients():
+def get_all_patients(projection=None):
     """Get all patients with error handling"""
     try:
         db = Database.get_db()
         if db is None:
             return []
-        patients_cursor = db.users.find({'role': 'patient'})
+        patients_cursor = db.users.find({'role': 'patient'}, projection or USER_FIELDS)
         return [User(pat) for pat in patients_cursor]
     except Exception as e:
         print(f"Error getting patients: {e}")
         return []
 
 # Patient Data (Medical Records/Risk Analysis)
-def get_patient_data(patient_id):
-    """Get patient data with error handling"""
+def get_patient_data(patient_id, projection=None):
+    """Get patient data with error handling; `projection` limits the fields returned"""
     try:
         db = Database.get_db()
         if db is None:
             return None
-        return db.patients_data.find_one({'patient_id': patient_id})
+        return db.patients_data.find_one({'patient_id': patient_id}, projection)
     except Exception as e:
         print(f"Error getting patient data for {patient_id}: {e}")
         return None
@@ -132,21 +263,22 @@ def save_patient_data(patient_data):
             {'$set': patient_data},
             upsert=True
         )
+        invalidate_patient_identity(patient_data['patient_id'], patient_data.get('username'))
     except Exception as e:
         print(f"Error saving patient data: {e}")
 
-def get_all_patients_data():
+def get_all_patients_data(projection=None):
     db = Database.get_db()
-    return list(db.patients_data.find())
+    return list(db.patients_data.find({}, projection))
 
 # Patient Records (Historical/Trends)
-def get_patient_records(username):
-    """Get patient records with error handling"""
+def get_patient_records(username, projection=None):
+    """Get patient records with error handling; `projection` limits the fields returned"""
     try:
         db = Database.get_db()
         if db is None:
             return {}
-        record = db.patient_records.find_one({'username': username})
+        record = db.patient_records.find_one(username_query('username', username), projection)
         return record if record else {}
     except Exception as e:
         print(f"Error getting patient records for {username}: {e}")
@@ -160,21 +292,21 @@ def save_patient_record(username, data):
             return
         db.patient_records.update_one(
             {'username': username},
-            {'$set': data},
+            {'$set': {**data, 'username_key': username_key(username)}},
             upsert=True
         )
     except Exception as e:
         print(f"Error saving patient record for {username}: {e}")
 
 # Patient Upload Trials
-def get_patient_trials(username):
+def get_patient_trials(username, projection=None):
     """Get patient trials with error handling"""
     try:
         db = Database.get_db()
         if db is None:
             # Default trial info
             return {'username': username, 'remaining': 999, 'used': 0}
-        trial = db.patient_trials.find_one({'username': username})
+        trial = db.patient_trials.find_one({'username': username}, projection)
         if trial:
             return trial
         # Default trial info
@@ -195,6 +327,8 @@ def update_patient_trials(username, remaining, used):
 # Appointments
 def create_appointment(appointment_data):
     db = Database.get_db()
+    appointment_data['patient_key'] = username_key(appointment_data.get('patient'))
+    appointment_data['doctor_key'] = username_key(appointment_data.get('doctor'))
     result = db.appointments.insert_one(appointment_data)
     return str(result.inserted_id)
 
@@ -217,7 +351,7 @@ def get_appointments_for_doctor(doctor_name):
     if db is None:
         return []
         
-    appointments = list(db.appointments.find({'doctor': doctor_name}))
+    appointments = list(db.appointments.find(username_query('doctor', doctor_name)))
     
     # Generate meet link if missing for any appointment
     for apt in appointments:
@@ -249,18 +383,11 @@ def get_appointments_for_patient(patient_username):
         print(f"DB Name: {db.name}")
         print(f"Querying for: '{patient_username}'")
         
-        # Try multiple query approaches to find appointments
-        query_options = [
-            {'patient': patient_username},  # Exact match
-            {'patient': {'$regex': f'^{patient_username}$', '$options': 'i'}},  # Case insensitive exact match
-        ]
-        
-        appointments = []
-        for query in query_options:
-            appointments = list(db.appointments.find(query))
-            if appointments:
-                print(f"Found {len(appointments)} appointments with query: {query}")
-                break
+        # Case-insensitive match as indexed equality on the normalized key
+        query = username_query('patient', patient_username)
+        appointments = list(db.appointments.find(query))
+        if appointments:
+            print(f"Found {len(appointments)} appointments with query: {query}")
         
         if not appointments:
             # If no appointments found, let's check what appointments exist in the database
@@ -335,6 +462,178 @@ def get_all_feedbacks():
     db = Database.get_db()
     return list(db.feedbacks.find())
 
+def get_feedbacks_page(page=1, per_page=10):
+    """Fetch one page of feedback, newest first. Returns (feedbacks, total)"""
+    try:
+        db = Database.get_db()
+        if db is None:
+            return [], 0
+        total = db.feedbacks.count_documents({})
+        cursor = db.feedbacks.find().sort([('date', -1), ('_id', -1)]).skip((page - 1) * per_page).limit(per_page)
+        return list(cursor), total
+    except Exception as e:
+        print(f"Error getting feedback page {page}: {e}")
+        return [], 0
+
+def get_admin_doctor_overview(page_doctor=None, patient_page=1, per_page=20):
+    """
+    Admin dashboard data: every doctor with their patient count and one page of their
+    patients (username/email), sorted by username key. A doctor's patients are those with
+    an appointment with them or manually assigned to them. Counts and pages come from one
+    aggregation over the (doctor_key, patient_key) appointments index; `page_doctor` (a
+    username key) is shown at `patient_page`, every other doctor at page 1.
+    """
+    try:
+        db = Database.get_db()
+        if db is None:
+            return []
+        doctors = list(db.users.find({'role': 'doctor'}, {
+            'username': 1, 'username_key': 1, 'email': 1, 'specialization': 1, 'city': 1, 'patients': 1
+        }).sort('username', 1))
+        for doctor in doctors:
+            doctor['key'] = doctor.pop('username_key', None) or username_key(doctor['username'])
+        manual = {d['key']: sorted({k for k in map(username_key, d.get('patients') or []) if k})
+                  for d in doctors if d.get('patients')}
+        skip = (patient_page - 1) * per_page
+
+        pipeline = [
+            {'$match': {'doctor_key': {'$in': [d['key'] for d in doctors]}, 'patient_key': {'$ne': None}}},
+            {'$sort': {'doctor_key': 1, 'patient_key': 1}},
+            # One entry per (doctor, patient) pair, however many appointments they share
+            {'$group': {'_id': {'doctor': '$doctor_key', 'patient': '$patient_key'}}},
+            {'$sort': {'_id.doctor': 1, '_id.patient': 1}},
+            {'$group': {'_id': '$_id.doctor', 'keys': {'$push': '$_id.patient'}}}
+        ]
+        if manual:
+            # Manually assigned patients without an appointment follow the others
+            pipeline.append({'$project': {'keys': {'$concatArrays': ['$keys', {'$setDifference': [
+                {'$switch': {'branches': [{'case': {'$eq': ['$_id', key]}, 'then': {'$literal': keys}}
+                                          for key, keys in manual.items()], 'default': []}},
+                '$keys'
+            ]}]}}})
+        pipeline.append({'$project': {
+            'patient_count': {'$size': '$keys'},
+            'page': {'$slice': ['$keys', {'$cond': [{'$eq': ['$_id', page_doctor]}, skip, 0]}, per_page]}
+        }})
+        pages = {row['_id']: row for row in db.appointments.aggregate(pipeline)}
+
+        page_keys = set()
+        for doctor in doctors:
+            row = pages.get(doctor['key'])
+            if row is None:
+                # No appointments: only manual assignments, if any
+                keys = manual.get(doctor['key'], [])
+                start = skip if doctor['key'] == page_doctor else 0
+                row = {'patient_count': len(keys), 'page': keys[start:start + per_page]}
+            doctor['patient_count'] = row['patient_count']
+            doctor['patients_page'] = patient_page if doctor['key'] == page_doctor else 1
+            doctor['patients'] = row['page']
+            page_keys.update(row['page'])
+
+        # Every doctor's page of patients in one indexed query
+        patients = {
+            u['username_key']: {'username': u['username'], 'email': u.get('email')}
+            for u in db.users.find({'username_key': {'$in': list(page_keys)}},
+                                   {'_id': 0, 'username': 1, 'email': 1, 'username_key': 1})
+        } if page_keys else {}
+        for doctor in doctors:
+            doctor['patients'] = [patients[k] for k in doctor['patients'] if k in patients]
+        return doctors
+    except Exception as e:
+        print(f"Error getting admin doctor overview: {e}")
+        return []
+
+def _encode_cursor(values):
+    """Opaque keyset cursor from the sort key values of the last item on a page"""
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+def _decode_cursor(cursor, *shape):
+    """
+    Sort key values from an _encode_cursor cursor, or None (first page) unless they match
+    `shape`: one type, or a tuple of types, per value. A single type expects a bare value,
+    several a list of exactly that many. Anything else, such as a crafted cursor holding
+    query operators, never reaches a query.
+    """
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        return None
+    if len(shape) == 1:
+        return values if isinstance(values, shape[0]) else None
+    if not isinstance(values, list) or len(values) != len(shape):
+        return None
+    return values if all(isinstance(v, t) for v, t in zip(values, shape)) else None
+
+def get_prescriptions_page(doctor_username, patient=None, cursor=None, limit=20):
+    """
+    Keyset-paginated prescriptions for a doctor, newest first, optionally for one patient.
+    Backed by the (doctor, patient, date) index. Returns (prescriptions, next_cursor).
+    """
+    try:
+        db = Database.get_db()
+        if db is None:
+            return [], None
+        query = {'doctor': doctor_username}
+        if patient:
+            query['patient'] = patient
+        after = _decode_cursor(cursor, (str, datetime.datetime), ObjectId) if cursor else None
+        if after:
+            last_date, last_id = after
+            query['$or'] = [
+                {'date': {'$lt': last_date}},
+                {'date': last_date, '_id': {'$lt': last_id}}
+            ]
+        items = list(db.prescriptions.find(query).sort([('date', -1), ('_id', -1)]).limit(limit + 1))
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = _encode_cursor([items[-1].get('date'), items[-1]['_id']])
+        return items, next_cursor
+    except Exception as e:
+        print(f"Error getting prescriptions page for doctor {doctor_username}: {e}")
+        return [], None
+
+def get_prescription_patients(doctor_username):
+    """Distinct patients a doctor has prescribed for (served from the (doctor, patient) index)"""
+    try:
+        db = Database.get_db()
+        if db is None:
+            return []
+        return sorted(p for p in db.prescriptions.distinct('patient', {'doctor': doctor_username}) if p)
+    except Exception as e:
+        print(f"Error getting prescription patients for doctor {doctor_username}: {e}")
+        return []
+
+def get_patient_usernames_page(cursor=None, limit=50):
+    """Keyset-paginated patient usernames, alphabetical. Returns (usernames, next_cursor)"""
+    try:
+        db = Database.get_db()
+        if db is None:
+            return [], None
+        query = {'role': 'patient'}
+        after = _decode_cursor(cursor, str) if cursor else None
+        if after:
+            query['username'] = {'$gt': after}
+        usernames = [u['username'] for u in db.users.find(query, {'username': 1}).sort('username', 1).limit(limit + 1)]
+        next_cursor = None
+        if len(usernames) > limit:
+            usernames = usernames[:limit]
+            next_cursor = _encode_cursor(usernames[-1])
+        return usernames, next_cursor
+    except Exception as e:
+        print(f"Error getting patient usernames page: {e}")
+        return [], None
+
+def get_doctor_patients_page(doctor_username, cursor=None, limit=50):
+    """Keyset-paginated get_doctor_patients_with_details. Returns (patients, next_cursor)"""
+    after = _decode_cursor(cursor, str) if cursor else None
+    patients = get_doctor_patients_with_details(doctor_username, after=after, limit=limit + 1)
+    next_cursor = None
+    if len(patients) > limit:
+        patients = patients[:limit]
+        next_cursor = _encode_cursor(username_key(patients[-1]['username']))
+    return patients, next_cursor
+
 def get_prescriptions_for_doctor(doctor_username):
     """Fetch prescriptions authored by the given doctor."""
     try:
@@ -378,148 +677,164 @@ def get_prescription_by_id(prescription_id):
 
 def update_patient_lab_values(username, lab_values, prediction, pdf_path=None, test_type="Lab Report Analysis"):
     """Update patient lab values and history"""
-    db = Database.get_db()
-    
-    # Get existing record to preserve other fields
-    record = db.patient_records.find_one({'username': username})
-    if not record:
-        record = {'username': username, 'history': []}
-    
-    # Update current metrics
-    current_metrics = record.get('current_metrics', {})
-    # Merge new values
+    ingest_lab_upload(username, lab_values, prediction, pdf_path=pdf_path, test_type=test_type)
+
+def _build_lab_ingest_writes(username, lab_values, prediction, pdf_path, test_type, disease_type):
+    """
+    Compute every document touched by a lab upload in one pass.
+    Returns the patient_records update, the patients_data $set and the lab_results document.
+    """
+    now = datetime.datetime.now()
+    lab_values = lab_values or {}
+
+    # current_metrics is merged with dotted paths so no read of the existing record is needed
+    record_set = {}
     for k, v in lab_values.items():
         if v is not None:
-            current_metrics[k] = v
-            
-    # Add prediction info to metrics for easy access
+            record_set[f'current_metrics.{k}'] = v
     if prediction:
-        current_metrics['disease_prediction'] = prediction
-        
-    # Add PDF path if provided
+        record_set['current_metrics.disease_prediction'] = prediction
     if pdf_path:
-        record['latest_lab_pdf'] = pdf_path
-            
-    # Create history entry
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record_set['latest_lab_pdf'] = pdf_path
+    if disease_type:
+        record_set[f'disease_status.{disease_type}'] = {
+            'last_updated': now.strftime("%Y-%m-%d %H:%M"),
+            'prediction': prediction
+        }
+
     history_entry = {
-        'date': timestamp,
+        'date': now.strftime("%Y-%m-%d %H:%M:%S"),
         'test_type': test_type,
         'metrics': lab_values,
         'prediction': prediction,
-        'pdf_path': pdf_path
+        'pdf_path': pdf_path,
+        # When the entry was written, whatever its lab date; the analytics snapshot selects on it
+        'ingested_at': datetime.datetime.utcnow()
     }
-    
-    # Update database
-    update_data = {
-        '$set': {
-            'current_metrics': current_metrics,
-            'latest_lab_pdf': pdf_path if pdf_path else record.get('latest_lab_pdf')
-        },
-        '$push': {'history': history_entry}
-    }
-    
-    # Remove None values from $set to avoid overwriting with None if not provided
-    if not pdf_path:
-        del update_data['$set']['latest_lab_pdf']
-        
-    db.patient_records.update_one(
-        {'username': username},
-        update_data,
-        upsert=True
-    )
-
-    # Also update patients_data collection to ensure doctor dashboard shows updated values
-    try:
-        # Prepare patient data update
-        patient_data_update = {}
-        for k, v in lab_values.items():
-            if v is not None:
-                patient_data_update[k] = v
-        
-        # Add prediction data
-        if prediction:
-            patient_data_update.update({
-                'risk_percentage': prediction.get('risk_percentage', 0),
-                'stage': prediction.get('stage', 'N/A'),
-                'risk_level': prediction.get('risk_level', 'Unknown'),
-                'egfr': prediction.get('egfr', None)
-            })
-        
-        # Update patients_data collection
-        db.patients_data.update_one(
-            {'username': username},
-            {'$set': patient_data_update},
-            upsert=True  # Create record if it doesn't exist
-        )
-        print(f"Updated patients_data for {username} with new lab values")
-    except Exception as e:
-        print(f"Error updating patients_data: {e}")
-
-def update_disease_status(username, disease_type, prediction, lab_values=None):
-    """
-    Update the status for a specific disease type in patient records.
-    Stores the latest result for dashboard display.
-    """
-    try:
-        db = Database.get_db()
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-        
-        status_entry = {
-            'last_updated': timestamp,
-            'prediction': prediction
-        }
-        
-        # Update specifically the disease_status dictionary
-        db.patient_records.update_one(
-            {'username': username},
-            {'$set': {f'disease_status.{disease_type}': status_entry}},
-            upsert=True
-        )
-        print(f"Updated disease status for {username} - {disease_type}")
-    except Exception as e:
-        print(f"Error updating disease status: {e}")
+    record_set['username_key'] = username_key(username)
+    record_update = {'$push': {'history': history_entry}, '$set': record_set}
 
-    # Sync with lab_results collection for Doctor Dashboard
-    try:
-        # Prepare lab result document
+    # patients_data keeps the doctor dashboard in sync
+    patient_data_set = {k: v for k, v in lab_values.items() if v is not None}
+    if prediction:
+        patient_data_set.update({
+            'risk_percentage': prediction.get('risk_percentage', 0),
+            'stage': prediction.get('stage', 'N/A'),
+            'risk_level': prediction.get('risk_level', 'Unknown'),
+            'egfr': prediction.get('egfr', None)
+        })
+
+    # lab_results feeds the doctor health trends charts
+    lab_result_doc = None
+    if disease_type and lab_values:
         lab_result_doc = {
             'patient_username': username,
-            'test_date': datetime.datetime.now(),
+            'test_date': now,
             'test_type': 'Lab Report Upload',
             'notes': f"Uploaded via Patient Dashboard. Prediction: {prediction if prediction else 'N/A'}",
-            'created_at': datetime.datetime.now()
+            'created_at': now
         }
-        
-        # Map common fields
-        if 'egfr' in lab_values:
-            lab_result_doc['egfr'] = float(lab_values['egfr'])
-        if 'serum_creatinine' in lab_values:
-            lab_result_doc['serum_creatinine'] = float(lab_values['serum_creatinine'])
-        if 'bp_systolic' in lab_values:
-            lab_result_doc['bp_systolic'] = float(lab_values['bp_systolic'])
-        if 'bp_diastolic' in lab_values:
-            lab_result_doc['bp_diastolic'] = float(lab_values['bp_diastolic'])
-            
-        # Add other values
         for k, v in lab_values.items():
-            if k not in ['egfr', 'serum_creatinine', 'bp_systolic', 'bp_diastolic'] and v is not None:
-                lab_result_doc[k] = v
-                
-        db.lab_results.insert_one(lab_result_doc)
-        print(f"Synced lab result for {username} to lab_results collection")
-    except Exception as e:
-        print(f"Error syncing to lab_results: {e}")
+            if v is None:
+                continue
+            if k in ['egfr', 'serum_creatinine', 'bp_systolic', 'bp_diastolic']:
+                try:
+                    v = float(v)
+                except (ValueError, TypeError):
+                    continue
+            lab_result_doc[k] = v
+
+    return record_update, patient_data_set, lab_result_doc
+
+def ingest_lab_upload(username, lab_values, prediction, pdf_path=None, test_type="Lab Report Analysis", disease_type=None):
+    """
+    Single write path for a lab upload.
+    Writes patient_records, patients_data and lab_results with one operation each and no reads.
+    When the deployment supports transactions the three writes are all-or-nothing; otherwise
+    the patient_records write raises as before and the patients_data/lab_results copies are
+    each best effort, so one failing does not drop the others. Returns the number of writes made.
+    """
+    db = Database.get_db()
+    if db is None:
+        return 0
+
+    record_update, patient_data_set, lab_result_doc = _build_lab_ingest_writes(
+        username, lab_values, prediction, pdf_path, test_type, disease_type
+    )
+
+    def run_writes(session=None):
+        db.patient_records.update_one({'username': username}, record_update, upsert=True, session=session)
+        ops = 1
+        copies = []
+        if patient_data_set:
+            copies.append(('patients_data', lambda: db.patients_data.update_one(
+                {'username': username}, {'$set': patient_data_set}, upsert=True, session=session)))
+        if lab_result_doc:
+            copies.append(('lab_results', lambda: db.lab_results.insert_one(lab_result_doc, session=session)))
+        for collection, write in copies:
+            if session is not None:
+                # Let the transaction abort (and with_transaction retry) on any failure
+                write()
+            else:
+                try:
+                    write()
+                except Exception as e:
+                    logger.warning(f"Error syncing lab upload for {username} to {collection}: {e}")
+                    continue
+            ops += 1
+        return ops
+
+    use_transaction = Database.supports_transactions()
+    if use_transaction:
+        with Database.client.start_session() as session:
+            ops = session.with_transaction(run_writes)
+    else:
+        ops = run_writes()
+    invalidate_patient_identity(username)
+
+    logger.info(f"Lab ingest for {username}: {ops} write ops (transaction={use_transaction})")
+    return ops
 
 def decrement_trial_count(username):
     """Deprecated:# No changer enforcing trial limits"""
     pass
 
-def get_doctor_patients_with_details(doctor_username):
+def _get_doctor_patient_keys(db, doctor, after=None, limit=None):
+    """
+    Sorted username keys of a doctor's patients (appointments plus manual assignment),
+    starting after the key `after`. distinct() walks the (doctor_key, patient_key)
+    appointments index one key per patient instead of grouping every appointment.
+    """
+    query = {'doctor_key': username_key(doctor.username)}
+    if after:
+        query['patient_key'] = {'$gt': after}
+    keys = {k for k in db.appointments.distinct('patient_key', query) if k}
+
+    # Also include patients manually assigned to this doctor (if any)
+    if doctor.patients:
+        keys.update(k for k in map(username_key, doctor.patients) if k and (not after or k > after))
+
+    keys = sorted(keys)
+    return keys[:limit] if limit else keys
+
+def get_doctor_patient_keys(doctor_username):
+    """Username keys of every patient of a doctor (appointments plus manual assignment)"""
+    try:
+        db = Database.get_db()
+        doctor = User.get_by_username(doctor_username)
+        if db is None or not doctor:
+            return []
+        return _get_doctor_patient_keys(db, doctor)
+    except Exception as e:
+        print(f"Error getting patient keys for doctor {doctor_username}: {e}")
+        return []
+
+def get_doctor_patients_with_details(doctor_username, after=None, limit=None):
     """
-    Fetch all patients associated with a doctor (via appointments or manual assignment)
+    Fetch patients associated with a doctor (via appointments or manual assignment)
     and return their detailed data including 'last_updated'.
     Fetches real-time data from patient_records as primary source.
+    Patients are ordered by username key; pass `after` (a key) and `limit` for keyset pagination.
     """
     try:
         db = Database.get_db()
@@ -529,23 +844,39 @@ def get_doctor_patients_with_details(doctor_username):
         if not doctor:
             return []
 
-        appointments = get_appointments_for_doctor(doctor_username)
-        
-        # Filter patients: Only show those who have an appointment with this doctor
-        patient_usernames_with_appointments = set(apt['patient'] for apt in appointments)
-        
-        # Also include patients manually assigned to this doctor (if any)
-        if hasattr(doctor, 'patients') and doctor.patients:
-            patient_usernames_with_appointments.update(doctor.patients)
+        page_keys = _get_doctor_patient_keys(db, doctor, after, limit)
+        if not page_keys:
+            return []
+
+        # Batch the per-patient lookups for this page: one query per collection, matched
+        # on the normalized key so differently-cased references land on the same patient
+        users_by_key = {
+            u['username_key']: u for u in db.users.find(
+                {'username_key': {'$in': page_keys}}, {'username': 1, 'username_key': 1}
+            )
+        }
+        page_usernames = [users_by_key[k]['username'] if k in users_by_key else k for k in page_keys]
+        records_by_key = {
+            username_key(r['username']): r for r in db.patient_records.find(
+                usernames_query('username', page_usernames),
+                {'username': 1, 'history': {'$slice': -1}, 'current_metrics': 1}
+            )
+        }
+        patient_data_by_key = {
+            username_key(p['username']): p for p in db.patients_data.find(
+                {'username': {'$in': page_usernames}},
+                {'name': 1, 'username': 1, 'risk_level': 1, 'risk_percentage': 1, 'stage': 1, 'egfr': 1, 'age': 1}
+            )
+        }
             
         filtered_patients = []
-        for username in patient_usernames_with_appointments:
+        for key, username in zip(page_keys, page_usernames):
             # Fetch patient records (primary source of truth for lab data)
-            records = get_patient_records(username)
+            records = records_by_key.get(key, {})
             
             # Get user info for patient_id
-            user = User.get_by_username(username)
-            patient_id = f'P{user.id}' if user else f'P{username}'
+            user = users_by_key.get(key)
+            patient_id = f"P{user['_id']}" if user else f'P{username}'
             
             # Initialize with defaults
             patient_info = {
@@ -617,7 +948,7 @@ def get_doctor_patients_with_details(doctor_username):
                             pass
 
             # Always try to backfill with patients_data if info is missing
-            patient_data = db.patients_data.find_one({'username': username})
+            patient_data = patient_data_by_key.get(key)
             if patient_data:
                 # Use data from patients_data if available and not already set/valid
                 if 'name' in patient_data and (not patient_info['name'] or patient_info['name'] == username):
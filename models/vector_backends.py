@@ -0,0 +1,177 @@
+"""
+Vector Store Backends for the RAG Engine
+Both backends expose the same small interface (add/delete/search/search_by_vector/count/persist), so
+RAGEngine can run on Chroma or on an in-process NumPy index chosen by RAG_VECTOR_BACKEND.
+
+The NumPy backend keeps L2-normalized float32 embeddings in a .npy matrix opened with
+mmap_mode='r' (loads in milliseconds, pages shared by every worker through the OS page
+cache) and chunk ids/texts/metadata in a JSON file beside it. Search is exact: one
+matrix-vector product and an argpartition top-k.
+"""
+
+import os
+import json
+import threading
+from typing import List
+import numpy as np
+
+RAG_VECTOR_BACKEND = os.environ.get('RAG_VECTOR_BACKEND', 'chroma').lower()
+DEFAULT_PERSIST_DIRECTORIES = {
+    'chroma': 'data/chroma_db',
+    'numpy': 'data/numpy_index'
+}
+
+
+class ChromaBackend:
+    """Adapter over the LangChain Chroma store"""
+
+    def __init__(self, persist_directory, embeddings):
+        from langchain_community.vectorstores import Chroma
+        self.store = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
+
+    def add(self, ids, texts, metadatas=None):
+        # Chroma upserts by id
+        self.store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+
+    def delete(self, ids):
+        if ids:
+            self.store.delete(ids=list(ids))
+
+    def get_all(self):
+        stored = self.store._collection.get(include=["documents"])
+        return stored["ids"], stored["documents"]
+
+    def count(self):
+        return self.store._collection.count()
+
+    def search(self, query, k=3) -> List[str]:
+        return [doc.page_content for doc in self.store.similarity_search(query, k=k)]
+
+    def search_by_vector(self, vector, k=3) -> List[str]:
+        return [doc.page_content for doc in self.store.similarity_search_by_vector(vector, k=k)]
+
+    def persist(self):
+        self.store.persist()
+
+
+class NumpyBackend:
+    """Exact cosine search over a memory-mapped float32 embedding matrix"""
+
+    VECTORS_FILE = "vectors.npy"
+    META_FILE = "chunks.json"
+
+    def __init__(self, persist_directory, embeddings):
+        self.directory = persist_directory
+        self.embeddings = embeddings
+        self._lock = threading.Lock()
+        # (vectors, ids, texts, metadatas) swapped as a whole, so searches never see a half update
+        self._state = (np.zeros((0, 0), dtype=np.float32), [], [], [])
+        self._dirty = False
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        try:
+            with open(self._path(self.META_FILE)) as f:
+                meta = json.load(f)
+            vectors = np.load(self._path(self.VECTORS_FILE), mmap_mode='r')
+        except (OSError, ValueError):
+            return
+        self._state = (vectors, meta["ids"], meta["texts"], meta["metadatas"])
+
+    @staticmethod
+    def _normalize(matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    def add(self, ids, texts, metadatas=None):
+        if not ids:
+            return
+        new_vectors = self._normalize(self.embeddings.embed_documents(list(texts)))
+        metadatas = list(metadatas) if metadatas else [{} for _ in ids]
+        with self._lock:
+            vectors, old_ids, old_texts, old_metadatas = self._state
+            replaced = set(ids)
+            keep = [i for i, chunk_id in enumerate(old_ids) if chunk_id not in replaced]
+            if len(old_ids):
+                kept = np.asarray(vectors[keep], dtype=np.float32)
+                vectors = np.concatenate([kept, new_vectors]) if len(kept) else new_vectors
+            else:
+                vectors = new_vectors
+            self._state = (
+                vectors,
+                [old_ids[i] for i in keep] + list(ids),
+                [old_texts[i] for i in keep] + list(texts),
+                [old_metadatas[i] for i in keep] + metadatas
+            )
+            self._dirty = True
+
+    def delete(self, ids):
+        removed = set(ids)
+        with self._lock:
+            vectors, old_ids, old_texts, old_metadatas = self._state
+            keep = [i for i, chunk_id in enumerate(old_ids) if chunk_id not in removed]
+            if len(keep) == len(old_ids):
+                return
+            self._state = (
+                np.asarray(vectors[keep], dtype=np.float32),
+                [old_ids[i] for i in keep],
+                [old_texts[i] for i in keep],
+                [old_metadatas[i] for i in keep]
+            )
+            self._dirty = True
+
+    def get_all(self):
+        _, ids, texts, _ = self._state
+        return list(ids), list(texts)
+
+    def count(self):
+        return len(self._state[1])
+
+    def search(self, query, k=3) -> List[str]:
+        if not self.count():
+            return []
+        return self.search_by_vector(self.embeddings.embed_query(query), k=k)
+
+    def search_by_vector(self, vector, k=3) -> List[str]:
+        vectors, _, texts, _ = self._state
+        if not texts:
+            return []
+        scores = vectors @ self._normalize(vector)
+        k = min(k, len(texts))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [texts[i] for i in top]
+
+    def persist(self):
+        """Write the matrix and metadata atomically, then reopen the matrix memory-mapped"""
+        with self._lock:
+            if not self._dirty:
+                return
+            vectors, ids, texts, metadatas = self._state
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_vectors = self._path("vectors.tmp.npy")
+            np.save(tmp_vectors, np.ascontiguousarray(vectors, dtype=np.float32))
+            tmp_meta = self._path(self.META_FILE + ".tmp")
+            with open(tmp_meta, "w") as f:
+                json.dump({"ids": ids, "texts": texts, "metadatas": metadatas}, f)
+            os.replace(tmp_vectors, self._path(self.VECTORS_FILE))
+            os.replace(tmp_meta, self._path(self.META_FILE))
+            self._state = (np.load(self._path(self.VECTORS_FILE), mmap_mode='r'), ids, texts, metadatas)
+            self._dirty = False
+
+
+BACKENDS = {
+    'chroma': ChromaBackend,
+    'numpy': NumpyBackend
+}
+
+
+def create_backend(name, persist_directory, embeddings):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown vector backend: {name} (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name](persist_directory, embeddings)
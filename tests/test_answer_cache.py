@@ -0,0 +1,108 @@
+"""
+Semantic answer cache on the chatbot's RAG path
+Uses the real BM25 index, query embedding cache and NumPy backend with a small
+deterministic embedder, so no model download or Gemini key is needed.
+"""
+
+import hashlib
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("langchain_core")
+pytest.importorskip("langchain_community")
+pytest.importorskip("google.generativeai")
+
+from models.answer_cache import SemanticAnswerCache
+from models.bm25_index import BM25Index, tokenize
+from models.embedding_cache import CachedQueryEmbeddings
+from models.patient_chatbot import PatientEducationChatbot
+from models.rag_engine import RAGEngine, RAG_LEXICAL_MAX_TERMS
+from models.vector_backends import NumpyBackend
+
+CHUNKS = {
+    "egfr": "eGFR (estimated glomerular filtration rate) measures how well the kidneys filter blood.",
+    "bananas": "Bananas are high in potassium; people with high potassium may need to limit them.",
+    "dialysis": "Dialysis filters the blood when the kidneys can no longer do it on their own.",
+}
+
+
+class HashingEmbeddings:
+    """Bag-of-words hashing embedder: same words, same vector"""
+
+    def __init__(self):
+        self.query_calls = 0
+
+    def _embed(self, text):
+        vector = np.zeros(64, dtype=np.float32)
+        for token in tokenize(text):
+            vector[int(hashlib.md5(token.encode()).hexdigest(), 16) % 64] += 1.0
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        self.query_calls += 1
+        return self._embed(text)
+
+
+class CountingModel:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        return type("Response", (), {"text": f"answer {self.calls}"})()
+
+
+@pytest.fixture
+def chatbot(tmp_path):
+    model_embeddings = HashingEmbeddings()
+    engine = RAGEngine.__new__(RAGEngine)
+    engine.retrieval_mode = "hybrid"
+    engine.search_stats = {"lexical": 0, "hybrid": 0, "vector": 0}
+    engine.embeddings = CachedQueryEmbeddings(model_embeddings, batch_window_ms=0)
+    engine.vector_store = NumpyBackend(str(tmp_path), engine.embeddings)
+    engine.vector_store.add(list(CHUNKS), list(CHUNKS.values()))
+    engine.bm25 = BM25Index()
+    engine.bm25.add(list(CHUNKS), list(CHUNKS.values()))
+
+    bot = PatientEducationChatbot.__new__(PatientEducationChatbot)
+    bot.rag_engine = engine
+    bot.answer_cache = SemanticAnswerCache(enabled=True)
+    bot.recommender = type("Recommender", (), {"model": CountingModel()})()
+    return bot
+
+
+def test_short_question_asked_twice_generates_once(chatbot):
+    question = "What is eGFR?"
+    assert len(tokenize(question)) <= RAG_LEXICAL_MAX_TERMS
+    patient = {"stage": "3a", "egfr": 52, "potassium": 4.8, "age": 61}
+
+    first = chatbot._generate_rag_response(question, patient)
+    second = chatbot._generate_rag_response(question, patient)
+
+    assert first == second
+    assert chatbot.recommender.model.calls == 1
+    # Served by the keyword-only path, and embedded once through the query cache
+    assert chatbot.rag_engine.search_stats["lexical"] == 2
+    assert chatbot.rag_engine.embeddings.embeddings.query_calls == 1
+    assert chatbot.answer_cache.stats()["hits"] == 1
+
+
+def test_follow_up_questions_always_generate(chatbot):
+    history = [{"role": "patient", "message": "Hi"}, {"role": "assistant", "message": "Hello!"}]
+    chatbot._generate_rag_response("Can I eat bananas?", None, history)
+    chatbot._generate_rag_response("Can I eat bananas?", None, history)
+
+    assert chatbot.recommender.model.calls == 2
+    assert chatbot.answer_cache.stats()["stores"] == 0
+
+
+def test_lexical_path_skips_embedding_when_not_asked(chatbot):
+    texts, vector = chatbot.rag_engine.search_with_vector("dialysis", k=1)
+
+    assert texts == [CHUNKS["dialysis"]]
+    assert vector is None
+    assert chatbot.rag_engine.embeddings.embeddings.query_calls == 0
@@ -0,0 +1,334 @@
+"""
+Behaviour of the embedded local datastore against what MongoDB returns for the same
+operations, for the query, update and aggregation operators the app uses
+"""
+
+import datetime
+import time
+
+import pytest
+
+pytest.importorskip("pymongo")
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from models import local_store
+from models.local_store import LocalClient, LocalDatabase
+
+
+@pytest.fixture
+def db():
+    return LocalDatabase('test')
+
+
+@pytest.fixture
+def people(db):
+    db.people.insert_many([
+        {'_id': 1, 'name': 'Ann', 'age': 30, 'tags': ['a', 'b'], 'city': 'Pune',
+         'history': [{'date': '2025-01-01', 'egfr': 60}, {'date': '2025-03-01', 'egfr': 52}]},
+        {'_id': 2, 'name': 'bob', 'age': 45, 'tags': ['b'], 'city': None,
+         'history': [{'date': '2025-02-01', 'egfr': 40}]},
+        {'_id': 3, 'name': 'Cy', 'age': 45, 'tags': []},
+        {'_id': 4, 'name': 'Dee', 'age': 61.5, 'tags': ['c'], 'city': 'Delhi'},
+    ])
+    return db.people
+
+
+def ids(docs):
+    return [d['_id'] for d in docs]
+
+
+# --- find ---------------------------------------------------------------------
+
+def test_find_comparison_and_logical_operators(people):
+    assert ids(people.find({'age': {'$gt': 30, '$lte': 45}}).sort('_id')) == [2, 3]
+    assert ids(people.find({'age': {'$in': [30, 61.5]}}).sort('_id')) == [1, 4]
+    assert ids(people.find({'age': {'$nin': [45]}}).sort('_id')) == [1, 4]
+    assert ids(people.find({'$or': [{'name': 'Ann'}, {'age': 61.5}]}).sort('_id')) == [1, 4]
+    assert ids(people.find({'$and': [{'age': 45}, {'name': {'$ne': 'bob'}}]})) == [3]
+    assert ids(people.find({'$nor': [{'age': 45}]}).sort('_id')) == [1, 4]
+
+
+def test_find_null_and_exists_semantics(people):
+    # {field: None} matches explicit nulls and missing fields alike
+    assert ids(people.find({'city': None}).sort('_id')) == [2, 3]
+    assert ids(people.find({'city': {'$exists': True}}).sort('_id')) == [1, 2, 4]
+    assert ids(people.find({'city': {'$exists': False}})) == [3]
+    assert ids(people.find({'city': {'$ne': None}}).sort('_id')) == [1, 4]
+    assert ids(people.find({'city': {'$type': 'string'}}).sort('_id')) == [1, 4]
+
+
+def test_find_arrays_and_embedded_documents(people):
+    # Equality on an array field matches any element
+    assert ids(people.find({'tags': 'b'}).sort('_id')) == [1, 2]
+    assert ids(people.find({'tags': {'$all': ['a', 'b']}})) == [1]
+    assert ids(people.find({'tags': {'$size': 0}})) == [3]
+    assert ids(people.find({'history.egfr': {'$lt': 45}})) == [2]
+    assert ids(people.find({'history': {'$elemMatch': {'date': {'$gte': '2025-02-01'}, 'egfr': {'$gt': 50}}}})) == [1]
+    assert ids(people.find({'history': {'$elemMatch': {'$or': [{'egfr': 40}, {'date': '2025-01-01'}]}}}).sort('_id')) == [1, 2]
+    assert ids(people.find({'tags': {'$elemMatch': {'$in': ['c']}}})) == [4]
+
+
+def test_find_regex_is_case_sensitive_unless_asked(people):
+    assert ids(people.find({'name': {'$regex': '^b'}})) == [2]
+    assert ids(people.find({'name': {'$regex': '^B'}})) == []
+    assert ids(people.find({'name': {'$regex': '^B', '$options': 'i'}})) == [2]
+
+
+def test_find_sort_skip_limit_and_projection(people):
+    docs = list(people.find({}, {'name': 1}).sort([('age', DESCENDING), ('_id', ASCENDING)]).skip(1).limit(2))
+    assert docs == [{'_id': 2, 'name': 'bob'}, {'_id': 3, 'name': 'Cy'}]
+    assert people.find_one({'_id': 1}, {'_id': 0, 'history.egfr': 1}) == {'history': [{'egfr': 60}, {'egfr': 52}]}
+    assert people.find_one({'_id': 1}, {'tags': 0, 'history': 0, 'city': 0}) == {'_id': 1, 'name': 'Ann', 'age': 30}
+    assert people.find_one({'_id': 1}, {'history': {'$slice': -1}})['history'] == [{'date': '2025-03-01', 'egfr': 52}]
+
+
+def test_count_and_distinct(people):
+    assert people.count_documents({'age': 45}) == 2
+    assert people.count_documents({}) == 4
+    assert sorted(people.distinct('tags')) == ['a', 'b', 'c']
+    assert sorted(people.distinct('age', {'age': {'$gte': 45}})) == [45, 61.5]
+
+
+# --- writes -------------------------------------------------------------------
+
+def test_insert_assigns_object_ids_and_rejects_duplicate_ids(db):
+    result = db.items.insert_one({'x': 1})
+    assert isinstance(result.inserted_id, ObjectId)
+    assert db.items.find_one({'x': 1})['_id'] == result.inserted_id
+    with pytest.raises(DuplicateKeyError):
+        db.items.insert_one({'_id': result.inserted_id})
+
+
+def test_update_operators(people):
+    people.update_one({'_id': 1}, {
+        '$set': {'city': 'Mumbai', 'current_metrics.egfr': 50},
+        '$inc': {'age': 1},
+        '$push': {'history': {'$each': [{'date': '2025-04-01', 'egfr': 50}], '$slice': -2}},
+        '$unset': {'tags': ''}
+    })
+    doc = people.find_one({'_id': 1})
+    assert doc['city'] == 'Mumbai' and doc['age'] == 31 and 'tags' not in doc
+    assert doc['current_metrics'] == {'egfr': 50}
+    assert [h['date'] for h in doc['history']] == ['2025-03-01', '2025-04-01']
+
+    people.update_one({'_id': 2}, {'$addToSet': {'tags': {'$each': ['b', 'z']}}, '$pull': {'history': {'egfr': 40}}})
+    doc = people.find_one({'_id': 2})
+    assert doc['tags'] == ['b', 'z'] and doc['history'] == []
+
+
+def test_update_results_and_upsert(people):
+    result = people.update_many({'age': 45}, {'$set': {'flag': True}})
+    assert (result.matched_count, result.modified_count) == (2, 2)
+
+    result = people.update_one({'name': 'Eve', 'age': 20}, {'$set': {'city': 'Goa'}, '$setOnInsert': {'new': True}}, upsert=True)
+    assert result.matched_count == 0 and result.upserted_id is not None
+    # Equality fields of the filter seed the inserted document
+    assert people.find_one({'_id': result.upserted_id}, {'_id': 0}) == {'name': 'Eve', 'age': 20, 'city': 'Goa', 'new': True}
+
+    people.update_one({'name': 'Eve'}, {'$set': {'city': 'Agra'}, '$setOnInsert': {'new': False}}, upsert=True)
+    assert people.find_one({'name': 'Eve'})['new'] is True
+
+
+def test_replace_and_delete(people):
+    people.replace_one({'_id': 3}, {'name': 'Cy', 'age': 46})
+    assert people.find_one({'_id': 3}) == {'_id': 3, 'name': 'Cy', 'age': 46}
+    assert people.delete_one({'age': {'$gte': 45}}).deleted_count == 1
+    assert people.delete_many({}).deleted_count == 3
+    assert people.count_documents({}) == 0
+
+
+def test_returned_documents_are_copies(people):
+    doc = people.find_one({'_id': 1})
+    doc['history'].append({'date': 'x'})
+    assert len(people.find_one({'_id': 1})['history']) == 2
+
+
+# --- indexes ------------------------------------------------------------------
+
+def test_unique_index(db):
+    db.users.create_index('username', unique=True)
+    db.users.insert_one({'username': 'ann'})
+    with pytest.raises(DuplicateKeyError):
+        db.users.insert_one({'username': 'ann'})
+    db.users.insert_one({'username': 'bob'})
+    with pytest.raises(DuplicateKeyError):
+        db.users.update_one({'username': 'bob'}, {'$set': {'username': 'ann'}})
+
+
+def test_partial_unique_index_ignores_documents_outside_the_filter(db):
+    db.users.create_index('username_key', unique=True,
+                          partialFilterExpression={'username_key': {'$exists': True}})
+    db.users.insert_many([{'username': 'legacy1'}, {'username': 'legacy2'}])
+    db.users.insert_one({'username': 'Ann', 'username_key': 'ann'})
+    with pytest.raises(DuplicateKeyError):
+        db.users.insert_one({'username': 'ANN', 'username_key': 'ann'})
+
+
+def test_creating_a_unique_index_over_duplicates_fails(db):
+    db.users.insert_many([{'k': 1}, {'k': 1}])
+    with pytest.raises(DuplicateKeyError):
+        db.users.create_index('k', unique=True)
+
+
+def test_ttl_index_expires_old_documents(db, monkeypatch):
+    monkeypatch.setattr(local_store, 'TTL_SWEEP_INTERVAL', 0)
+    db.cache.create_index('created_at', expireAfterSeconds=60)
+    now = datetime.datetime.utcnow()
+    db.cache.insert_many([{'_id': 'old', 'created_at': now - datetime.timedelta(minutes=5)},
+                          {'_id': 'new', 'created_at': now},
+                          {'_id': 'no-date', 'created_at': 'not a date'}])
+    db.cache._last_ttl_sweep = 0
+    assert sorted(ids(db.cache.find())) == ['new', 'no-date']
+
+
+# --- aggregation ----------------------------------------------------------------
+
+def test_match_group_sort(people):
+    rows = list(people.aggregate([
+        {'$match': {'age': {'$gte': 30}}},
+        {'$group': {'_id': '$age', 'count': {'$sum': 1}, 'names': {'$push': '$name'},
+                    'first': {'$first': '$name'}, 'avg_id': {'$avg': '$_id'}}},
+        {'$sort': {'_id': 1}}
+    ]))
+    assert rows == [
+        {'_id': 30, 'count': 1, 'names': ['Ann'], 'first': 'Ann', 'avg_id': 1.0},
+        {'_id': 45, 'count': 2, 'names': ['bob', 'Cy'], 'first': 'bob', 'avg_id': 2.5},
+        {'_id': 61.5, 'count': 1, 'names': ['Dee'], 'first': 'Dee', 'avg_id': 4.0},
+    ]
+
+
+def test_group_on_compound_key_then_push(db):
+    db.appointments.insert_many([
+        {'doctor_key': 'd1', 'patient_key': 'p2'}, {'doctor_key': 'd1', 'patient_key': 'p1'},
+        {'doctor_key': 'd1', 'patient_key': 'p2'}, {'doctor_key': 'd2', 'patient_key': 'p1'},
+    ])
+    rows = list(db.appointments.aggregate([
+        {'$group': {'_id': {'doctor': '$doctor_key', 'patient': '$patient_key'}}},
+        {'$sort': {'_id.doctor': 1, '_id.patient': 1}},
+        {'$group': {'_id': '$_id.doctor', 'keys': {'$push': '$_id.patient'}}},
+        {'$project': {'count': {'$size': '$keys'}, 'page': {'$slice': ['$keys', 1, 5]}}},
+        {'$sort': {'_id': 1}}
+    ]))
+    assert rows == [{'_id': 'd1', 'count': 2, 'page': ['p2']}, {'_id': 'd2', 'count': 1, 'page': []}]
+
+
+def test_unwind_and_count(people):
+    rows = list(people.aggregate([
+        {'$unwind': '$history'},
+        {'$match': {'history.egfr': {'$gte': 50}}},
+        {'$project': {'_id': 0, 'name': 1, 'egfr': '$history.egfr'}}
+    ]))
+    assert rows == [{'name': 'Ann', 'egfr': 60}, {'name': 'Ann', 'egfr': 52}]
+    # Documents with empty or missing arrays are dropped by default
+    assert list(people.aggregate([{'$unwind': '$tags'}, {'$count': 'n'}])) == [{'n': 4}]
+
+
+def test_lookup_with_local_and_foreign_field(db):
+    db.users.insert_many([{'_id': 1, 'username_key': 'ann'}, {'_id': 2, 'username_key': 'bob'}])
+    db.records.insert_many([{'username_key': 'ann', 'stage': 3}, {'username_key': 'ann', 'stage': 4}])
+    rows = list(db.users.aggregate([
+        {'$lookup': {'from': 'records', 'localField': 'username_key', 'foreignField': 'username_key', 'as': 'records'}},
+        {'$project': {'n': {'$size': '$records'}}},
+        {'$sort': {'_id': 1}}
+    ]))
+    assert rows == [{'_id': 1, 'n': 2}, {'_id': 2, 'n': 0}]
+
+
+def test_lookup_with_let_and_expr(db):
+    db.doctors.insert_many([{'_id': 'd1', 'key': 'd1'}, {'_id': 'd2', 'key': 'd2'}])
+    db.appointments.insert_many([{'doctor_key': 'd1', 'patient_key': 'p1'},
+                                 {'doctor_key': 'd1', 'patient_key': 'p2'}])
+    rows = list(db.doctors.aggregate([
+        {'$lookup': {'from': 'appointments', 'let': {'doctor': '$key'}, 'pipeline': [
+            {'$match': {'$expr': {'$eq': ['$doctor_key', '$$doctor']}}},
+            {'$project': {'_id': 0, 'patient_key': 1}}
+        ], 'as': 'appointments'}},
+        {'$sort': {'_id': 1}}
+    ]))
+    assert rows[0]['appointments'] == [{'patient_key': 'p1'}, {'patient_key': 'p2'}]
+    assert rows[1]['appointments'] == []
+
+
+def test_expressions(db):
+    db.docs.insert_one({'_id': 1, 'a': [3, 1, 3], 'b': [1, 2], 'name': '  Ann ', 'n': None, 'x': 7})
+    row = db.docs.aggregate([{'$project': {
+        'union': {'$setUnion': ['$a', '$b']},
+        'diff': {'$setDifference': ['$a', '$b']},
+        'concat': {'$concatArrays': ['$a', '$b']},
+        'lower': {'$toLower': {'$trim': {'input': '$name'}}},
+        'mapped': {'$map': {'input': '$b', 'in': {'$multiply': ['$$this', 10]}}},
+        'fallback': {'$ifNull': ['$n', 'none']},
+        'bucket': {'$switch': {'branches': [{'case': {'$gt': ['$x', 10]}, 'then': 'big'},
+                                            {'case': {'$gt': ['$x', 5]}, 'then': 'mid'}], 'default': 'small'}},
+        'odd': {'$cond': [{'$eq': [{'$arrayElemAt': ['$a', 0]}, 3]}, 'yes', 'no']},
+    }}]).next()
+    assert sorted(row['union']) == [1, 2, 3]
+    assert row['diff'] == [3]
+    assert row['concat'] == [3, 1, 3, 1, 2]
+    assert row['lower'] == 'ann'
+    assert row['mapped'] == [10, 20]
+    assert row['fallback'] == 'none'
+    assert row['bucket'] == 'mid'
+    assert row['odd'] == 'yes'
+
+
+def test_switch_without_matching_branch_or_default_fails(db):
+    db.docs.insert_one({'x': 1})
+    with pytest.raises(OperationFailure):
+        list(db.docs.aggregate([{'$project': {'y': {'$switch': {'branches': [{'case': False, 'then': 1}]}}}}]))
+
+
+def test_union_with(db):
+    db.a.insert_one({'_id': 1, 'src': 'a'})
+    db.b.insert_many([{'_id': 2, 'src': 'b'}, {'_id': 3, 'src': 'b', 'skip': True}])
+    rows = list(db.a.aggregate([
+        {'$unionWith': {'coll': 'b', 'pipeline': [{'$match': {'skip': {'$exists': False}}}]}}
+    ]))
+    assert ids(rows) == [1, 2]
+
+
+def test_unsupported_operators_fail_loudly(db):
+    db.docs.insert_one({'x': 1})
+    with pytest.raises(OperationFailure):
+        list(db.docs.aggregate([{'$project': {'y': {'$sortArray': {'input': [2, 1], 'sortBy': 1}}}}]))
+
+
+# --- persistence --------------------------------------------------------------
+
+def test_sqlite_store_persists_documents_and_indexes(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'store.db'}"
+    client = LocalClient(uri)
+    db = client['vois_ckd']
+    db.users.create_index('username', unique=True)
+    oid = db.users.insert_one({'username': 'ann', 'joined': datetime.datetime(2025, 1, 2, 3, 4, 5), 'n': 2.0}).inserted_id
+    client.close()
+
+    db = LocalClient(uri)['vois_ckd']
+    doc = db.users.find_one({'username': 'ann'})
+    # ObjectId, datetime and float survive the round trip through SQLite
+    assert doc == {'_id': oid, 'username': 'ann', 'joined': datetime.datetime(2025, 1, 2, 3, 4, 5), 'n': 2.0}
+    assert isinstance(doc['n'], float)
+    with pytest.raises(DuplicateKeyError):
+        db.users.insert_one({'username': 'ann'})
+
+
+def test_sqlite_store_sees_writes_from_another_connection(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'store.db'}"
+    reader = LocalClient(uri)['vois_ckd']
+    assert reader.items.count_documents({}) == 0
+    LocalClient(uri)['vois_ckd'].items.insert_one({'x': 1})
+    assert reader.items.count_documents({}) == 1
+
+
+def test_memory_store_is_shared_within_the_process():
+    name = f"test_memory_{time.monotonic_ns()}"
+    LocalClient('memory://')[name].items.insert_one({'x': 1})
+    assert LocalClient('memory://')[name].items.count_documents({}) == 1
+
+
+def test_sessions_are_not_supported():
+    with pytest.raises(OperationFailure):
+        LocalClient('memory://').start_session()